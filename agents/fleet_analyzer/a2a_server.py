@@ -2,6 +2,7 @@ from common.server import A2AServer
 from common.types import AgentCard, AgentCapabilities, AgentSkill
 from common.task_manager import AgentTaskManager
 from fleet_analyzer.fleet_analyzer_agent import FleetAnalyzerAgent
+from fleet_analyzer.fleet_analyzer_tools import spanner_data, serial_resolver
 import os
 import logging
 from dotenv import load_dotenv
@@ -50,6 +51,10 @@ def main():
         logger.info(f"Attempting to start server with Agent Card: {agent_card.name}")
         logger.info(f"Server object created: {server}")
 
+        if not spanner_data.warm_up():
+            logger.warning("Spanner session pool warmup failed; analyzer tools may be unavailable.")
+        else:
+            serial_resolver.warm_load()
         server.start()
     except Exception as e:
         logger.error(f"An error occurred during A2A server startup: {e}", exc_info=True)
@@ -1,14 +1,12 @@
 import os
+import sys
 from dotenv import load_dotenv
 import traceback
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 import json
 
-from google.cloud import spanner
 from google.cloud.spanner_v1 import param_types
-from google.cloud.spanner_v1.database import Database as SpannerDatabase
-from google.api_core import exceptions
 
 # --- Environment Variable Loading and Debugging ---
 print("fleet_analyzer_tools.py: Attempting to load .env file...")
@@ -26,94 +24,47 @@ if os.path.exists(dotenv_path):
 else:
     print(f"Fleet Analyzer Tools: .env file NOT FOUND at {dotenv_path}. Will rely on globally set environment variables or defaults.")
 
-# --- Spanner Configuration ---
-# These will now reflect .env values if override=True worked, or global env vars, or then defaults.
-PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT") # Must be set either globally or in .env
-SPANNER_INSTANCE_ID = os.environ.get("SPANNER_INSTANCE_ID", "rousefleet-graph-instance")
-SPANNER_DATABASE_ID = os.environ.get("SPANNER_DATABASE_ID", "graphdb")
+# --- Spanner Data Access ---
+# The client, session pool and query entry point are shared with the FleetPro web app
+# (rousefleet/spanner_data.py, rousefleet/serial_resolver.py). deploy_fleet_analyzer.sh stages copies into this package
+# for the container image; local runs import it straight from the repository.
+try:
+    from . import spanner_data
+    from .serial_resolver import serial_resolver
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'rousefleet'))
+    import spanner_data
+    from serial_resolver import serial_resolver
 
-db_instance: Optional[SpannerDatabase] = None
-spanner_client: Optional[spanner.Client] = None
+print(f"Fleet Analyzer Tools: Spanner Config to be used on first query: PROJECT_ID='{os.environ.get('GOOGLE_CLOUD_PROJECT')}', INSTANCE_ID='{os.environ.get('SPANNER_INSTANCE_ID', 'rousefleet-graph-instance')}', DATABASE_ID='{os.environ.get('SPANNER_DATABASE_ID', 'graphdb')}'")
 
-print(f"Fleet Analyzer Tools: FINAL Spanner Config to be used: PROJECT_ID='{PROJECT_ID}', INSTANCE_ID='{SPANNER_INSTANCE_ID}', DATABASE_ID='{SPANNER_DATABASE_ID}'")
-
-if not PROJECT_ID:
-    print("Fleet Analyzer Tools: CRITICAL ERROR - GOOGLE_CLOUD_PROJECT is not effectively set. Cannot initialize Spanner client.")
-elif not SPANNER_INSTANCE_ID:
-    print("Fleet Analyzer Tools: CRITICAL ERROR - SPANNER_INSTANCE_ID is not effectively set. Cannot initialize Spanner client.")
-elif not SPANNER_DATABASE_ID:
-    print("Fleet Analyzer Tools: CRITICAL ERROR - SPANNER_DATABASE_ID is not effectively set. Cannot initialize Spanner client.")
-else:
-    try:
-        spanner_client = spanner.Client(project=PROJECT_ID)
-        instance = spanner_client.instance(SPANNER_INSTANCE_ID) # Use the resolved variable
-        db_instance = instance.database(SPANNER_DATABASE_ID)   # Use the resolved variable
-        
-        print(f"Fleet Analyzer Tools: Attempting to check existence of {db_instance.name}...")
-        if not db_instance.exists():
-            print(f"Fleet Analyzer Tools Error: Database '{SPANNER_DATABASE_ID}' does not exist in instance '{SPANNER_INSTANCE_ID}'. Please ensure it's created and names are correct in your .env file or environment.")
-            db_instance = None
-        else:
-            print(f"Fleet Analyzer Tools: Successfully connected to Spanner: {db_instance.name}")
-            
-    except exceptions.NotFound as nf_error:
-        print(f"Fleet Analyzer Tools Error: Spanner resource not found. This usually means the INSTANCE_ID ('{SPANNER_INSTANCE_ID}') is incorrect for PROJECT_ID ('{PROJECT_ID}'), or less commonly the DATABASE_ID ('{SPANNER_DATABASE_ID}') if the instance was found. Error: {nf_error}")
-        db_instance = None
-    except Exception as e:
-        print(f"Fleet Analyzer Tools Error: An unexpected error occurred during Spanner initialization: {e}")
-        traceback.print_exc()
-        db_instance = None
-
-# --- The rest of your functions (run_sql_query, get_equipment_id_by_serial, etc.) remain unchanged from the previous version ---
-# Ensure they all start with 'if not db_instance: ... return None'
 
 def run_sql_query(sql: str, params: Optional[Dict[str, Any]] = None, param_types_map: Optional[Dict[str, Any]] = None, expected_fields: Optional[List[str]] = None) -> Optional[List[Dict[str, Any]]]:
-    if not db_instance:
-        print("Fleet Analyzer Tools: run_sql_query - Database connection (db_instance) is not available.")
-        return None 
-
-    results_list: List[Dict[str, Any]] = []
     try:
-        with db_instance.snapshot() as snapshot:
-            results = snapshot.execute_sql(sql, params=params, param_types=param_types_map)
-            
-            actual_field_names = expected_fields
-            if not actual_field_names:
-                if results and hasattr(results, 'fields') and results.fields:
-                    actual_field_names = [field.name for field in results.fields]
-                else:
-                    return [] 
-            
-            if not actual_field_names:
-                 return []
-
-            for row_idx, row in enumerate(results):
-                if len(actual_field_names) != len(row):
-                     print(f"Fleet Analyzer Tools: run_sql_query - Warning: Mismatch field names ({len(actual_field_names)}) vs row values ({len(row)}). Row {row_idx}: {row}")
-                     continue
-                results_list.append(dict(zip(actual_field_names, row)))
-    except Exception as e:
-        print(f"Fleet Analyzer Tools: An error occurred during SQL query execution: {e}")
-        traceback.print_exc()
+        results = spanner_data.run_query(sql, params=params, param_types_map=param_types_map, expected_fields=expected_fields)
+    except ConnectionError:
+        print("Fleet Analyzer Tools: run_sql_query - Database connection is not available.")
         return None
-    return results_list
+    if results is None:
+        print("Fleet Analyzer Tools: An error occurred during SQL query execution.")
+    return results
 
 def get_equipment_id_by_serial(serial_number: str) -> Optional[str]:
-    if not db_instance:
+    if not spanner_data.get_database():
         print(f"fleet_analyzer_tools.py: get_equipment_id_by_serial - db_instance not available for SN {serial_number}.")
         return None
-    sql = "SELECT equipment_id FROM Equipment WHERE serial_number = @serial_number LIMIT 1"
-    params = {"serial_number": serial_number}
-    param_types_map = {"serial_number": param_types.STRING}
-    fields = ["equipment_id"]
-    results = run_sql_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
-    if results:
-        return results[0]['equipment_id']
+    try:
+        equipment_id = serial_resolver.resolve(serial_number)
+    except ConnectionError:
+        print(f"Fleet Analyzer Tools: get_equipment_id_by_serial - Database connection is not available for SN {serial_number}.")
+        return None
+    if equipment_id:
+        return equipment_id
     print(f"Fleet Analyzer Tools: No equipment_id found for serial_number: {serial_number}")
     return None
 
 def get_equipment_details_for_analyzer(equipment_id: str) -> Optional[Dict[str, Any]]:
-    if not db_instance:
+    if not spanner_data.get_database():
         print(f"fleet_analyzer_tools.py: get_equipment_details_for_analyzer - db_instance not available for EQ_ID {equipment_id}.")
         return None
     sql = """
@@ -143,7 +94,7 @@ def get_equipment_details_for_analyzer(equipment_id: str) -> Optional[Dict[str,
     return None
 
 def get_recent_maintenance_for_equipment(equipment_id: str, limit: int = 3) -> Optional[List[Dict[str, Any]]]:
-    if not db_instance:
+    if not spanner_data.get_database():
         print(f"fleet_analyzer_tools.py: get_recent_maintenance_for_equipment - db_instance not available for EQ_ID {equipment_id}.")
         return None
     sql = """
@@ -166,8 +117,38 @@ def get_recent_maintenance_for_equipment(equipment_id: str, limit: int = 3) -> O
     return None
 
 
+def get_reliability_metrics_for_equipment(equipment_id: str) -> Optional[Dict[str, Any]]:
+    """Batch-computed reliability of a unit next to its make/model average (model_* fields); None if not computed yet."""
+    if not spanner_data.get_database():
+        print(f"fleet_analyzer_tools.py: get_reliability_metrics_for_equipment - db_instance not available for EQ_ID {equipment_id}.")
+        return None
+    sql = """
+        SELECT er.job_count, er.repair_count, er.mean_days_between_jobs, er.cost_per_meter_hour,
+               er.repair_ratio, er.trailing_spend, er.last_job_date, er.computed_at,
+               mr.mean_days_between_jobs AS model_mean_days_between_jobs,
+               mr.cost_per_meter_hour AS model_cost_per_meter_hour,
+               mr.repair_ratio AS model_repair_ratio, mr.trailing_spend AS model_trailing_spend
+        FROM EquipmentReliability AS er
+        LEFT JOIN ModelReliability AS mr ON mr.make = er.make AND mr.model = er.model
+        WHERE er.equipment_id = @equipment_id
+    """
+    params = {"equipment_id": equipment_id}
+    param_types_map = {"equipment_id": param_types.STRING}
+    fields = ["job_count", "repair_count", "mean_days_between_jobs", "cost_per_meter_hour", "repair_ratio",
+              "trailing_spend", "last_job_date", "computed_at", "model_mean_days_between_jobs",
+              "model_cost_per_meter_hour", "model_repair_ratio", "model_trailing_spend"]
+    results = run_sql_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    if not results:
+        return None
+    metrics = results[0]
+    for key in ("last_job_date", "computed_at"):
+        if isinstance(metrics.get(key), datetime):
+            metrics[key] = metrics[key].isoformat()
+    return metrics
+
+
 def get_comprehensive_equipment_report(equipment_id: str) -> Optional[Dict[str, Any]]:
-    if not db_instance:
+    if not spanner_data.get_database():
         print(f"fleet_analyzer_tools.py: get_comprehensive_equipment_report - db_instance not available for EQ_ID {equipment_id}.")
         return {"error": "Database connection not available."} 
     if not equipment_id:
@@ -180,32 +161,20 @@ def get_comprehensive_equipment_report(equipment_id: str) -> Optional[Dict[str,
         return {"error": f"No primary details found for equipment ID: {equipment_id}"}
         
     maintenance_summary = get_recent_maintenance_for_equipment(equipment_id, limit=3)
+    reliability = get_reliability_metrics_for_equipment(equipment_id)
     
     report = {
         "equipment_details": details,
         "recent_maintenance": maintenance_summary if maintenance_summary is not None else "Could not retrieve maintenance information.",
+        "reliability_metrics": reliability if reliability is not None else "Reliability metrics have not been computed for this equipment.",
     }
     return report
 
 def run_graph_query(graph_sql: str, params: Optional[Dict[str, Any]] = None, param_types_map: Optional[Dict[str, Any]] = None, expected_fields: Optional[List[str]] = None) -> Optional[List[Dict[str, Any]]]:
-    if not db_instance:
+    if not spanner_data.get_database():
         print("fleet_analyzer_tools.py: Database connection is not available for run_graph_query.")
         return None
-    results_list: List[Dict[str, Any]] = []
-    try:
-        with db_instance.snapshot() as snapshot:
-            results = snapshot.execute_sql(graph_sql, params=params, param_types=param_types_map)
-            actual_field_names = expected_fields
-            if not actual_field_names:
-                if results and hasattr(results, 'fields') and results.fields:
-                    actual_field_names = [field.name for field in results.fields]
-                else: return []
-            if not actual_field_names: return []
-            for row in results:
-                if len(actual_field_names) != len(row): continue
-                results_list.append(dict(zip(actual_field_names, row)))
-    except Exception as e:
-        print(f"Fleet Analyzer Tools: An error occurred during Graph query execution: {e}")
-        traceback.print_exc()
-        return None
-    return results_list
\ No newline at end of file
+    results = spanner_data.run_query(graph_sql, params=params, param_types_map=param_types_map, expected_fields=expected_fields)
+    if results is None:
+        print("Fleet Analyzer Tools: An error occurred during Graph query execution.")
+    return results
@@ -43,6 +43,7 @@ gcloud run deploy "${SERVICE_NAME}" \
   --set-env-vars="GOOGLE_CLOUD_PROJECT=${PROJECT_ID}" \
   --set-env-vars="GOOGLE_MAPS_API_KEY=${GOOGLE_MAPS_API_KEY}" \
   --set-env-vars="FLEET_ORCHESTRATOR_AGENT_ID=${ORCHESTRATE_AGENT_ID}" \
+  --set-env-vars="CHANGE_FEED_SOURCE=${CHANGE_FEED_SOURCE:-change_stream}" \
   --project="${PROJECT_ID}" \
   --min-instances=1 \
   --cpu=2 \
@@ -17,7 +17,14 @@ export IMAGE_PATH="${REGION}-docker.pkg.dev/${PROJECT_ID}/${REPO_NAME}/${IMAGE_N
 export SERVICE_NAME="fleet-analyzer-agent"   ## :contentReference[oaicite:24]{index=24}
 export PUBLIC_URL="https://fleet-analyzer-agent-${PROJECT_NUMBER}.${REGION}.run.app"  ## :contentReference[oaicite:25]{index=25}
 
-# 4) Build the Docker image and push to Artifact Registry
+# 4) Stage the shared Spanner data-access modules next to the agent (the build
+#    context is agents/, so it can't be copied from rousefleet/ inside the Dockerfile)
+SHARED_MODULES="spanner_data.py query_stats.py serial_resolver.py"
+for module in ${SHARED_MODULES}; do
+  cp "../rousefleet/${module}" "./${AGENT_NAME}/${module}"
+done
+
+# 5) Build the Docker image and push to Artifact Registry
 echo "Building ${AGENT_NAME} agent..."
 gcloud builds submit . \
   --config=cloudbuild.yaml \
@@ -25,9 +32,13 @@ gcloud builds submit . \
   --region="${REGION}" \
   --substitutions=_AGENT_NAME="${AGENT_NAME}",_IMAGE_PATH="${IMAGE_PATH}"   ## :contentReference[oaicite:26]{index=26}
 
+for module in ${SHARED_MODULES}; do
+  rm -f "./${AGENT_NAME}/${module}"
+done
+
 echo "Image built and pushed to: ${IMAGE_PATH}"
 
-# 5) Deploy the container to Cloud Run, injecting necessary environment variables
+# 6) Deploy the container to Cloud Run, injecting necessary environment variables
 echo "Deploying ${SERVICE_NAME} to Cloud Run..."
 gcloud run deploy "${SERVICE_NAME}" \
   --image="${IMAGE_PATH}" \
@@ -45,7 +56,7 @@ gcloud run deploy "${SERVICE_NAME}" \
   --project="${PROJECT_ID}" \
   --min-instances=1   ## :contentReference[oaicite:27]{index=27}
 
-# 6) Retrieve and export the URL of the deployed service
+# 7) Retrieve and export the URL of the deployed service
 export FLEET_ANALYZER_AGENT_URL="$(
   gcloud run services list \
     --platform=managed \
@@ -3,23 +3,39 @@
 import os
 from datetime import datetime, timezone
 from dotenv import load_dotenv
-from flask import Flask, render_template, abort, flash, request, jsonify, current_app
+from flask import Flask, render_template, abort, flash, request, jsonify, current_app, redirect, url_for, Response, make_response
 from google.cloud import spanner
 from google.cloud.spanner_v1 import param_types
-from google.api_core import exceptions
+from spanner_data import get_database, run_query, run_queries_batch, warm_up, is_warm, read_consistency, with_read_consistency, staleness_bound_seconds, current_staleness_seconds, STALE_READ_CONSISTENCY
+from pagination import build_page, clamp_page_size, decode_cursor, keyset_after_condition
+from read_cache import register_cache, notify_write, cache_stats
+from serial_resolver import serial_resolver
+from location_ingest import location_buffer, parse_ping, add_flush_listener
+from fleet_summary import fleet_summary
+from spatial_index import spatial_index
+from geocoder import geocoder
+from availability_index import availability_index
+from candidate_ranking import job_window
+import reliability_metrics
+from change_feed import change_feed
+import query_stats
 import humanize
 import uuid
+import hashlib
 import traceback
+from concurrent.futures import wait as futures_wait
 from dateutil import parser as dateutil_parser
 
 # --- Import your new blueprint ---
 from fleet_advisor_routes import fleet_advisor_bp # <<< ADD THIS LINE
+from export_routes import export_bp
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "a_default_secret_key_for_fleetpro_dev")
 
 # --- Register your new blueprint ---
 app.register_blueprint(fleet_advisor_bp) # <<< ADD THIS LINE
+app.register_blueprint(export_bp)
 
 load_dotenv()
 # --- Spanner Configuration ---
@@ -35,95 +51,30 @@ if not PROJECT_ID:
 if not Maps_API_KEY:
     print("Warning: Maps_API_KEY environment variable not set. Maps will not function.")
 
-# --- Spanner Client Initialization ---
-db = None
-try:
-    spanner_client = spanner.Client(project=PROJECT_ID)
-    instance = spanner_client.instance(INSTANCE_ID)
-    database = instance.database(DATABASE_ID)
-    print(f"Attempting to connect to Spanner: {instance.name}/databases/{database.name}")
-
-    if not database.exists():
-         print(f"Error: Database '{database.name}' does not exist in instance '{instance.name}'.")
-         print("Please ensure the database and tables are created.")
-         db = None
-    else:
-        print("Database connection check successful (database exists).")
-        db = database
+# --- Spanner Data Access ---
+# The client, session pool and query helper live in spanner_data; the connection
+# is created lazily on first use and warmed up before the server starts.
 
-except exceptions.NotFound:
-    print(f"Error: Spanner instance '{INSTANCE_ID}' not found in project '{PROJECT_ID}'.")
-except Exception as e:
-    print(f"An unexpected error occurred during Spanner initialization: {e}")
-    traceback.print_exc()
+# --- FleetPro Data Access Functions ---
 
-def run_query(sql, params=None, param_types_map=None, expected_fields=None):
-    if not db:
-        print("Error in run_query: Database connection (db object) is not available.")
-        # This ConnectionError will be caught by the updated fleet_advisor_agent_logic
-        raise ConnectionError("Spanner database connection not initialized.")
-    
-    results_list = []
-    # print(f"--- Executing SQL ---\nSQL: {sql}") # Verbose logging, uncomment for debugging
-    # if params: print(f"Params: {params}")
-    # print("----------------------")
-    
-    try:
-        with db.snapshot() as snapshot:
-            results = snapshot.execute_sql(sql, params=params, param_types=param_types_map)
-            
-            if not expected_fields:
-                print("Warning in run_query: expected_fields not provided. Attempting dynamic lookup.")
-                try:
-                    # Ensure results object is not None and has fields attribute
-                    if results and hasattr(results, 'fields'):
-                        field_names = [field.name for field in results.fields]
-                    else:
-                        # Handle cases where results might not be as expected (e.g., DML in snapshot, though unlikely here)
-                        print("Error in run_query: Could not determine field names from results (results object or fields attribute missing).")
-                        return None # Indicate an error processing results
-                except AttributeError as e:
-                    print(f"Error in run_query: Could not determine field names (results.fields failed): {e}")
-                    return None # Indicate an error processing results
-            else:
-                field_names = expected_fields
-
-            for row_idx, row in enumerate(results): # Iterate safely
-                if len(field_names) != len(row):
-                     print(f"Warning in run_query: Mismatch field names ({len(field_names)}) vs row values ({len(row)}). Row {row_idx}: {row}")
-                     continue # Skip malformed row
-                results_list.append(dict(zip(field_names, row)))
-            # print(f"Query successful, fetched {len(results_list)} rows.")
-            
-    except (exceptions.NotFound, exceptions.PermissionDenied, exceptions.InvalidArgument) as spanner_err:
-        print(f"Spanner Error in run_query ({type(spanner_err).__name__}): {spanner_err}")
-        # Flashing messages won't work for SSE, but logging is good.
-        return None # Return None to indicate a handled Spanner query failure
-        
-    except ValueError as ve: # Catch ValueErrors from field processing or other logic
-         print(f"ValueError in run_query (e.g., query processing): {ve}")
-         traceback.print_exc() # Print traceback for ValueErrors too
-         return None
-         
-    except ConnectionError as ce: # Specifically catch ConnectionError if db object became None unexpectedly
-        print(f"ConnectionError in run_query: {ce}")
-        traceback.print_exc()
-        # Re-raise this specific one if we want fleet_advisor_agent_logic to catch it explicitly
-        # or return None to signal failure. For now, let it be caught by the general Exception below.
-        # However, the initial 'if not db:' check should make this rare here.
-        raise # Re-raise to be caught by the agent's specific ConnectionError handler if possible
-
-    except Exception as e: # Catch any other unexpected exceptions
-        print(f"An UNEXPECTED error occurred during query execution in run_query: {e}")
-        traceback.print_exc() # Log the full traceback to server logs
-        return None # MODIFIED: Return None instead of re-raising, to protect SSE streams
-        
-    return results_list
+def _keyset_clause(cursor, columns, param_prefix="after"):
+    """
+    Returns (where_sql, params, param_types_map) restricting a listing to rows after the
+    page cursor. Raises ValueError for malformed cursors. All key columns are STRING.
+    """
+    key_values = decode_cursor(cursor, len(columns))
+    if key_values is None:
+        return "TRUE", {}, {}
+    condition, params = keyset_after_condition(columns, key_values, param_prefix)
+    param_types_map = {name: param_types.STRING for name in params}
+    return condition, params, param_types_map
 
-# --- FleetPro Data Access Functions ---
+EQUIPMENT_LIST_KEY = ["make", "model", "equipment_id"]
 
-def get_all_equipment_db(limit=50):
-    sql = """
+def get_all_equipment_db(limit=50, cursor=None):
+    """Returns one keyset page of equipment ordered by (make, model, equipment_id)."""
+    where_sql, params, param_types_map = _keyset_clause(cursor, ["eq.make", "eq.model", "eq.equipment_id"])
+    sql = f"""
         SELECT
             eq.equipment_id, eq.serial_number, eq.description, eq.category, eq.subcategory,
             eq.make, eq.model, eq.model_year, eq.meter_hours,
@@ -134,11 +85,12 @@ def get_all_equipment_db(limit=50):
         FROM Equipment AS eq
         LEFT JOIN Customer AS c ON eq.current_customer_id = c.customer_id
         LEFT JOIN ServiceLocation AS sl ON eq.current_service_location_id = sl.location_id
-        ORDER BY eq.make, eq.model
+        WHERE {where_sql}
+        ORDER BY eq.make, eq.model, eq.equipment_id
         LIMIT @limit
     """
-    params = {"limit": limit}
-    param_types_map = {"limit": param_types.INT64}
+    params["limit"] = limit + 1
+    param_types_map["limit"] = param_types.INT64
     fields = [
         "equipment_id", "serial_number", "description", "category", "subcategory",
         "make", "model", "model_year", "meter_hours",
@@ -146,9 +98,10 @@ def get_all_equipment_db(limit=50):
         "current_customer_name", "current_customer_id",
         "current_service_location_name", "current_service_location_id", "photo_url"
     ]
-    return run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    rows = run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    return build_page(rows, limit, EQUIPMENT_LIST_KEY)
 
-def get_equipment_details_db(equipment_id):
+def _equipment_details_query(equipment_id):
     sql = """
         SELECT
             eq.equipment_id, eq.serial_number, eq.description, eq.list_price,
@@ -176,10 +129,13 @@ def get_equipment_details_db(equipment_id):
         "current_customer_id", "current_customer_name", "customer_industry",
         "create_time"
     ]
-    results = run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    return {"sql": sql, "params": params, "param_types_map": param_types_map, "expected_fields": fields}
+
+def get_equipment_details_db(equipment_id):
+    results = run_query(**_equipment_details_query(equipment_id))
     return results[0] if results else None
 
-def get_maintenance_jobs_for_equipment_db(equipment_id, limit=20):
+def _maintenance_jobs_for_equipment_query(equipment_id, limit=20):
     sql = """
         SELECT job_id, job_date, job_description, cost, service_type, create_time
         FROM MaintenanceJob
@@ -190,9 +146,12 @@ def get_maintenance_jobs_for_equipment_db(equipment_id, limit=20):
     params = {"equipment_id": equipment_id, "limit": limit}
     param_types_map = {"equipment_id": param_types.STRING, "limit": param_types.INT64}
     fields = ["job_id", "job_date", "job_description", "cost", "service_type", "create_time"]
-    return run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    return {"sql": sql, "params": params, "param_types_map": param_types_map, "expected_fields": fields}
 
-def get_customer_details_db(customer_id):
+def get_maintenance_jobs_for_equipment_db(equipment_id, limit=20):
+    return run_query(**_maintenance_jobs_for_equipment_query(equipment_id, limit))
+
+def _customer_details_query(customer_id):
     sql = """
         SELECT customer_id, customer_name, industry_type, region, create_time
         FROM Customer
@@ -201,10 +160,13 @@ def get_customer_details_db(customer_id):
     params = {"customer_id": customer_id}
     param_types_map = {"customer_id": param_types.STRING}
     fields = ["customer_id", "customer_name", "industry_type", "region", "create_time"]
-    results = run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    return {"sql": sql, "params": params, "param_types_map": param_types_map, "expected_fields": fields}
+
+def get_customer_details_db(customer_id):
+    results = run_query(**_customer_details_query(customer_id))
     return results[0] if results else None
 
-def get_equipment_for_customer_db(customer_id, limit=50):
+def _equipment_for_customer_query(customer_id, limit=50):
     sql = """
         SELECT
             eq.equipment_id, eq.serial_number, eq.description, eq.make, eq.model,
@@ -218,9 +180,12 @@ def get_equipment_for_customer_db(customer_id, limit=50):
     params = {"customer_id": customer_id, "limit": limit}
     param_types_map = {"customer_id": param_types.STRING, "limit": param_types.INT64}
     fields = ["equipment_id", "serial_number", "description", "make", "model", "assignment_type", "assignment_start_date"]
-    return run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    return {"sql": sql, "params": params, "param_types_map": param_types_map, "expected_fields": fields}
 
-def get_service_location_details_db(location_id):
+def get_equipment_for_customer_db(customer_id, limit=50):
+    return run_query(**_equipment_for_customer_query(customer_id, limit))
+
+def _service_location_details_query(location_id):
     sql = """
         SELECT location_id, name, address, city, state_province, postal_code, country,
                latitude, longitude, capacity, create_time
@@ -230,10 +195,13 @@ def get_service_location_details_db(location_id):
     params = {"location_id": location_id}
     param_types_map = {"location_id": param_types.STRING}
     fields = ["location_id", "name", "address", "city", "state_province", "postal_code", "country", "latitude", "longitude", "capacity", "create_time"]
-    results = run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    return {"sql": sql, "params": params, "param_types_map": param_types_map, "expected_fields": fields}
+
+def get_service_location_details_db(location_id):
+    results = run_query(**_service_location_details_query(location_id))
     return results[0] if results else None
 
-def get_equipment_at_service_location_db(location_id, limit=50):
+def _equipment_at_service_location_query(location_id, limit=50):
     sql = """
         SELECT
             equipment_id, serial_number, description, make, model, category, subcategory
@@ -245,43 +213,210 @@ def get_equipment_at_service_location_db(location_id, limit=50):
     params = {"location_id": location_id, "limit": limit}
     param_types_map = {"location_id": param_types.STRING, "limit": param_types.INT64}
     fields = ["equipment_id", "serial_number", "description", "make", "model", "category", "subcategory"]
-    return run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    return {"sql": sql, "params": params, "param_types_map": param_types_map, "expected_fields": fields}
+
+def get_equipment_at_service_location_db(location_id, limit=50):
+    return run_query(**_equipment_at_service_location_query(location_id, limit))
+
+# --- Detail Page Reads (one multi-use snapshot, queries run concurrently) ---
+
+def _first_row(rows):
+    return rows[0] if rows else None
+
+def get_equipment_page_db(equipment_id):
+    """
+    Returns (equipment, maintenance_jobs) read at one timestamp, all queries in flight at once.
+    The unit's batch reliability metrics, if computed, are in equipment["reliability"].
+    """
+    results = run_queries_batch({
+        "equipment": _equipment_details_query(equipment_id),
+        "maintenance_jobs": _maintenance_jobs_for_equipment_query(equipment_id),
+        "reliability": reliability_metrics.reliability_query(equipment_id),
+    })
+    equipment = _first_row(results["equipment"])
+    if equipment is not None:
+        equipment["reliability"] = _first_row(results["reliability"])
+    return equipment, results["maintenance_jobs"]
+
+def get_customer_page_db(customer_id):
+    """Returns (customer, assigned_equipment) read at one timestamp, both queries in flight at once."""
+    results = run_queries_batch({
+        "customer": _customer_details_query(customer_id),
+        "assigned_equipment": _equipment_for_customer_query(customer_id),
+    })
+    return _first_row(results["customer"]), results["assigned_equipment"]
+
+def get_service_location_page_db(location_id):
+    """Returns (location, equipment_at_location) read at one timestamp, both queries in flight at once."""
+    results = run_queries_batch({
+        "location": _service_location_details_query(location_id),
+        "equipment_at_location": _equipment_at_service_location_query(location_id),
+    })
+    return _first_row(results["location"]), results["equipment_at_location"]
+
+# --- Detail Page Versions (ETag / If-None-Match) ---
+# One cheap strong read per detail page returning the commit timestamps (and counts) of
+# everything the page shows. Rows never updated since insert have no last_update_time,
+# so create_time stands in. Hashed into an ETag, this lets polls of unchanged pages get
+# a 304 without running the page's joins or rendering its template.
+
+ETAG_SALT = os.environ.get("K_REVISION", "")  # a new deployment may render pages differently
+
+def _equipment_version_query(equipment_id):
+    sql = """
+        SELECT
+            COALESCE(eq.last_update_time, eq.create_time) AS equipment_version,
+            COALESCE(c.last_update_time, c.create_time) AS customer_version,
+            COALESCE(sl.last_update_time, sl.create_time) AS location_version,
+            (SELECT COUNT(*) FROM MaintenanceJob AS mj WHERE mj.equipment_id = eq.equipment_id) AS job_count,
+            (SELECT MAX(mj.create_time) FROM MaintenanceJob AS mj WHERE mj.equipment_id = eq.equipment_id) AS job_version,
+            (SELECT er.computed_at FROM EquipmentReliability AS er WHERE er.equipment_id = eq.equipment_id) AS reliability_version
+        FROM Equipment AS eq
+        LEFT JOIN Customer AS c ON eq.current_customer_id = c.customer_id
+        LEFT JOIN ServiceLocation AS sl ON eq.current_service_location_id = sl.location_id
+        WHERE eq.equipment_id = @equipment_id
+    """
+    fields = ["equipment_version", "customer_version", "location_version", "job_count", "job_version", "reliability_version"]
+    return {"sql": sql, "params": {"equipment_id": equipment_id},
+            "param_types_map": {"equipment_id": param_types.STRING}, "expected_fields": fields}
 
-def get_all_customers_db(limit=100):
+def _customer_version_query(customer_id):
     sql = """
+        SELECT
+            COALESCE(c.last_update_time, c.create_time) AS customer_version,
+            a.assignment_count, a.assignment_version, a.equipment_version
+        FROM Customer AS c
+        CROSS JOIN (
+            SELECT COUNT(*) AS assignment_count,
+                   MAX(asgn.create_time) AS assignment_version,
+                   MAX(COALESCE(eq.last_update_time, eq.create_time)) AS equipment_version
+            FROM CustomerEquipmentAssignment AS asgn
+            JOIN Equipment AS eq ON eq.equipment_id = asgn.equipment_id
+            WHERE asgn.customer_id = @customer_id
+        ) AS a
+        WHERE c.customer_id = @customer_id
+    """
+    fields = ["customer_version", "assignment_count", "assignment_version", "equipment_version"]
+    return {"sql": sql, "params": {"customer_id": customer_id},
+            "param_types_map": {"customer_id": param_types.STRING}, "expected_fields": fields}
+
+def _service_location_version_query(location_id):
+    sql = """
+        SELECT
+            COALESCE(sl.last_update_time, sl.create_time) AS location_version,
+            e.equipment_count, e.equipment_version
+        FROM ServiceLocation AS sl
+        CROSS JOIN (
+            SELECT COUNT(*) AS equipment_count,
+                   MAX(COALESCE(eq.last_update_time, eq.create_time)) AS equipment_version
+            FROM Equipment AS eq
+            WHERE eq.current_service_location_id = @location_id
+        ) AS e
+        WHERE sl.location_id = @location_id
+    """
+    fields = ["location_version", "equipment_count", "equipment_version"]
+    return {"sql": sql, "params": {"location_id": location_id},
+            "param_types_map": {"location_id": param_types.STRING}, "expected_fields": fields}
+
+def get_detail_version_db(version_query):
+    """
+    Returns a version token for a detail page, or None if the record doesn't exist or the read failed.
+
+    Always a strong read: a poll must see a write as soon as it has committed.
+    """
+    rows = run_query(**version_query, consistency="strong")
+    if not rows:
+        return None
+    return hashlib.sha1(repr((ETAG_SALT, sorted(rows[0].items()))).encode("utf-8")).hexdigest()[:24]
+
+def _not_modified_or_none(version, representation):
+    """Returns (etag, 304 response or None) for the current request."""
+    if version is None:
+        return None, None
+    etag = f"{representation}-{version}"
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return etag, response
+    return etag, None
+
+def _with_etag(response, etag):
+    response = make_response(response)
+    if etag:
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"  # always revalidate; the 304 path is cheap
+    return response
+
+CUSTOMER_LIST_KEY = ["customer_name", "customer_id"]
+
+def _cached_page(cache, key, load):
+    """
+    Serves a list page through cache only for reads in the stale window it was built for:
+    a strong read (?consistency=strong) must see the latest commit, and a staler one
+    than settle_seconds could outlive the write that invalidated it.
+    """
+    staleness = current_staleness_seconds()
+    if staleness == 0 or staleness > cache.settle_seconds:
+        return load()
+    return cache.get_or_load(key, load)
+
+# List pages are read with STALE_READ_CONSISTENCY (see the list routes), so a page loaded right after a
+# write may predate it; settle_seconds keeps such pages only until that window has passed.
+customer_list_cache = register_cache("customer_list", max_entries=128, depends_on={"Customer": None},
+                                     settle_seconds=staleness_bound_seconds(STALE_READ_CONSISTENCY))
+
+def get_all_customers_db(limit=100, cursor=None):
+    """Returns one keyset page of customers ordered by (customer_name, customer_id). Cached per page."""
+    return _cached_page(customer_list_cache, (limit, cursor), lambda: _query_customers_page(limit, cursor))
+
+def _query_customers_page(limit, cursor):
+    where_sql, params, param_types_map = _keyset_clause(cursor, ["customer_name", "customer_id"])
+    sql = f"""
         SELECT customer_id, customer_name, industry_type, region
         FROM Customer
-        ORDER BY customer_name
+        WHERE {where_sql}
+        ORDER BY customer_name, customer_id
         LIMIT @limit
     """
-    params = {"limit": limit}
-    param_types_map = {"limit": param_types.INT64}
+    params["limit"] = limit + 1
+    param_types_map["limit"] = param_types.INT64
     fields = ["customer_id", "customer_name", "industry_type", "region"]
-    return run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    rows = run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    return build_page(rows, limit, CUSTOMER_LIST_KEY)
 
-def get_all_service_locations_db(limit=50):
-    sql = """
+LOCATION_LIST_KEY = ["name", "location_id"]
+
+location_list_cache = register_cache("service_location_list", max_entries=128, depends_on={"ServiceLocation": None},
+                                     settle_seconds=staleness_bound_seconds(STALE_READ_CONSISTENCY))
+
+def get_all_service_locations_db(limit=50, cursor=None):
+    """Returns one keyset page of service locations ordered by (name, location_id). Cached per page."""
+    return _cached_page(location_list_cache, (limit, cursor), lambda: _query_service_locations_page(limit, cursor))
+
+def _query_service_locations_page(limit, cursor):
+    where_sql, params, param_types_map = _keyset_clause(cursor, ["name", "location_id"])
+    sql = f"""
         SELECT location_id, name, city, state_province, capacity
         FROM ServiceLocation
-        ORDER BY name
+        WHERE {where_sql}
+        ORDER BY name, location_id
         LIMIT @limit
     """
-    params = {"limit": limit}
-    param_types_map = {"limit": param_types.INT64}
+    params["limit"] = limit + 1
+    param_types_map["limit"] = param_types.INT64
     fields = ["location_id", "name", "city", "state_province", "capacity"]
-    return run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    rows = run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    return build_page(rows, limit, LOCATION_LIST_KEY)
 
-def get_equipment_by_serial_number_db(serial_number):
-    sql = "SELECT equipment_id FROM Equipment WHERE serial_number = @serial_number LIMIT 1"
-    params = {"serial_number": serial_number}
-    param_types_map = {"serial_number": param_types.STRING}
-    fields = ["equipment_id"]
-    results = run_query(sql, params=params, param_types_map=param_types_map, expected_fields=fields)
-    return results[0]['equipment_id'] if results else None
+def get_equipment_by_serial_number_db(serial_number, trust_negative=True):
+    return serial_resolver.resolve(serial_number, trust_negative=trust_negative)
 
-def add_maintenance_job_db(equipment_id, job_description, cost, service_type, job_date=None):
-    if not db: raise ConnectionError("DB not init.")
-    job_id = str(uuid.uuid4())
+def resolve_serial_numbers_db(serial_numbers):
+    """Maps many serial numbers to equipment IDs (one IN UNNEST query for cache misses). Unknown serials are omitted."""
+    return serial_resolver.resolve_many(serial_numbers)
+
+def _normalize_job_date(job_date):
     job_date_to_insert = job_date # Will be Python datetime object or None
     if job_date is None:
         job_date_to_insert = datetime.now(timezone.utc)
@@ -297,22 +432,92 @@ def add_maintenance_job_db(equipment_id, job_description, cost, service_type, jo
         job_date_to_insert = job_date_to_insert.replace(tzinfo=timezone.utc)
     else:
         job_date_to_insert = job_date_to_insert.astimezone(timezone.utc)
+    return job_date_to_insert
+
+def _after_commit(hook, *args, **kwargs):
+    """Runs a post-commit cache/index hook. A failure is logged and never fails the write that already committed."""
+    try:
+        hook(*args, **kwargs)
+    except Exception as e:
+        print(f"Post-commit hook {getattr(hook, '__qualname__', hook)} failed: {e}")
+        traceback.print_exc()
+
+MAINTENANCE_JOB_COLUMNS = ["job_id", "equipment_id", "job_date", "job_description", "cost", "service_type", "create_time"]
+
+def add_maintenance_job_db(equipment_id, job_description, cost, service_type, job_date=None):
+    db = get_database()
+    if not db: raise ConnectionError("DB not init.")
+    job_id = str(uuid.uuid4())
+    job_date_to_insert = _normalize_job_date(job_date)
 
     def _insert_job(transaction):
         transaction.insert(
             table="MaintenanceJob",
-            columns=["job_id", "equipment_id", "job_date", "job_description", "cost", "service_type", "create_time"],
+            columns=MAINTENANCE_JOB_COLUMNS,
             values=[(job_id, equipment_id, job_date_to_insert, job_description, cost, service_type, spanner.COMMIT_TIMESTAMP)]
         )
     try:
         db.run_in_transaction(_insert_job)
-        return job_id
     except Exception as e:
         print(f"Error inserting maintenance job for equipment {equipment_id}: {e}")
         traceback.print_exc()
         return None
+    _after_commit(notify_write, "MaintenanceJob")
+    _after_commit(change_feed.publish, "MaintenanceJob", {"job_id": job_id}, mod_type="INSERT",
+                  values={"equipment_id": equipment_id, "job_date": job_date_to_insert, "job_description": job_description,
+                          "cost": cost, "service_type": service_type})
+    _after_commit(fleet_summary.on_maintenance_jobs_added, [(job_id, equipment_id, cost, job_date_to_insert)])
+    return job_id
+
+# Spanner caps mutations per commit (every inserted column plus every secondary-index
+# entry counts). MaintenanceJob rows cost 7 column mutations plus 2 per index
+# (MaintenanceJobByEquipment, MaintenanceJobByDate).
+SPANNER_MUTATION_LIMIT = int(os.environ.get("SPANNER_MUTATION_LIMIT", "80000"))
+MAINTENANCE_JOB_MUTATIONS_PER_ROW = len(MAINTENANCE_JOB_COLUMNS) + 2 * 2
+
+def add_maintenance_jobs_batch_db(jobs):
+    """
+    Inserts many maintenance jobs with blind batched mutations, chunked to the commit mutation limit.
+
+    Args:
+        jobs (list[dict]): Items with equipment_id, job_description, cost, service_type, job_date.
+
+    Returns:
+        list[tuple[str | None, str | None]]: (job_id, error) per input item, in order.
+        A chunk commits atomically, so a failed commit fails every item in that chunk.
+    """
+    db = get_database()
+    if not db: raise ConnectionError("DB not init.")
+    chunk_rows = max(1, SPANNER_MUTATION_LIMIT // MAINTENANCE_JOB_MUTATIONS_PER_ROW)
+    outcomes = []
+    committed_any = False
+    for chunk_start in range(0, len(jobs), chunk_rows):
+        chunk = jobs[chunk_start:chunk_start + chunk_rows]
+        rows = [(
+            str(uuid.uuid4()), job["equipment_id"], _normalize_job_date(job.get("job_date")),
+            job["job_description"], job["cost"], job["service_type"], spanner.COMMIT_TIMESTAMP
+        ) for job in chunk]
+        try:
+            with db.batch() as batch:
+                batch.insert(table="MaintenanceJob", columns=MAINTENANCE_JOB_COLUMNS, values=rows)
+        except Exception as e:
+            print(f"Error inserting maintenance job batch (items {chunk_start}-{chunk_start + len(chunk) - 1}): {e}")
+            traceback.print_exc()
+            outcomes.extend((None, f"Batch commit failed: {e}") for _ in rows)
+            continue
+        outcomes.extend((row[0], None) for row in rows)
+        committed_any = True
+        for row in rows:
+            _after_commit(change_feed.publish, "MaintenanceJob", {"job_id": row[0]}, mod_type="INSERT",
+                          values={"equipment_id": row[1], "job_date": row[2], "job_description": row[3], "cost": row[4],
+                                  "service_type": row[5]})
+        _after_commit(fleet_summary.on_maintenance_jobs_added, [(row[0], row[1], row[4], row[2]) for row in rows])
+    if committed_any:
+        _after_commit(notify_write, "MaintenanceJob")
+    return outcomes
 
 def add_equipment_db(data):
+    db = get_database()
     if not db: raise ConnectionError("DB not init.")
     equipment_id = str(uuid.uuid4())
     list_price = float(data.get("list_price", 0.0)) if data.get("list_price") is not None else None
@@ -345,11 +550,25 @@ def add_equipment_db(data):
         )
     try:
         db.run_in_transaction(_insert_equipment)
-        return equipment_id
     except Exception as e:
         print(f"Error inserting equipment (serial: {data.get('serial_number')}): {e}")
         traceback.print_exc()
         return None
+    _after_commit(serial_resolver.remember, data["serial_number"], equipment_id)
+    _after_commit(notify_write, "Equipment")
+    _after_commit(change_feed.publish, "Equipment", {"equipment_id": equipment_id}, mod_type="INSERT",
+                  values={"serial_number": data["serial_number"], "category": data["category"], "make": data["make"],
+                          "model": data["model"], "current_city": data.get("current_city"),
+                          "latitude": latitude, "longitude": longitude,
+                          "current_service_location_id": data.get("current_service_location_id"),
+                          "current_customer_id": data.get("current_customer_id")})
+    _after_commit(fleet_summary.on_equipment_added, equipment_id, category=data["category"], make=data["make"],
+                  city=data.get("current_city"), location_id=data.get("current_service_location_id"),
+                  customer_id=data.get("current_customer_id"))
+    _after_commit(spatial_index.put, equipment_id, data["category"], make=data["make"], latitude=latitude, longitude=longitude,
+                  city=data.get("current_city"))
+    _after_commit(availability_index.add_unit, equipment_id, data["category"], make=data["make"])
+    return equipment_id
 
 # --- Custom Jinja Filter ---
 @app.template_filter('humanize_datetime')
@@ -381,32 +600,45 @@ def _jinja2_filter_humanize_datetime(value, default="just now"):
 
 # --- FleetPro Routes ---
 @app.route('/')
+@with_read_consistency(STALE_READ_CONSISTENCY)
 def home():
     all_equipment = []
+    next_cursor = None
+    cursor = request.args.get('cursor')
+    page_size = clamp_page_size(request.args.get('page_size'), default=100)
     current_time = datetime.utcnow() # For footer year
+    db = get_database()
     if not db:
         flash("Database connection not available. Cannot load equipment data.", "danger")
     else:
         try:
-            all_equipment = get_all_equipment_db(limit=100)
+            page = get_all_equipment_db(limit=page_size, cursor=cursor)
+            if page:
+                all_equipment, next_cursor = page["items"], page["next_cursor"]
+        except ValueError as ve:
+            flash(f"{ve} Showing the first page instead.", "warning")
+            return redirect(url_for('home', page_size=page_size))
         except Exception as e:
              flash(f"Failed to load equipment data: {e}", "danger")
              print(f"Error in home route: {e}")
              traceback.print_exc()
-    return render_template('fleet_index.html', equipment_list=all_equipment, title="Fleet Overview", now=current_time)
+    return render_template('fleet_index.html', equipment_list=all_equipment, next_cursor=next_cursor, is_first_page=not cursor, page_size=page_size, title="Fleet Overview", now=current_time)
 
 @app.route('/equipment/<string:equipment_id>')
 def equipment_detail(equipment_id):
     equipment = None
     maintenance_jobs = []
     current_time = datetime.utcnow()
+    db = get_database()
     if not db:
         flash("Database connection not available.", "danger")
         abort(503)
+    etag, not_modified = _not_modified_or_none(get_detail_version_db(_equipment_version_query(equipment_id)), "html")
+    if not_modified: return not_modified
     try:
-        equipment = get_equipment_details_db(equipment_id)
+        equipment, maintenance_jobs = get_equipment_page_db(equipment_id)
         if not equipment: abort(404)
-        maintenance_jobs = get_maintenance_jobs_for_equipment_db(equipment_id)
+        maintenance_jobs = maintenance_jobs or []
         if equipment.get("latitude") is not None: equipment["latitude"] = float(equipment["latitude"])
         if equipment.get("longitude") is not None: equipment["longitude"] = float(equipment["longitude"])
     except Exception as e:
@@ -414,67 +646,233 @@ def equipment_detail(equipment_id):
         print(f"Error loading equipment {equipment_id}: {e}")
         traceback.print_exc()
         return render_template('equipment_detail.html', equipment=None, maintenance_jobs=[], error=True, Maps_api_key=Maps_API_KEY, title="Equipment Error", now=current_time)
-    return render_template('equipment_detail.html', equipment=equipment, maintenance_jobs=maintenance_jobs, Maps_api_key=Maps_API_KEY, title=f"Equipment: {equipment.get('make','')} {equipment.get('model','')}", now=current_time)
+    return _with_etag(render_template('equipment_detail.html', equipment=equipment, maintenance_jobs=maintenance_jobs, Maps_api_key=Maps_API_KEY, title=f"Equipment: {equipment.get('make','')} {equipment.get('model','')}", now=current_time), etag)
 
 @app.route('/customer/<string:customer_id>')
 def customer_detail(customer_id):
     customer = None
     assigned_equipment = []
     current_time = datetime.utcnow()
+    db = get_database()
     if not db:
         flash("Database connection not available.", "danger")
         abort(503)
+    etag, not_modified = _not_modified_or_none(get_detail_version_db(_customer_version_query(customer_id)), "html")
+    if not_modified: return not_modified
     try:
-        customer = get_customer_details_db(customer_id)
+        customer, assigned_equipment = get_customer_page_db(customer_id)
         if not customer: abort(404)
-        assigned_equipment = get_equipment_for_customer_db(customer_id)
+        assigned_equipment = assigned_equipment or []
     except Exception as e:
         flash(f"Failed to load customer details: {e}", "danger")
         return render_template('customer_detail.html', customer=None, assigned_equipment=[], error=True, title="Customer Error", now=current_time)
-    return render_template('customer_detail.html', customer=customer, assigned_equipment=assigned_equipment, title=f"Customer: {customer.get('customer_name','')}", now=current_time)
+    return _with_etag(render_template('customer_detail.html', customer=customer, assigned_equipment=assigned_equipment, title=f"Customer: {customer.get('customer_name','')}", now=current_time), etag)
 
 @app.route('/location/<string:location_id>')
 def service_location_detail(location_id):
     location = None
     equipment_at_location = []
     current_time = datetime.utcnow()
+    db = get_database()
     if not db:
         flash("Database connection not available.", "danger")
         abort(503)
+    etag, not_modified = _not_modified_or_none(get_detail_version_db(_service_location_version_query(location_id)), "html")
+    if not_modified: return not_modified
     try:
-        location = get_service_location_details_db(location_id)
+        location, equipment_at_location = get_service_location_page_db(location_id)
         if not location: abort(404)
-        equipment_at_location = get_equipment_at_service_location_db(location_id)
+        equipment_at_location = equipment_at_location or []
         if location.get("latitude") is not None: location["latitude"] = float(location["latitude"])
         if location.get("longitude") is not None: location["longitude"] = float(location["longitude"])
     except Exception as e:
         flash(f"Failed to load service location details: {e}", "danger")
         return render_template('location_detail.html', location=None, equipment_at_location=[], error=True, Maps_api_key=Maps_API_KEY, title="Location Error", now=current_time)
-    return render_template('location_detail.html', location=location, equipment_at_location=equipment_at_location, Maps_api_key=Maps_API_KEY, title=f"Location: {location.get('name', '')}", now=current_time)
+    return _with_etag(render_template('location_detail.html', location=location, equipment_at_location=equipment_at_location, Maps_api_key=Maps_API_KEY, title=f"Location: {location.get('name', '')}", now=current_time), etag)
 
 @app.route('/customers')
+@with_read_consistency(STALE_READ_CONSISTENCY)
 def customers_list():
     all_customers = []
+    next_cursor = None
+    cursor = request.args.get('cursor')
+    page_size = clamp_page_size(request.args.get('page_size'), default=100)
     current_time = datetime.utcnow()
+    db = get_database()
     if not db: flash("Database not connected.", "danger")
     else:
-        try: all_customers = get_all_customers_db()
+        try:
+            page = get_all_customers_db(limit=page_size, cursor=cursor)
+            if page: all_customers, next_cursor = page["items"], page["next_cursor"]
+        except ValueError as ve:
+            flash(f"{ve} Showing the first page instead.", "warning")
+            return redirect(url_for('customers_list', page_size=page_size))
         except Exception as e: flash(f"Error fetching customers: {e}", "danger")
-    return render_template('customers_list.html', customers=all_customers, title="All Customers", now=current_time)
+    return render_template('customers_list.html', customers=all_customers, next_cursor=next_cursor, is_first_page=not cursor, page_size=page_size, title="All Customers", now=current_time)
 
 @app.route('/locations')
+@with_read_consistency(STALE_READ_CONSISTENCY)
 def service_locations_list():
     all_locations = []
+    occupancy = {}
+    next_cursor = None
+    cursor = request.args.get('cursor')
+    page_size = clamp_page_size(request.args.get('page_size'), default=50)
     current_time = datetime.utcnow()
+    db = get_database()
     if not db: flash("Database not connected.", "danger")
     else:
-        try: all_locations = get_all_service_locations_db()
+        try:
+            page = get_all_service_locations_db(limit=page_size, cursor=cursor)
+            if page: all_locations, next_cursor = page["items"], page["next_cursor"]
+            occupancy = {row["location_id"]: row for row in fleet_summary.occupancy() or []}
+        except ValueError as ve:
+            flash(f"{ve} Showing the first page instead.", "warning")
+            return redirect(url_for('service_locations_list', page_size=page_size))
         except Exception as e: flash(f"Error fetching locations: {e}", "danger")
-    return render_template('locations_list.html', locations=all_locations, title="All Service Locations", now=current_time)
+    return render_template('locations_list.html', locations=all_locations, occupancy=occupancy, next_cursor=next_cursor, is_first_page=not cursor, page_size=page_size, title="All Service Locations", now=current_time)
 
 # --- FleetPro API Endpoints ---
+def _json_page_response(fetch_page, default_page_size):
+    """List APIs read with STALE_READ_CONSISTENCY unless the caller passes ?consistency=strong (or exact:N / max:N)."""
+    db = get_database()
+    if not db: return jsonify({"error": "Database connection unavailable"}), 503
+    page_size = clamp_page_size(request.args.get('page_size'), default=default_page_size)
+    try:
+        with read_consistency(request.args.get('consistency', STALE_READ_CONSISTENCY)):
+            page = fetch_page(limit=page_size, cursor=request.args.get('cursor'))
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    if page is None:
+        return jsonify({"error": "Failed to load page"}), 500
+    return jsonify(page), 200
+
+@app.route('/api/equipment', methods=['GET'])
+def list_equipment_api():
+    return _json_page_response(get_all_equipment_db, default_page_size=100)
+
+@app.route('/api/customers', methods=['GET'])
+def list_customers_api():
+    return _json_page_response(get_all_customers_db, default_page_size=100)
+
+@app.route('/api/locations', methods=['GET'])
+def list_service_locations_api():
+    return _json_page_response(get_all_service_locations_db, default_page_size=50)
+
+def _json_detail_response(version_query, fetch_page, record_key, related_key):
+    if not get_database(): return jsonify({"error": "Database connection unavailable"}), 503
+    etag, not_modified = _not_modified_or_none(get_detail_version_db(version_query), "json")
+    if not_modified: return not_modified
+    record, related = fetch_page()
+    if not record:
+        return jsonify({"error": f"{record_key.replace('_', ' ').capitalize()} not found"}), 404
+    return _with_etag(jsonify({record_key: record, related_key: related or []}), etag)
+
+@app.route('/api/equipment/<string:equipment_id>', methods=['GET'])
+def equipment_detail_api(equipment_id):
+    return _json_detail_response(_equipment_version_query(equipment_id), lambda: get_equipment_page_db(equipment_id),
+                                 "equipment", "maintenance_jobs")
+
+@app.route('/api/customers/<string:customer_id>', methods=['GET'])
+def customer_detail_api(customer_id):
+    return _json_detail_response(_customer_version_query(customer_id), lambda: get_customer_page_db(customer_id),
+                                 "customer", "assigned_equipment")
+
+@app.route('/api/locations/<string:location_id>', methods=['GET'])
+def service_location_detail_api(location_id):
+    return _json_detail_response(_service_location_version_query(location_id), lambda: get_service_location_page_db(location_id),
+                                 "location", "equipment_at_location")
+
+@app.route('/api/equipment/nearest', methods=['GET'])
+def nearest_equipment_api():
+    """k nearest units to ?lat=&lon= (or ?location=City), optionally filtered by category/make/max_km."""
+    if not spatial_index.loaded and not spatial_index.warm_load():
+        return jsonify({"error": "Spatial index unavailable"}), 503
+    try:
+        if request.args.get('lat') is not None or request.args.get('lon') is not None:
+            point = float(request.args['lat']), float(request.args['lon'])
+        else:
+            point = spatial_index.locate(request.args.get('location'))
+        max_km = float(request.args['max_km']) if request.args.get('max_km') else None
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat and lon must both be numbers"}), 400
+    if point is None:
+        return jsonify({"error": "Provide lat and lon, or a known location"}), 400
+    k = clamp_page_size(request.args.get('k'), default=5)
+    units = spatial_index.nearest(point[0], point[1], k=k, category=request.args.get('category') or None,
+                                  make=request.args.get('make') or None, max_km=max_km)
+    return jsonify({"latitude": point[0], "longitude": point[1], "equipment": units}), 200
+
+@app.route('/api/geocode', methods=['GET'])
+def geocode_api():
+    """Resolves ?q= (city/state, postal code, yard name or "lat, lon") with the offline geocoder."""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "Missing required parameter: q"}), 400
+    place = geocoder.geocode(query)
+    if place is None:
+        return jsonify({"error": f"Location '{query}' not recognized"}), 404
+    return jsonify(place), 200
+
+# --- Fleet Summary ---
+@app.route('/api/fleet/summary', methods=['GET'])
+def fleet_summary_api():
+    if not get_database(): return jsonify({"error": "Database connection unavailable"}), 503
+    top_n = clamp_page_size(request.args.get('top'), default=25)
+    summary = fleet_summary.summary(top_n=top_n)
+    if summary is None:
+        return jsonify({"error": "Fleet summary is not available"}), 500
+    return jsonify(summary), 200
+
+@app.route('/api/locations/occupancy', methods=['GET'])
+def service_location_occupancy_api():
+    """Units vs. capacity per service location, fullest first. ?over_capacity=true keeps only full yards."""
+    if not get_database(): return jsonify({"error": "Database connection unavailable"}), 503
+    occupancy = fleet_summary.occupancy()
+    if occupancy is None:
+        return jsonify({"error": "Occupancy is not available yet"}), 503
+    if request.args.get('over_capacity', 'false').lower() == 'true':
+        occupancy = [row for row in occupancy if row["over_capacity"]]
+    return jsonify({"locations": occupancy}), 200
+
+# --- Reliability Metrics ---
+@app.route('/api/reliability/models', methods=['GET'])
+def model_reliability_api():
+    """Batch-computed reliability per make/model, worst repair ratio first. ?make= narrows to one make."""
+    if not get_database(): return jsonify({"error": "Database connection unavailable"}), 503
+    models = reliability_metrics.get_model_reliability(request.args.get('make') or None)
+    if models is None:
+        return jsonify({"error": "Reliability metrics are not available"}), 500
+    return jsonify({"models": models}), 200
+
+@app.route('/admin/reliability/recompute', methods=['POST'])
+def recompute_reliability_api():
+    """Runs the reliability batch job in this worker; meant for a scheduler, not for page loads."""
+    try:
+        summary = reliability_metrics.recompute()
+    except ConnectionError:
+        return jsonify({"error": "Database connection unavailable"}), 503
+    if summary is None:
+        return jsonify({"error": "Reliability recompute failed"}), 500
+    notify_write("EquipmentReliability")
+    notify_write("ModelReliability")
+    return jsonify(summary), 200
+
+@app.route('/fleet/summary')
+def fleet_summary_page():
+    current_time = datetime.utcnow()
+    summary = None
+    if not get_database():
+        flash("Database connection not available. Cannot load the fleet summary.", "danger")
+    else:
+        summary = fleet_summary.summary()
+        if summary is None:
+            flash("Failed to build the fleet summary.", "danger")
+    return render_template('fleet_summary.html', summary=summary, title="Fleet Summary", now=current_time)
+
 @app.route('/api/maintenance-requests', methods=['POST'])
 def add_maintenance_job_api():
+    db = get_database()
     if not db: return jsonify({"error": "Database connection unavailable"}), 503
     data = request.get_json()
     if not data: return jsonify({"error": "Invalid JSON payload"}), 400
@@ -495,15 +893,70 @@ def add_maintenance_job_api():
     else:
         return jsonify({"error": "Failed to save maintenance job"}), 500
 
+MAINTENANCE_BATCH_MAX_ITEMS = int(os.environ.get("MAINTENANCE_BATCH_MAX_ITEMS", "10000"))
+
+@app.route('/api/maintenance-requests/batch', methods=['POST'])
+def add_maintenance_jobs_batch_api():
+    db = get_database()
+    if not db: return jsonify({"error": "Database connection unavailable"}), 503
+    data = request.get_json(silent=True)
+    items = data.get("requests") if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Expected a non-empty JSON list of maintenance requests (or {\"requests\": [...]})"}), 400
+    if len(items) > MAINTENANCE_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many requests in one batch ({len(items)}); the limit is {MAINTENANCE_BATCH_MAX_ITEMS}."}), 413
+
+    required_fields = ["equipment_serial_number", "job_description", "service_type"]
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not all(field in item and item[field] for field in required_fields):
+            results[index] = {"index": index, "status": "error", "error": f"Missing or empty required fields: {', '.join(required_fields)}"}
+            continue
+        try:
+            cost = float(item.get("cost", 0.0) or 0.0)
+        except (TypeError, ValueError):
+            results[index] = {"index": index, "status": "error", "error": "Invalid cost value. Must be a number."}
+            continue
+        valid.append((index, item, cost))
+
+    serial_map = resolve_serial_numbers_db(item["equipment_serial_number"] for _, item, _ in valid)
+    if serial_map is None:
+        return jsonify({"error": "Failed to resolve equipment serial numbers"}), 500
+
+    jobs, job_indexes = [], []
+    for index, item, cost in valid:
+        equipment_id = serial_map.get(item["equipment_serial_number"])
+        if not equipment_id:
+            results[index] = {"index": index, "status": "error", "error": f"Equipment with serial number '{item['equipment_serial_number']}' not found"}
+            continue
+        jobs.append({
+            "equipment_id": equipment_id, "job_description": item["job_description"],
+            "cost": cost, "service_type": item["service_type"], "job_date": item.get("job_date"),
+        })
+        job_indexes.append(index)
+
+    for index, (job_id, error) in zip(job_indexes, add_maintenance_jobs_batch_db(jobs)):
+        if job_id:
+            results[index] = {"index": index, "status": "created", "job_id": job_id}
+        else:
+            results[index] = {"index": index, "status": "error", "error": error}
+
+    created = sum(1 for r in results if r["status"] == "created")
+    summary = {"received": len(items), "created": created, "failed": len(items) - created}
+    return jsonify({"summary": summary, "results": results}), 201 if created == len(items) else 207
+
 @app.route('/api/equipment', methods=['POST'])
 def add_equipment_api():
+    db = get_database()
     if not db: return jsonify({"error": "Database connection unavailable"}), 503
     data = request.get_json()
     if not data: return jsonify({"error": "Invalid JSON payload"}), 400
     required_fields = ["serial_number", "description", "category", "make", "model"]
     if not all(field in data and data[field] for field in required_fields):
         return jsonify({"error": f"Missing or empty required fields: {', '.join(required_fields)}"}), 400
-    existing_equipment_id = get_equipment_by_serial_number_db(data["serial_number"])
+    # Don't trust a cached "unknown serial" here: another instance may have just added it.
+    existing_equipment_id = get_equipment_by_serial_number_db(data["serial_number"], trust_negative=False)
     if existing_equipment_id:
         return jsonify({"error": f"Equipment with serial number '{data['serial_number']}' already exists."}), 409
 
@@ -513,6 +966,102 @@ def add_equipment_api():
     else:
         return jsonify({"error": "Failed to save equipment"}), 500
 
+# --- Change Feed ---
+def _apply_change_event(event):
+    """
+    Applies a committed row change (from any worker or tool) to this process's caches and
+    indexes. Every step is idempotent: a worker also applies its own writes directly, and
+    the feed may deliver an event more than once. fleet_summary and the graph engine
+    subscribe to the feed themselves.
+    """
+    table, mod_type, values = event["table"], event["mod_type"], event["values"]
+    notify_write(table, columns=event["columns"] if mod_type == "UPDATE" else None)
+    if table == "Equipment":
+        equipment_id = event["keys"].get("equipment_id")
+        if mod_type == "INSERT" and values.get("category"):
+            if values.get("serial_number"):
+                serial_resolver.remember(values["serial_number"], equipment_id)
+            spatial_index.put(equipment_id, values["category"], make=values.get("make"), latitude=values.get("latitude"),
+                              longitude=values.get("longitude"), city=values.get("current_city"))
+            availability_index.add_unit(equipment_id, values["category"], make=values.get("make"))
+        elif mod_type == "UPDATE":
+            spatial_index.move(equipment_id, **{field: values[column] for field, column in
+                                                (("latitude", "latitude"), ("longitude", "longitude"), ("city", "current_city")) if column in values})
+    elif table == "CustomerEquipmentAssignment":
+        assignment_id = event["keys"].get("assignment_id")
+        if mod_type == "DELETE":
+            availability_index.remove_assignment(assignment_id)
+        elif values.get("equipment_id"):
+            availability_index.put_assignment(assignment_id, values["equipment_id"],
+                                              values.get("assignment_start_date"), values.get("assignment_end_date"))
+
+change_feed.subscribe(_apply_change_event)
+
+# --- Worker Warm-up / Health ---
+def warm_up_worker():
+    """
+    Prepares this process to serve: connects, pre-creates the pooled sessions, runs a
+    trivial query and loads the serial map. Called before a worker accepts traffic
+    (gunicorn.conf.py, the ASGI lifespan, or __main__).
+
+    Returns:
+        bool: True if the worker is ready.
+    """
+    if not get_database() or not warm_up():
+        return False
+    # Start before the loads: the feed reports every commit after this point, and each
+    # index replays the writes it is told about while its load runs. Started after them,
+    # commits made by other workers in between would be missed until the next reload.
+    change_feed.start()
+    if not serial_resolver.loaded:
+        serial_resolver.warm_load()
+    if not geocoder.locations_loaded:
+        geocoder.load_service_locations()
+    if not spatial_index.loaded:
+        spatial_index.warm_load()
+    if not availability_index.loaded:
+        availability_index.warm_load()
+    # Build the fleet summary off the startup path; /fleet/summary waits for it, occupancy reads don't.
+    fleet_summary.build_in_background()
+    return True
+
+@app.route('/healthz/live', methods=['GET'])
+def liveness():
+    return jsonify({"status": "alive"}), 200
+
+@app.route('/healthz/ready', methods=['GET'])
+def readiness():
+    """200 only once this worker's pool is warm; a worker whose warm-up failed retries it here."""
+    if is_warm() or warm_up_worker():
+        return jsonify({"status": "ready", "pid": os.getpid()}), 200
+    return jsonify({"status": "warming", "pid": os.getpid()}), 503
+
+@app.before_request
+def tag_queries_with_route():
+    # Queries issued while serving this request are attributed to its endpoint in query_stats.
+    query_stats.set_route(request.endpoint or request.path)
+
+@app.route('/debug/queries', methods=['GET'])
+def debug_query_stats():
+    """Per-query-name latency percentiles, row/byte totals, calling routes and PROFILE samples."""
+    include_profiles = request.args.get('profiles', 'true').lower() != 'false'
+    return jsonify(query_stats.snapshot(include_profiles=include_profiles)), 200
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(query_stats.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/cache', methods=['GET'])
+def debug_cache_stats():
+    stats = cache_stats()
+    stats["serial_resolver"] = serial_resolver.stats()
+    stats["fleet_summary"] = fleet_summary.stats()
+    stats["spatial_index"] = spatial_index.stats()
+    stats["geocoder"] = geocoder.stats()
+    stats["availability_index"] = availability_index.stats()
+    stats["change_feed"] = change_feed.stats()
+    return jsonify(stats), 200
+
 # --- Error Handlers ---
 @app.errorhandler(404)
 def page_not_found(e):
@@ -538,6 +1087,7 @@ def inject_now():
 
 @app.route('/api/equipment/<string:equipment_id>/location', methods=['POST'])
 def api_update_equipment_location(equipment_id):
+    db = get_database()
     if not db:
         current_app.logger.error("API Update Location: Database connection not available.")
         return jsonify({"error": "Database connection not available"}), 503
@@ -549,13 +1099,14 @@ def api_update_equipment_location(equipment_id):
 
     new_city = data.get('new_city')
     new_address = data.get('new_address')
+    service_location_id = data.get('service_location_id') # Optional: the unit arrived at (or left, with "") a yard
     latitude = data.get('latitude')
     longitude = data.get('longitude')
     notes = data.get('notes', '') # Optional notes
 
-    if not new_city and not new_address: # At least city or address should be provided
-        current_app.logger.error(f"API Update Location for {equipment_id}: Missing new_city or new_address.")
-        return jsonify({"error": "Missing required location fields: new_city or new_address"}), 400
+    if not new_city and not new_address and service_location_id is None: # At least city, address or yard should be provided
+        current_app.logger.error(f"API Update Location for {equipment_id}: Missing new_city, new_address or service_location_id.")
+        return jsonify({"error": "Missing required location fields: new_city, new_address or service_location_id"}), 400
 
     # Validate latitude and longitude if provided
     if latitude is not None:
@@ -590,10 +1141,12 @@ def api_update_equipment_location(equipment_id):
             if new_address is not None: update_data['current_address'] = new_address
             if latitude is not None: update_data['latitude'] = latitude
             if longitude is not None: update_data['longitude'] = longitude
+            if service_location_id is not None: update_data['current_service_location_id'] = service_location_id or None
             # Could add a field for 'location_update_notes' or append to description if desired
 
             if not update_data: # Should not happen due to earlier check, but as a safeguard
                  return True # No actual update needed, but not an error
+            update_data['last_update_time'] = spanner.COMMIT_TIMESTAMP # Versions the detail pages (ETag)
 
             columns_to_update = list(update_data.keys())
             values_to_update = list(update_data.values())
@@ -614,14 +1167,185 @@ def api_update_equipment_location(equipment_id):
         if not success:
             current_app.logger.warning(f"API Update Location: Equipment ID '{equipment_id}' not found.")
             return jsonify({"error": f"Equipment ID '{equipment_id}' not found"}), 404
-        
-        current_app.logger.info(f"Successfully updated location for equipment {equipment_id} via API.")
-        return jsonify({"message": f"Location for equipment {equipment_id} updated successfully."}), 200
-
     except Exception as e:
         current_app.logger.error(f"Error updating equipment location via API for {equipment_id}: {e}", exc_info=True)
         return jsonify({"error": f"Failed to update equipment location: {str(e)}"}), 500
 
+    _after_commit(notify_write, "Equipment", columns=["current_city", "current_address", "latitude", "longitude", "current_service_location_id"])
+    _after_commit(change_feed.publish, "Equipment", {"equipment_id": equipment_id}, mod_type="UPDATE",
+                  values={column: value for column, value in
+                          (("current_city", new_city), ("current_address", new_address), ("latitude", latitude),
+                           ("longitude", longitude), ("current_service_location_id", service_location_id))
+                          if value is not None})
+    if new_city is not None: _after_commit(fleet_summary.on_equipment_moved, equipment_id, city=new_city)
+    if service_location_id is not None: _after_commit(fleet_summary.on_equipment_moved, equipment_id, location_id=service_location_id or None)
+    _after_commit(spatial_index.move, equipment_id, **{field: value for field, value in
+                                                       (("latitude", latitude), ("longitude", longitude), ("city", new_city)) if value is not None})
+    current_app.logger.info(f"Successfully updated location for equipment {equipment_id} via API.")
+    return jsonify({"message": f"Location for equipment {equipment_id} updated successfully."}), 200
+
+# --- Equipment Availability ---
+def _parse_utc_datetime(value):
+    """ISO 8601 string -> aware datetime (naive is read as UTC); empty -> None. Raises ValueError."""
+    if not value:
+        return None
+    parsed = dateutil_parser.isoparse(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+@app.route('/api/equipment/available', methods=['GET'])
+def available_equipment_api():
+    """
+    Units free for a date range: ?start=&end= (ISO 8601) or ?job_date=&duration_days=,
+    optionally narrowed with ?category= and ?make=.
+    """
+    if not availability_index.loaded and availability_index.warm_load() is None:
+        return jsonify({"error": "Availability index unavailable"}), 503
+    if request.args.get('start'):
+        try:
+            start, end = _parse_utc_datetime(request.args['start']), _parse_utc_datetime(request.args.get('end'))
+        except (ValueError, TypeError):
+            return jsonify({"error": "Invalid start or end. Must be ISO 8601."}), 400
+        if end is not None and end <= start:
+            return jsonify({"error": "end must be after start"}), 400
+    else:
+        start, end = job_window(request.args.get('job_date'), request.args.get('duration_days', type=int, default=1))
+    free = availability_index.free_units(start, end, category=request.args.get('category') or None,
+                                         make=request.args.get('make') or None)
+    return jsonify({"start": start.isoformat(), "end": end.isoformat() if end else None,
+                    "count": len(free), "equipment_ids": sorted(free)}), 200
+
+@app.route('/api/equipment/<string:equipment_id>/assignments', methods=['POST'])
+def add_equipment_assignment_api(equipment_id):
+    """Assigns a unit to a customer for a date range, rejecting overlaps with existing assignments (409)."""
+    db = get_database()
+    if not db: return jsonify({"error": "Database connection unavailable"}), 503
+    data = request.get_json()
+    if not data: return jsonify({"error": "Invalid JSON payload"}), 400
+    if not data.get("customer_id") or not data.get("start_date"):
+        return jsonify({"error": "Missing required fields: customer_id, start_date"}), 400
+    try:
+        start, end = _parse_utc_datetime(data["start_date"]), _parse_utc_datetime(data.get("end_date"))
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid start_date or end_date. Must be ISO 8601."}), 400
+    if end is not None and end <= start:
+        return jsonify({"error": "end_date must be after start_date"}), 400
+    # Cheap pre-check against the in-memory index; the transaction below re-checks strongly.
+    if availability_index.loaded and not availability_index.is_free(equipment_id, start, end):
+        return jsonify({"error": f"Equipment '{equipment_id}' is already assigned during that period"}), 409
+
+    assignment_id = str(uuid.uuid4())
+    def _insert_assignment(transaction):
+        found = list(transaction.execute_sql(
+            """
+            SELECT
+                (SELECT COUNT(*) FROM Equipment WHERE equipment_id = @equipment_id) AS equipment_count,
+                (SELECT COUNT(*) FROM Customer WHERE customer_id = @customer_id) AS customer_count,
+                (SELECT COUNT(*) FROM CustomerEquipmentAssignment
+                 WHERE equipment_id = @equipment_id
+                   AND (assignment_start_date IS NULL OR @end IS NULL OR assignment_start_date < @end)
+                   AND (assignment_end_date IS NULL OR assignment_end_date > @start)) AS overlapping
+            """,
+            params={"equipment_id": equipment_id, "customer_id": data["customer_id"], "start": start, "end": end},
+            param_types={"equipment_id": param_types.STRING, "customer_id": param_types.STRING,
+                         "start": param_types.TIMESTAMP, "end": param_types.TIMESTAMP},
+        ))
+        equipment_count, customer_count, overlapping = found[0]
+        if not equipment_count: return "equipment_not_found"
+        if not customer_count: return "customer_not_found"
+        if overlapping: return "conflict"
+        transaction.insert(
+            table="CustomerEquipmentAssignment",
+            columns=["assignment_id", "customer_id", "equipment_id", "assignment_start_date", "assignment_end_date",
+                     "assignment_type", "create_time"],
+            values=[(assignment_id, data["customer_id"], equipment_id, start, end, data.get("assignment_type", "Rental"),
+                     spanner.COMMIT_TIMESTAMP)],
+        )
+        return "created"
+    try:
+        outcome = db.run_in_transaction(_insert_assignment)
+    except Exception as e:
+        current_app.logger.error(f"Error assigning equipment {equipment_id}: {e}", exc_info=True)
+        return jsonify({"error": f"Failed to create assignment: {str(e)}"}), 500
+    if outcome == "equipment_not_found":
+        return jsonify({"error": f"Equipment ID '{equipment_id}' not found"}), 404
+    if outcome == "customer_not_found":
+        return jsonify({"error": f"Customer ID '{data['customer_id']}' not found"}), 404
+    if outcome == "conflict":
+        return jsonify({"error": f"Equipment '{equipment_id}' is already assigned during that period"}), 409
+    _after_commit(notify_write, "CustomerEquipmentAssignment")
+    _after_commit(availability_index.put_assignment, assignment_id, equipment_id, start, end)
+    _after_commit(change_feed.publish, "CustomerEquipmentAssignment", {"assignment_id": assignment_id}, mod_type="INSERT",
+                  values={"customer_id": data["customer_id"], "equipment_id": equipment_id,
+                          "assignment_start_date": start, "assignment_end_date": end,
+                          "assignment_type": data.get("assignment_type", "Rental")})
+    return jsonify({"message": "Assignment created", "assignment_id": assignment_id}), 201
+
+def _summarize_ingested_locations(written):
+    for equipment_id, values in written.items():
+        if "current_city" in values:
+            fleet_summary.on_equipment_moved(equipment_id, city=values["current_city"])
+
+def _index_ingested_locations(written):
+    for equipment_id, values in written.items():
+        spatial_index.move(equipment_id, **{field: values[column] for field, column in
+                                            (("latitude", "latitude"), ("longitude", "longitude"), ("city", "current_city")) if column in values})
+
+add_flush_listener(_summarize_ingested_locations)
+add_flush_listener(_index_ingested_locations)
+
+LOCATION_BATCH_MAX_PINGS = int(os.environ.get("LOCATION_BATCH_MAX_PINGS", "20000"))
+LOCATION_INGEST_WAIT_SECONDS = float(os.environ.get("LOCATION_INGEST_WAIT_SECONDS", "15"))
+
+@app.route('/api/telematics/locations', methods=['POST'])
+def ingest_telematics_locations_api():
+    """
+    Accepts a batch of GPS pings: [{"equipment_id", "latitude", "longitude", "new_city"?,
+    "new_address"?, "timestamp"?}, ...] or {"pings": [...]}.
+
+    Pings are coalesced per unit with everything else arriving in the same flush window.
+    By default the response waits for that flush and reports per-ping results; with
+    ?wait=false it returns 202 as soon as the pings are queued.
+    """
+    if not get_database(): return jsonify({"error": "Database connection unavailable"}), 503
+    data = request.get_json(silent=True)
+    items = data.get("pings") if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Expected a non-empty JSON list of pings (or {\"pings\": [...]})"}), 400
+    if len(items) > LOCATION_BATCH_MAX_PINGS:
+        return jsonify({"error": f"Too many pings in one batch ({len(items)}); the limit is {LOCATION_BATCH_MAX_PINGS}."}), 413
+
+    results = [None] * len(items)
+    pings, ping_indexes = [], []
+    for index, item in enumerate(items):
+        ping, error = parse_ping(item)
+        if error:
+            results[index] = {"index": index, "status": "error", "error": error}
+            continue
+        pings.append(ping)
+        ping_indexes.append(index)
+    futures = location_buffer.submit(pings)
+
+    if request.args.get("wait", "true").lower() == "false":
+        for index in ping_indexes:
+            results[index] = {"index": index, "status": "queued"}
+        return jsonify({"queued": len(pings), "rejected": len(items) - len(pings), "results": results}), 202
+
+    # One deadline for the whole batch, however many flushes its pings landed in.
+    done, _ = futures_wait(futures, timeout=LOCATION_INGEST_WAIT_SECONDS)
+    for index, future in zip(ping_indexes, futures):
+        if future in done:
+            results[index] = {"index": index, **future.result()}
+        else:
+            results[index] = {"index": index, "status": "queued"}
+
+    updated = sum(1 for r in results if r["status"] == "updated")
+    status_code = 200 if updated == len(items) else 207
+    return jsonify({"updated": updated, "failed": sum(1 for r in results if r["status"] == "error"), "results": results}), status_code
+
+@app.route('/debug/location-ingest', methods=['GET'])
+def debug_location_ingest_stats():
+    return jsonify(location_buffer.stats()), 200
+
 
 if __name__ == '__main__':
     # For Cloud Run, honor the PORT environment variable.
@@ -630,10 +1354,12 @@ if __name__ == '__main__':
     # Debug mode should be False in production. Controlled by FLASK_DEBUG env var.
     debug_mode = os.environ.get("FLASK_DEBUG", "False").lower() == "true"
 
+    db = get_database()
     if not db:
         print("\n--- Cannot start Flask app: Spanner database connection failed. ---")
         print("--- Please check GCP_PROJECT_ID, Spanner instance/database IDs, permissions, and network. ---")
     else:
+        warm_up_worker() # Pre-create pooled sessions and load the serial map so the first requests don't pay for them
         print(f"\n--- Starting Rouse FleetPro Flask Server ---")
         print(f"Mode: {'Development (Debug)' if debug_mode else 'Production'}")
         print(f"Listening on: http://{APP_HOST}:{port}")
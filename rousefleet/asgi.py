@@ -0,0 +1,203 @@
+# asgi.py - ASGI serving mode for the Rouse FleetPro web app
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 8080
+#
+# The two advisor SSE endpoints are served natively on the event loop: the agent stream
+# is awaited (fleet_advisor_agent_logic.*_async), so a dispatcher watching a long
+# recommendation holds a coroutine instead of a server thread and one process can keep
+# hundreds of streams open. That holds when the Agent Engine client has
+# async_stream_query; without it each stream drains the sync stream on a thread, and
+# AGENT_STREAM_FALLBACK_THREADS (default 32) caps the streams progressing at once per
+# process. Every other route is the unchanged Flask app, run through uvicorn's
+# WSGIMiddleware on a pool of ASGI_WSGI_THREADS threads (default 8), so one slow request
+# (a telematics batch waiting for its flush, say) doesn't hold up the others. Size the
+# Spanner pool (SPANNER_POOL_SIZE_PER_WORKER) to at least that many sessions.
+#
+# Like the WSGI versions, these streams read the Flask session cookie but don't write it:
+# response headers (and so the cookie) are already sent by the time a stream ends. The
+# review page posts the recommendation back from the SSE payload instead.
+
+import asyncio
+import json
+import os
+import traceback
+import uuid
+
+from uvicorn.middleware.wsgi import WSGIMiddleware
+from werkzeug.test import EnvironBuilder
+
+from app import app as flask_app, warm_up_worker
+import query_stats
+from spanner_data import get_database, is_warm
+from fleet_advisor_agent_logic import call_dispatch_agent_for_recommendation_async, execute_dispatch_assignment_async
+
+ASGI_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", "8"))
+
+# Not asgiref's WsgiToAsgi: it runs every request on one thread_sensitive thread.
+_wsgi_application = WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)
+
+
+def _sse(event_type, data):
+    try:
+        payload = json.dumps(data)
+    except TypeError as te:
+        print(f"asgi: TypeError serializing data for event '{event_type}': {te}. Data: {data}")
+        payload = json.dumps({"error": "Data serialization issue", "original_type": str(type(data))})
+        event_type = "thought_error"
+    return f"event: {event_type}\ndata: {payload}\n\n".encode("utf-8")
+
+
+def _error_events(message, code, end_message):
+    return [
+        _sse("error", {"message": message, "code": code}),
+        _sse("stream_end", {"message": end_message}),
+    ]
+
+
+def _load_session(scope):
+    """Decodes the Flask session cookie for an ASGI request (read-only)."""
+    headers = [(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope.get("headers", [])]
+    environ = EnvironBuilder(path=scope["path"], headers=headers).get_environ()
+    request = flask_app.request_class(environ)
+    with flask_app.app_context():
+        return flask_app.session_interface.open_session(flask_app, request) or {}
+
+
+async def _recommendation_events(session):
+    dispatch_params = session.get('dispatch_request_params')
+    if not dispatch_params:
+        for chunk in _error_events("Missing dispatch parameters in session. Please submit the form again.", "NO_DISPATCH_PARAMS",
+                                   "Stream closed due to missing parameters."):
+            yield chunk
+        return
+    print(f"--- ADVISOR_SSE (asgi): recommendation stream started for job at {dispatch_params.get('job_location')} ---")
+    try:
+        async for event_data in call_dispatch_agent_for_recommendation_async(
+            job_date=dispatch_params['job_date'],
+            job_location=dispatch_params['job_location'],
+            equipment_category=dispatch_params['equipment_category'],
+            equipment_make=dispatch_params.get('equipment_make'),
+            duration_days=dispatch_params['duration_days'],
+            notes=dispatch_params.get('notes'),
+            requestor_name=dispatch_params['requestor_name']
+        ):
+            yield _sse(event_data.get("type", "thought"), event_data.get("data"))
+        yield _sse("stream_end", {"message": "Recommendation stream finished."})
+    except Exception as e:
+        error_details_str = traceback.format_exc()
+        print(f"!!! ADVISOR_SSE (asgi): UNHANDLED EXCEPTION during recommendation stream: {e}\n{error_details_str}")
+        yield _sse("error", {"message": f"Server error during recommendation generation: {str(e)}",
+                             "code": "RECOMMENDATION_STREAM_UNHANDLED_CRASH", "raw_output": error_details_str})
+        yield _sse("stream_end", {"message": "Stream ended due to server error."})
+
+
+async def _post_status_events(session):
+    execution_params = session.get('dispatch_execution_params')
+    if not execution_params:
+        for chunk in _error_events("Missing dispatch execution parameters in session. Please start over.", "NO_EXEC_PARAMS",
+                                   "Stream closed due to missing execution parameters."):
+            yield chunk
+        return
+    equipment_id = execution_params.get("equipment_id")
+    job_details = execution_params.get("job_details", {})
+    if not equipment_id or not job_details:
+        for chunk in _error_events("Essential data (equipment_id or job_details) missing for dispatch execution.", "BAD_EXEC_DATA",
+                                   "Stream closed due to incomplete execution data."):
+            yield chunk
+        return
+    try:
+        async for event in execute_dispatch_assignment_async(
+            execution_params.get("user_name", "Dispatch User"), equipment_id,
+            execution_params.get("equipment_details", {}), job_details,
+            execution_params.get("agent_session_user_id", str(uuid.uuid4())),
+        ):
+            if not isinstance(event, dict) or 'type' not in event or 'data' not in event:
+                yield _sse("thought", f"Agent (execute) produced a malformed event: {str(event)[:200]}")
+                continue
+            yield _sse(event['type'], event['data'])
+        yield _sse("stream_end", {"message": "Dispatch execution stream finished successfully."})
+    except Exception as e:
+        error_details_str = traceback.format_exc()
+        print(f"!!! ADVISOR_POST_SSE (asgi): UNHANDLED EXCEPTION in post-status stream: {e}\n{error_details_str}")
+        yield _sse("error", {"message": f"A critical server error occurred during dispatch execution: {str(e)}",
+                             "code": "EXECUTE_STREAM_UNHANDLED_CRASH", "raw_output": error_details_str})
+        yield _sse("stream_end", {"message": "Stream closed due to critical server error."})
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _serve_sse(scope, receive, send, make_events, db_unavailable_code, db_unavailable_message):
+    query_stats.set_route(scope["path"])
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                    (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")],
+    })
+
+    async def pump():
+        database_ok = await asyncio.to_thread(get_database)
+        if not database_ok:
+            events = _error_events(db_unavailable_message, db_unavailable_code, "Stream closed due to database unavailability.")
+            for chunk in events:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            return
+        session = await asyncio.to_thread(_load_session, scope)
+        async for chunk in make_events(session):
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+    # Stop consuming the agent stream as soon as the browser goes away.
+    pump_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({pump_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (pump_task, disconnect_task):
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(pump_task, disconnect_task, return_exceptions=True)
+    if pump_task.done() and not pump_task.cancelled() and pump_task.exception():
+        print(f"asgi: SSE stream for {scope['path']} failed: {pump_task.exception()}")
+    if not disconnect_task.done() or disconnect_task.cancelled():
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+SSE_ROUTES = {
+    "/dispatch-advisor/stream-recommendation": (
+        _recommendation_events, "STREAM_DB_UNAVAILABLE_RECOMMEND",
+        "Advisor service cannot connect to the database. Please try again later.",
+    ),
+    "/dispatch-advisor/stream-post-status": (
+        _post_status_events, "STREAM_POST_DB_UNAVAILABLE",
+        "Dispatch execution service cannot connect to database. Please try again later.",
+    ),
+}
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope.get("method") == "GET" and scope["path"] in SSE_ROUTES:
+        make_events, code, message = SSE_ROUTES[scope["path"]]
+        await _serve_sse(scope, receive, send, make_events, code, message)
+        return
+    if scope["type"] == "lifespan":
+        # Warm the Spanner pool and serial map before the server reports it is up.
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await asyncio.to_thread(_warm_up)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    await _wsgi_application(scope, receive, send)
+
+
+def _warm_up():
+    # Under gunicorn's post_worker_init the worker is already warm by the time lifespan starts.
+    if not is_warm() and not warm_up_worker():
+        print("asgi: Warning - Spanner warm-up failed; /healthz/ready will report 503 until it succeeds.")
@@ -0,0 +1,310 @@
+# availability_index.py - In-memory index of equipment bookings (CustomerEquipmentAssignment)
+#
+# Every open or future assignment is an interval [start, end) on its unit (a missing
+# start is -inf, a missing end is +inf). The intervals live in a static augmented
+# interval tree (sorted by start, each subtree annotated with its latest end), so
+# "which units are booked between A and B" is O(log n + hits) for the whole fleet, and
+# "which units of category X are free" is that set subtracted from the category's units.
+#
+# Writes made through this process are applied immediately: new or changed assignments
+# go to a small overflow list that every query also scans, and the tree is rebuilt
+# once the list passes AVAILABILITY_REBUILD_THRESHOLD. A full reload every
+# AVAILABILITY_RELOAD_SECONDS picks up assignments written by other workers and the agents.
+
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+
+from google.cloud.spanner_v1 import param_types
+
+from spanner_data import run_queries_batch
+
+RELOAD_SECONDS = float(os.environ.get("AVAILABILITY_RELOAD_SECONDS", "120"))
+REBUILD_THRESHOLD = int(os.environ.get("AVAILABILITY_REBUILD_THRESHOLD", "256"))
+
+_UNSET = object()
+
+
+def to_epoch(value, default):
+    """datetime (naive = UTC) -> epoch seconds; None -> default."""
+    if value is None:
+        return default
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+class _IntervalTree:
+    """
+    Immutable interval tree over (start, end, key) triples: an implicit balanced BST on
+    the start-sorted array where each node stores the maximum end of its subtree.
+    """
+
+    def __init__(self, intervals):
+        intervals = sorted(intervals, key=lambda item: item[0])
+        self.starts = [item[0] for item in intervals]
+        self.ends = [item[1] for item in intervals]
+        self.keys = [item[2] for item in intervals]
+        self.max_end = list(self.ends)
+        self._annotate(0, len(intervals))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _annotate(self, lo, hi):
+        # Iterative post-order so deep trees don't hit the recursion limit.
+        stack = [(lo, hi, False)]
+        while stack:
+            lo, hi, children_done = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            if not children_done:
+                stack.append((lo, hi, True))
+                stack.append((lo, mid, False))
+                stack.append((mid + 1, hi, False))
+                continue
+            best = self.ends[mid]
+            if lo < mid:
+                best = max(best, self.max_end[(lo + mid) // 2])
+            if mid + 1 < hi:
+                best = max(best, self.max_end[(mid + 1 + hi) // 2])
+            self.max_end[mid] = best
+
+    def overlapping(self, start, end):
+        """Keys of intervals with interval_start < end and interval_end > start."""
+        found = []
+        stack = [(0, len(self.keys))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            if self.max_end[mid] <= start:
+                continue  # nothing in this subtree ends after the window opens
+            stack.append((lo, mid))
+            if self.starts[mid] < end:
+                if self.ends[mid] > start:
+                    found.append(self.keys[mid])
+                stack.append((mid + 1, hi))
+        return found
+
+
+class AvailabilityIndex:
+    """
+    Thread-safe index of unit bookings with fleet-wide free/booked queries.
+
+    Args:
+        reload_seconds (float): Interval of the background full reload; 0 disables it.
+        rebuild_threshold (int): Overflow entries tolerated before the tree is rebuilt.
+    """
+
+    def __init__(self, reload_seconds=RELOAD_SECONDS, rebuild_threshold=REBUILD_THRESHOLD):
+        self.reload_seconds = reload_seconds
+        self.rebuild_threshold = max(1, rebuild_threshold)
+        self._assignments = {}   # assignment_id -> (equipment_id, start, end)
+        self._by_equipment = {}  # equipment_id -> set(assignment_id)
+        self._units = {}         # equipment_id -> (category, make)
+        self._by_category = {}   # category -> set(equipment_id)
+        self._tree = _IntervalTree([])
+        self._overflow = set()   # assignment_ids added or changed since the tree was built
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._writes_during_load = None  # list of callables while a load is in progress
+        self._reload_thread = None
+        self.loaded = False
+        self.loaded_at = None
+        self.rebuilds = 0
+        self.queries = 0
+
+    # --- Loading ---
+    def warm_load(self):
+        """
+        Loads every unit's category/make and every open or future assignment.
+
+        Returns:
+            int | None: Number of assignments loaded, or None if the load failed.
+        """
+        with self._load_lock:
+            return self._load()
+
+    def _load(self):
+        started = time.perf_counter()
+        with self._lock:
+            self._writes_during_load = []
+        queries = {
+            "units": {"sql": "SELECT equipment_id, category, make FROM Equipment",
+                      "expected_fields": ["equipment_id", "category", "make"]},
+            "assignments": {
+                "sql": """
+                    SELECT assignment_id, equipment_id, assignment_start_date, assignment_end_date
+                    FROM CustomerEquipmentAssignment
+                    WHERE assignment_end_date IS NULL OR assignment_end_date >= @now
+                """,
+                "params": {"now": datetime.now(timezone.utc)},
+                "param_types_map": {"now": param_types.TIMESTAMP},
+                "expected_fields": ["assignment_id", "equipment_id", "assignment_start_date", "assignment_end_date"],
+            },
+        }
+        try:
+            results = run_queries_batch(queries)
+        except Exception as e:
+            results = {}
+            print(f"availability_index: Load failed: {e}")
+        if results.get("units") is None or results.get("assignments") is None:
+            with self._lock:
+                self._writes_during_load = None
+            return None
+
+        units, by_category = {}, {}
+        for row in results["units"]:
+            units[row["equipment_id"]] = (row["category"], row["make"])
+            by_category.setdefault(row["category"], set()).add(row["equipment_id"])
+        assignments, by_equipment = {}, {}
+        for row in results["assignments"]:
+            assignments[row["assignment_id"]] = (row["equipment_id"], to_epoch(row["assignment_start_date"], float("-inf")),
+                                                 to_epoch(row["assignment_end_date"], float("inf")))
+            by_equipment.setdefault(row["equipment_id"], set()).add(row["assignment_id"])
+        tree = _IntervalTree((start, end, assignment_id) for assignment_id, (_, start, end) in assignments.items())
+
+        with self._lock:
+            pending, self._writes_during_load = self._writes_during_load, None
+            self._units, self._by_category = units, by_category
+            self._assignments, self._by_equipment = assignments, by_equipment
+            self._tree, self._overflow = tree, set()
+            # Writes applied while the snapshot was read may be missing from it; replay them.
+            for apply in pending:
+                apply()
+            self.loaded = True
+            self.loaded_at = time.time()
+        print(f"availability_index: Loaded {len(assignments)} assignments for {len(units)} units in "
+              f"{(time.perf_counter() - started) * 1000:.0f} ms.")
+        self._ensure_reloader()
+        return len(assignments)
+
+    def _ensure_reloader(self):
+        if self.reload_seconds <= 0 or (self._reload_thread is not None and self._reload_thread.is_alive()):
+            return
+        self._reload_thread = threading.Thread(target=self._reload_forever, name="availability-reload", daemon=True)
+        self._reload_thread.start()
+
+    def _reload_forever(self):
+        while True:
+            time.sleep(self.reload_seconds)
+            try:
+                self.warm_load()
+            except Exception as e:
+                print(f"availability_index: Reload failed: {e}")
+                traceback.print_exc()
+
+    # --- Write-path hooks (call after the commit succeeded) ---
+    def _apply(self, apply):
+        with self._lock:
+            apply()
+            if self._writes_during_load is not None:
+                self._writes_during_load.append(apply)
+
+    def add_unit(self, equipment_id, category, make=None):
+        def apply():
+            self._units[equipment_id] = (category, make)
+            self._by_category.setdefault(category, set()).add(equipment_id)
+        self._apply(apply)
+
+    def put_assignment(self, assignment_id, equipment_id, start=None, end=None):
+        """Records a new or changed assignment. start/end are datetimes (None = open)."""
+        interval = (equipment_id, to_epoch(start, float("-inf")), to_epoch(end, float("inf")))
+
+        def apply():
+            previous = self._assignments.get(assignment_id)
+            if previous is not None and previous[0] != equipment_id:
+                self._by_equipment.get(previous[0], set()).discard(assignment_id)
+            self._assignments[assignment_id] = interval
+            self._by_equipment.setdefault(equipment_id, set()).add(assignment_id)
+            self._overflow.add(assignment_id)
+            if len(self._overflow) > self.rebuild_threshold:
+                self._rebuild_locked()
+        self._apply(apply)
+
+    def remove_assignment(self, assignment_id):
+        def apply():
+            previous = self._assignments.pop(assignment_id, None)
+            if previous is not None:
+                self._by_equipment.get(previous[0], set()).discard(assignment_id)
+            self._overflow.discard(assignment_id)
+        self._apply(apply)
+
+    def _rebuild_locked(self):
+        self._tree = _IntervalTree((start, end, assignment_id) for assignment_id, (_, start, end) in self._assignments.items())
+        self._overflow = set()
+        self.rebuilds += 1
+
+    # --- Queries ---
+    def _booked_locked(self, start, end):
+        booked = {}
+        # Tree hits are re-checked against the current interval: it may have changed since the build.
+        for assignment_id in list(self._tree.overlapping(start, end)) + list(self._overflow):
+            interval = self._assignments.get(assignment_id)
+            if interval is not None and interval[1] < end and interval[2] > start:
+                booked.setdefault(interval[0], []).append(assignment_id)
+        return booked
+
+    def booked_units(self, start, end):
+        """
+        Units with an assignment overlapping [start, end).
+
+        Args:
+            start (datetime), end (datetime): The job window.
+
+        Returns:
+            dict: {equipment_id: [assignment_id, ...]}.
+        """
+        with self._lock:
+            self.queries += 1
+            return self._booked_locked(to_epoch(start, float("-inf")), to_epoch(end, float("inf")))
+
+    def free_units(self, start, end, category=None, make=_UNSET):
+        """
+        Units of a category (and make, if given) with no assignment overlapping [start, end).
+
+        Returns:
+            set[str]: Free equipment IDs (all categories when category is None).
+        """
+        with self._lock:
+            self.queries += 1
+            booked = self._booked_locked(to_epoch(start, float("-inf")), to_epoch(end, float("inf")))
+            if category is None:
+                candidates = set(self._units)
+            else:
+                candidates = set(self._by_category.get(category, ()))
+            if make is not _UNSET and make is not None:
+                candidates = {equipment_id for equipment_id in candidates if self._units[equipment_id][1] == make}
+            return candidates.difference(booked)
+
+    def is_free(self, equipment_id, start, end):
+        start, end = to_epoch(start, float("-inf")), to_epoch(end, float("inf"))
+        with self._lock:
+            for assignment_id in self._by_equipment.get(equipment_id, ()):
+                _, assigned_start, assigned_end = self._assignments[assignment_id]
+                if assigned_start < end and assigned_end > start:
+                    return False
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "loaded_at": self.loaded_at,
+                "units": len(self._units),
+                "assignments": len(self._assignments),
+                "tree_size": len(self._tree),
+                "overflow": len(self._overflow),
+                "rebuilds": self.rebuilds,
+                "queries": self.queries,
+                "reload_seconds": self.reload_seconds,
+            }
+
+
+# Process-wide index shared by every caller.
+availability_index = AvailabilityIndex()
@@ -0,0 +1,289 @@
+# candidate_ranking.py - Multi-factor ranking of dispatch candidates
+#
+# All units of the requested category (and make) are held as column arrays (a
+# "candidate pool", cached per category/make) and scored in one vectorized NumPy pass:
+#
+#   distance             great-circle km from the job site (skipped if the job can't be placed)
+#   meter_hours          relative to the highest-hour unit in the pool
+#   maintenance_recency  days since the unit's last maintenance job
+#   maintenance_spend    trailing maintenance spend
+#   yard_occupancy       sits in a service location that is over capacity (a plus)
+#
+# Each factor becomes a 0..1 score (1 = best) and the weighted mean is the unit's
+# score. Units already assigned during the job window (availability_index) are left
+# out entirely. The top k come back with the raw value and score of every factor, so
+# the dispatcher sees why a unit ranked where it did.
+#
+# The maintenance factors come from the batch EquipmentReliability table
+# (reliability_metrics.py), so they are as fresh as its last recompute; units it hasn't
+# covered yet score as having no maintenance history.
+#
+# Pools are invalidated by writes to the tables they come from, except the telematics
+# location columns: positions in a pool are at most RANKING_POOL_TTL_SECONDS old.
+#
+#   RANKING_POOL_TTL_SECONDS   lifetime of a cached pool (default 60)
+#   RANKING_WEIGHTS            e.g. "distance=0.35,meter_hours=0.2,..." (see DEFAULT_WEIGHTS)
+#   DISPATCH_TOP_K             candidates returned to the advisor (default 5)
+
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from google.cloud.spanner_v1 import param_types
+from dateutil import parser as dateutil_parser
+
+from spanner_data import run_queries_batch
+from read_cache import register_cache
+from spatial_index import EARTH_RADIUS_KM, spatial_index
+from fleet_summary import fleet_summary
+from availability_index import availability_index
+
+POOL_TTL_SECONDS = float(os.environ.get("RANKING_POOL_TTL_SECONDS", "60"))
+TOP_K = int(os.environ.get("DISPATCH_TOP_K", "5"))
+
+# Distances / maintenance gaps at which a factor's score has dropped to 0.5.
+DISTANCE_HALF_SCORE_KM = 250.0
+MAINTENANCE_HALF_SCORE_DAYS = 180.0
+
+FACTORS = ("distance", "meter_hours", "maintenance_recency", "maintenance_spend", "yard_occupancy")
+DEFAULT_WEIGHTS = "distance=0.4,meter_hours=0.25,maintenance_recency=0.15,maintenance_spend=0.15,yard_occupancy=0.05"
+
+UNIT_FIELDS = ["equipment_id", "serial_number", "make", "model", "model_year", "meter_hours", "description",
+               "current_city", "latitude", "longitude", "current_service_location_id"]
+
+candidate_pool_cache = register_cache(
+    "dispatch_candidate_pool",
+    max_entries=64,
+    ttl_seconds=POOL_TTL_SECONDS,
+    depends_on={
+        "Equipment": ("category", "make", "model", "model_year", "meter_hours", "serial_number", "description",
+                      "current_service_location_id"),
+        "EquipmentReliability": None,
+    },
+)
+
+
+def parse_weights(text, base=None):
+    """
+    Parses "factor=weight,..." into {factor: weight}. Factors not mentioned keep their
+    weight in base (0 without one); unknown factors raise ValueError.
+    """
+    weights = dict(base) if base else {factor: 0.0 for factor in FACTORS}
+    for item in (text or "").split(","):
+        if not item.strip():
+            continue
+        factor, _, weight = item.partition("=")
+        factor = factor.strip()
+        if factor not in weights:
+            raise ValueError(f"Unknown ranking factor '{factor}'. Expected one of {', '.join(FACTORS)}.")
+        weights[factor] = float(weight)
+    return weights
+
+
+WEIGHTS = parse_weights(os.environ.get("RANKING_WEIGHTS", DEFAULT_WEIGHTS))
+
+
+def _epoch(value):
+    return value.timestamp() if value is not None else np.nan
+
+
+class CandidatePool:
+    """Column arrays for every unit of one category/make."""
+
+    def __init__(self, units, maintenance):
+        self.rows = [{field: row[field] for field in UNIT_FIELDS if field not in ("latitude", "longitude")} for row in units]
+        self.ids = [row["equipment_id"] for row in units]
+        self.index = index = {equipment_id: i for i, equipment_id in enumerate(self.ids)}
+        n = len(units)
+
+        self.latitude = np.array([row["latitude"] if row["latitude"] is not None else np.nan for row in units], dtype=float)
+        self.longitude = np.array([row["longitude"] if row["longitude"] is not None else np.nan for row in units], dtype=float)
+        # Radians and cos(latitude) are fixed per pool; precomputed for the distance pass.
+        self._phi = np.radians(self.latitude)
+        self._cos_phi = np.cos(self._phi)
+        self._lambda = np.radians(self.longitude)
+        self.meter_hours = np.array([row["meter_hours"] if row["meter_hours"] is not None else np.nan for row in units], dtype=float)
+        # Service locations as small integer codes, so membership tests stay numeric.
+        self.location_codes, self._location_index = {}, []
+        for row in units:
+            self._location_index.append(self.location_codes.setdefault(row["current_service_location_id"], len(self.location_codes)))
+        self._location_index = np.array(self._location_index, dtype=np.int64)
+
+        self.last_maintenance = np.full(n, np.nan)
+        self.recent_spend = np.zeros(n)
+        for row in maintenance:
+            i = index.get(row["equipment_id"])
+            if i is not None:
+                self.last_maintenance[i] = _epoch(row["last_job_date"])
+                self.recent_spend[i] = row["trailing_spend"] or 0.0
+
+        self.loaded_at = time.time()
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def load_pool(equipment_category, equipment_make=None):
+    """
+    Reads every unit of a category (and make) with its reliability metrics, in one snapshot.
+
+    Returns:
+        CandidatePool | None: None if any of the queries failed.
+    """
+    filters = "e.category = @category AND (@make IS NULL OR e.make = @make)"
+    params = {"category": equipment_category, "make": equipment_make or None}
+    types = {"category": param_types.STRING, "make": param_types.STRING}
+    queries = {
+        "units": {
+            "sql": f"SELECT {', '.join('e.' + field for field in UNIT_FIELDS)} FROM Equipment e WHERE {filters}",
+            "params": params, "param_types_map": types, "expected_fields": UNIT_FIELDS,
+        },
+        "maintenance": {
+            "sql": f"""
+                SELECT r.equipment_id, r.last_job_date, r.trailing_spend
+                FROM Equipment e JOIN EquipmentReliability r ON r.equipment_id = e.equipment_id
+                WHERE {filters}
+            """,
+            "params": params, "param_types_map": types,
+            "expected_fields": ["equipment_id", "last_job_date", "trailing_spend"],
+        },
+    }
+    results = run_queries_batch(queries)
+    if any(results.get(name) is None for name in queries):
+        return None
+    return CandidatePool(results["units"], results["maintenance"])
+
+
+def _distances_km(pool, lat, lon):
+    phi = np.radians(lat)
+    a = np.sin((pool._phi - phi) / 2) ** 2 + np.cos(phi) * pool._cos_phi * np.sin((pool._lambda - np.radians(lon)) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def score_pool(pool, k, job_point=None, booked_ids=(), weights=None, over_capacity_ids=(), now=None):
+    """
+    Scores every unit in the pool and returns the best k.
+
+    Args:
+        pool (CandidatePool): Units to rank.
+        k (int): Number of candidates returned.
+        job_point ((float, float), optional): Job site coordinates; without it distance is ignored.
+        booked_ids (iterable[str]): Units assigned during the job window; they are not ranked.
+        weights (dict, optional): {factor: weight}; defaults to RANKING_WEIGHTS.
+        over_capacity_ids (iterable[str]): Service locations currently over capacity.
+
+    Returns:
+        list[dict]: Candidate rows, best first, each with "score" and a per-factor "factors" breakdown.
+    """
+    n = len(pool)
+    if n == 0 or k <= 0:
+        return []
+    weights = dict(weights or WEIGHTS)
+    now = now if now is not None else time.time()
+    values, scores = {}, {}
+
+    if job_point is not None:
+        distance = _distances_km(pool, job_point[0], job_point[1])
+        values["distance"] = distance
+        scores["distance"] = np.where(np.isnan(distance), 0.0, DISTANCE_HALF_SCORE_KM / (distance + DISTANCE_HALF_SCORE_KM))
+    else:
+        weights["distance"] = 0.0
+
+    hours = pool.meter_hours
+    max_hours = np.nanmax(hours) if not np.all(np.isnan(hours)) else 0.0
+    values["meter_hours"] = hours
+    scores["meter_hours"] = np.where(np.isnan(hours), 0.0, 1.0 - hours / max_hours) if max_hours > 0 else np.where(np.isnan(hours), 0.0, 1.0)
+
+    days = (now - pool.last_maintenance) / 86400.0
+    values["maintenance_recency"] = days
+    scores["maintenance_recency"] = np.where(np.isnan(days), 0.5, MAINTENANCE_HALF_SCORE_DAYS / (np.maximum(days, 0) + MAINTENANCE_HALF_SCORE_DAYS))
+
+    spend = pool.recent_spend
+    max_spend = spend.max()
+    values["maintenance_spend"] = spend
+    scores["maintenance_spend"] = 1.0 - spend / max_spend if max_spend > 0 else np.ones(n)
+
+    full_codes = [pool.location_codes[location_id] for location_id in over_capacity_ids if location_id in pool.location_codes]
+    in_full_yard = np.isin(pool._location_index, full_codes) if full_codes else np.zeros(n, dtype=bool)
+    values["yard_occupancy"] = in_full_yard
+    scores["yard_occupancy"] = in_full_yard.astype(float)
+
+    total_weight = sum(weights[factor] for factor in scores)
+    if total_weight <= 0:
+        raise ValueError("At least one ranking factor needs a positive weight.")
+    combined = sum(weights[factor] * scores[factor] for factor in scores) / total_weight
+
+    booked = [pool.index[equipment_id] for equipment_id in booked_ids if equipment_id in pool.index]
+    if booked:
+        combined[booked] = -np.inf
+    k = min(k, n - len(booked))
+    if k <= 0:
+        return []
+    top = np.argpartition(-combined, k - 1)[:k]
+    top = top[np.argsort(-combined[top], kind="stable")]
+
+    ranked = []
+    for i in top:
+        candidate = dict(pool.rows[i])
+        candidate["score"] = round(float(combined[i]), 4)
+        candidate["factors"] = {
+            factor: {"value": _plain(values[factor][i]), "score": round(float(scores[factor][i]), 4), "weight": weights[factor]}
+            for factor in scores
+        }
+        if "distance" in values and not np.isnan(values["distance"][i]):
+            candidate["distance_km"] = round(float(values["distance"][i]), 1)
+        ranked.append(candidate)
+    return ranked
+
+
+def _plain(value):
+    if isinstance(value, np.bool_):
+        return bool(value)
+    value = float(value)
+    return None if np.isnan(value) else round(value, 2)
+
+
+def job_window(job_date, duration_days=1):
+    """(start, end) datetimes for a job date string and duration; an unparseable or missing date means today."""
+    start = None
+    if job_date:
+        try:
+            start = dateutil_parser.parse(str(job_date))
+        except (ValueError, OverflowError):
+            print(f"candidate_ranking: Invalid job date '{job_date}', using today.")
+    if start is None:
+        start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    return start, start + timedelta(days=max(1, int(duration_days or 1)))
+
+
+def _booked_units(job_start, job_end):
+    if not availability_index.loaded and availability_index.warm_load() is None:
+        print("candidate_ranking: Availability index unavailable; booked units are not filtered out.")
+        return {}
+    return availability_index.booked_units(job_start, job_end)
+
+
+def rank_candidates(equipment_category, equipment_make=None, job_location=None, job_date=None, duration_days=1, k=TOP_K,
+                    weights=None):
+    """
+    Ranks every unit of a category (and make) that is free for the job window.
+
+    Returns:
+        list[dict] | None: Up to k candidates, best first (see score_pool), or None if the
+        candidate pool couldn't be read.
+
+    Raises:
+        ConnectionError: If no database connection is available.
+    """
+    pool = candidate_pool_cache.get_or_load((equipment_category, equipment_make or None),
+                                            lambda: load_pool(equipment_category, equipment_make))
+    if pool is None:
+        return None
+    job_point = spatial_index.locate(job_location) if job_location else None
+    booked = _booked_units(*job_window(job_date, duration_days))
+    over_capacity_ids = fleet_summary.over_capacity_location_ids()
+    return score_pool(pool, k, job_point=job_point, booked_ids=booked, weights=weights,
+                      over_capacity_ids=over_capacity_ids)
@@ -0,0 +1,487 @@
+# change_feed.py - Row-level change events for Equipment, MaintenanceJob and CustomerEquipmentAssignment
+#
+# In-process consumers (the read caches, the spatial and availability indexes, the
+# serial map, the graph engine) subscribe to one ChangeFeed per process and are told about every row
+# written, by any worker or tool, shortly after it commits. They no longer have to wait
+# for a TTL or a periodic reload to notice. The events come from a pluggable source
+# (CHANGE_FEED_SOURCE):
+#
+#   change_stream   Spanner change stream CHANGE_STREAM_NAME (created by setup.py), read
+#                   partition by partition from the worker's start time. The production
+#                   choice: set it at deploy time once the stream exists.
+#   polling         Strong reads of rows whose commit timestamp (create_time /
+#                   last_update_time) is past the last one seen, every
+#                   CHANGE_FEED_POLL_SECONDS, in every worker. A fallback for small
+#                   fleets without the stream: the commit-timestamp columns are not
+#                   indexed, so each poll scans the three tables; it cannot see deletes,
+#                   and it keeps a fingerprint of every Equipment row (read whole at
+#                   start) to tell which columns an update changed.
+#   in_process      Only the writes this process publishes (change_feed.publish); other
+#                   workers' writes reach consumers through their TTLs and reloads.
+#   off             No events; consumers fall back to their TTLs and reloads.
+#
+# Consumers that would otherwise poll Spanner themselves (the graph engine) only stop
+# doing so when the feed is complete, i.e. its source sees every writer.
+#
+# An event is a dict: {table, mod_type ("INSERT" | "UPDATE" | "DELETE"), keys, values,
+# columns, commit_timestamp, source}. values holds the row's new column values as far
+# as the source knows them, and columns lists the columns an UPDATE changed (None if
+# unknown). Delivery is at least once: a source that restarts resumes from the last
+# commit timestamp it saw, so subscribers must tolerate repeats.
+#
+#   CHANGE_FEED_SOURCE          change_stream | polling | in_process | off (default in_process)
+#   CHANGE_STREAM_NAME          change stream to read (default FleetChanges)
+#   CHANGE_STREAM_HEARTBEAT_MS  heartbeat interval requested from the stream (default 10000)
+#   CHANGE_STREAM_SESSIONS      idle sessions kept for the partition readers, which use their
+#                               own Database handle and pool, not the request pool (default 4)
+#   CHANGE_FEED_POLL_SECONDS    polling interval (default 5)
+#   CHANGE_FEED_RETRY_SECONDS   wait before a failed read is retried (default 5)
+
+import json
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+
+from google.cloud.spanner_v1 import param_types
+
+from spanner_data import get_separate_database, run_queries_batch
+
+SOURCE = os.environ.get("CHANGE_FEED_SOURCE", "in_process").strip().lower()
+STREAM_NAME = os.environ.get("CHANGE_STREAM_NAME", "FleetChanges")
+HEARTBEAT_MS = int(os.environ.get("CHANGE_STREAM_HEARTBEAT_MS", "10000"))
+STREAM_SESSIONS = int(os.environ.get("CHANGE_STREAM_SESSIONS", "4"))
+POLL_SECONDS = float(os.environ.get("CHANGE_FEED_POLL_SECONDS", "5"))
+RETRY_SECONDS = float(os.environ.get("CHANGE_FEED_RETRY_SECONDS", "5"))
+
+# Watched tables: primary key, the columns the polling source reads, and its commit-timestamp
+# expression. Equipment is the one updated in place, so every column is read to tell which changed.
+TABLES = {
+    "Equipment": (("equipment_id",),
+                  ["serial_number", "description", "list_price", "meter_hours", "current_address", "current_city",
+                   "current_state_province", "current_postal_code", "current_country", "category", "subcategory",
+                   "make", "model", "model_year", "financing_eligible", "warranty_eligible", "photo_url", "video_url",
+                   "latitude", "longitude", "current_service_location_id", "current_customer_id",
+                   "create_time", "last_update_time"],
+                  "COALESCE(last_update_time, create_time)"),
+    "MaintenanceJob": (("job_id",), ["equipment_id", "job_date", "job_description", "cost", "service_type", "create_time"],
+                       "create_time"),
+    "CustomerEquipmentAssignment": (("assignment_id",),
+                                    ["customer_id", "equipment_id", "assignment_start_date", "assignment_end_date",
+                                     "assignment_type", "create_time"],
+                                    "create_time"),
+}
+# Commit timestamps, not data: never reported as changed columns.
+_VERSION_COLUMNS = ("create_time", "last_update_time")
+# TIMESTAMP columns; the change stream delivers them as strings, events carry datetimes.
+TIMESTAMP_COLUMNS = frozenset(["create_time", "last_update_time", "job_date", "assignment_start_date", "assignment_end_date"])
+
+
+def make_event(table, mod_type, keys, values=None, commit_timestamp=None, columns=None, source=None):
+    return {"table": table, "mod_type": mod_type, "keys": dict(keys), "values": dict(values or {}),
+            "columns": list(columns) if columns is not None else None,
+            "commit_timestamp": commit_timestamp, "source": source}
+
+
+# --- Sources ---
+# A source has a name, sees_all_writers (whether other processes' commits reach it),
+# start(emit) (begin calling emit(event) from its own threads), stop() and stats().
+
+class InProcessSource:
+    """Delivers only what the process publishes itself."""
+
+    name = "in_process"
+    sees_all_writers = False
+
+    def __init__(self):
+        self._emit = None
+
+    def start(self, emit):
+        self._emit = emit
+
+    def stop(self):
+        self._emit = None
+
+    def publish(self, table, keys, mod_type="UPDATE", values=None):
+        emit = self._emit
+        if emit is None:
+            return
+        columns = list(values or {}) if mod_type == "UPDATE" else None
+        emit(make_event(table, mod_type, keys, values, datetime.now(timezone.utc), columns=columns, source=self.name))
+
+    def stats(self):
+        return {}
+
+
+class PollingSource:
+    """
+    Polls each watched table for rows committed after its watermark.
+
+    A strong read sees every commit up to its read timestamp, so advancing the watermark
+    to the newest commit timestamp returned never skips a row. Deletes are not seen. For
+    tables updated in place (those with last_update_time) the source keeps a fingerprint
+    of every row, so an UPDATE event lists only the columns that actually changed and a
+    telematics position update doesn't read as a whole-row write.
+    """
+
+    name = "polling"
+    sees_all_writers = True
+
+    def __init__(self, interval=POLL_SECONDS, retry_seconds=RETRY_SECONDS):
+        self.interval = interval
+        self.retry_seconds = retry_seconds
+        self._watermarks = {}
+        self._fingerprints = {table: {} for table, (_, _, version) in TABLES.items() if "last_update_time" in version}
+        self._stop = threading.Event()
+        self._thread = None
+        self.polls = 0
+        self.errors = 0
+
+    def start(self, emit):
+        """Seeds the watermarks before returning, so every later commit is reported."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        if not self._seed():
+            print(f"change_feed: Polling seed failed; retrying every {self.retry_seconds}s. Commits until then are missed.")
+        self._thread = threading.Thread(target=self._run, args=(emit,), name="change-feed-poll", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _seed(self):
+        # Start from the newest commit already in each table: only later writes are changes.
+        queries = {}
+        for table, (key, columns, version) in TABLES.items():
+            if table in self._fingerprints:
+                queries[table] = {"sql": f"SELECT {', '.join(key + tuple(columns))}, {version} AS commit_version FROM {table}",
+                                  "expected_fields": list(key) + columns + ["commit_version"]}
+            else:
+                queries[table] = {"sql": f"SELECT MAX({version}) AS commit_version FROM {table}", "expected_fields": ["commit_version"]}
+        try:
+            results = run_queries_batch(queries, consistency="strong")
+        except Exception as e:
+            print(f"change_feed: Polling seed failed: {e}")
+            results = {}
+        if any(results.get(table) is None for table in TABLES):
+            self.errors += 1
+            return False
+        epoch = datetime.fromtimestamp(0, timezone.utc)
+        for table, rows in results.items():
+            if table in self._fingerprints:
+                fingerprints = self._fingerprints[table]
+                for row in rows:
+                    fingerprints[self._key(table, row)] = self._fingerprint(table, row)
+            self._watermarks[table] = max((row["commit_version"] for row in rows if row["commit_version"] is not None), default=epoch)
+        return True
+
+    @staticmethod
+    def _key(table, row):
+        return tuple(row[column] for column in TABLES[table][0])
+
+    @staticmethod
+    def _fingerprint(table, row):
+        return tuple(hash(row[column]) for column in TABLES[table][1] if column not in _VERSION_COLUMNS)
+
+    def _run(self, emit):
+        while not self._watermarks and not self._stop.wait(self.retry_seconds):
+            self._seed()
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll(emit)
+            except Exception as e:
+                self.errors += 1
+                print(f"change_feed: Poll failed: {e}")
+                traceback.print_exc()
+
+    def poll(self, emit):
+        queries = {}
+        for table, (key, columns, version) in TABLES.items():
+            fields = list(key) + columns + ["commit_version"]
+            queries[table] = {
+                "sql": f"SELECT {', '.join(fields[:-1])}, {version} AS commit_version FROM {table} "
+                       f"WHERE {version} > @since ORDER BY commit_version",
+                "params": {"since": self._watermarks[table]}, "param_types_map": {"since": param_types.TIMESTAMP},
+                "expected_fields": fields,
+            }
+        results = run_queries_batch(queries, consistency="strong")
+        self.polls += 1
+        events = []
+        for table, rows in results.items():
+            if rows is None:
+                self.errors += 1
+                continue  # watermark stays; retried next poll
+            key, columns = TABLES[table][0], [column for column in TABLES[table][1] if column not in _VERSION_COLUMNS]
+            fingerprints = self._fingerprints.get(table)
+            for row in rows:
+                commit_version = row.pop("commit_version")
+                self._watermarks[table] = commit_version
+                mod_type, changed = "INSERT", None
+                if fingerprints is not None:
+                    fingerprint = self._fingerprint(table, row)
+                    previous = fingerprints.get(self._key(table, row))
+                    fingerprints[self._key(table, row)] = fingerprint
+                    if previous is not None:
+                        mod_type = "UPDATE"
+                        changed = [column for column, old, new in zip(columns, previous, fingerprint) if old != new]
+                        if not changed:
+                            continue  # rewritten with the same values
+                events.append(make_event(table, mod_type, {column: row[column] for column in key}, row,
+                                         commit_version, columns=changed, source=self.name))
+        events.sort(key=lambda event: event["commit_timestamp"])
+        for event in events:
+            emit(event)
+
+    def stats(self):
+        return {"polls": self.polls, "errors": self.errors, "interval_seconds": self.interval,
+                "tracked_rows": {table: len(fingerprints) for table, fingerprints in self._fingerprints.items()},
+                "watermarks": {table: value.isoformat() for table, value in self._watermarks.items()}}
+
+
+def _field(struct, index, name):
+    """A STRUCT value by name if the client decoded it as a mapping, else by position."""
+    if isinstance(struct, dict):
+        return struct.get(name)
+    return struct[index]
+
+
+def _json(value):
+    if value is None:
+        return {}
+    return json.loads(value) if isinstance(value, str) else dict(value)
+
+
+def _typed(values):
+    """Parses the TIMESTAMP columns of a change record's JSON values into aware datetimes."""
+    for column in TIMESTAMP_COLUMNS.intersection(values):
+        if isinstance(values[column], str):
+            values[column] = datetime.fromisoformat(values[column].replace("Z", "+00:00"))
+    return values
+
+
+class ChangeStreamSource:
+    """
+    Reads a Spanner change stream: the root query names the initial partitions, each
+    partition is read on its own thread until it ends, and the child partitions it
+    reports are started in turn (once each, whichever parent reports them first).
+
+    A partition read holds its session until the partition ends, so the readers share a
+    Database handle with its own pool (spanner_data.get_separate_database) rather than
+    taking sessions the request handlers need.
+    """
+
+    name = "change_stream"
+    sees_all_writers = True
+
+    def __init__(self, stream_name=STREAM_NAME, heartbeat_ms=HEARTBEAT_MS, retry_seconds=RETRY_SECONDS,
+                 sessions=STREAM_SESSIONS):
+        self.stream_name = stream_name
+        self.heartbeat_ms = heartbeat_ms
+        self.retry_seconds = retry_seconds
+        self.sessions = sessions
+        self._database = None
+        self._emit = None
+        self._seen_tokens = set()
+        self._active = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.records = 0
+        self.heartbeats = 0
+        self.partitions_started = 0
+        self.errors = 0
+
+    def start(self, emit):
+        if self._emit is not None:
+            return
+        self._emit = emit
+        self._stop.clear()
+        self._spawn(None, datetime.now(timezone.utc))
+
+    def stop(self):
+        self._stop.set()
+
+    def _spawn(self, token, start):
+        with self._lock:
+            if token in self._seen_tokens:
+                return
+            self._seen_tokens.add(token)
+            self.partitions_started += 1
+            number = self.partitions_started
+        threading.Thread(target=self._read_partition, args=(token, start), name=f"change-stream-{number}", daemon=True).start()
+
+    def _read_partition(self, token, start):
+        sql = (f"SELECT ChangeRecord FROM READ_{self.stream_name}(start_timestamp => @start, end_timestamp => NULL, "
+               f"partition_token => @token, heartbeat_milliseconds => @heartbeat)")
+        types = {"start": param_types.TIMESTAMP, "token": param_types.STRING, "heartbeat": param_types.INT64}
+        resume_at = start
+        with self._lock:
+            self._active += 1
+        try:
+            while not self._stop.is_set():
+                try:
+                    db = self._get_database()
+                    if not db: raise ConnectionError("Spanner database connection not initialized.")
+                    with db.snapshot() as snapshot:
+                        results = snapshot.execute_sql(sql, params={"start": resume_at, "token": token, "heartbeat": self.heartbeat_ms},
+                                                       param_types=types)
+                        for row in results:
+                            for record in row[0] or []:
+                                resume_at = self._handle(record, resume_at)
+                            if self._stop.is_set():
+                                return
+                    return  # the partition has ended; its children carry on
+                except Exception as e:
+                    self.errors += 1
+                    print(f"change_feed: Change stream partition read failed (resuming at {resume_at.isoformat()}): {e}")
+                    self._stop.wait(self.retry_seconds)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _get_database(self):
+        with self._lock:
+            if self._database is None:
+                self._database = get_separate_database(self.sessions)
+            return self._database
+
+    def _handle(self, record, resume_at):
+        """Emits a ChangeRecord's data changes, starts its child partitions; returns the new resume point."""
+        for change in _field(record, 0, "data_change_record") or []:
+            commit_timestamp = _field(change, 0, "commit_timestamp")
+            table = _field(change, 4, "table_name")
+            mod_type = _field(change, 7, "mod_type")
+            if table in TABLES:
+                for mod in _field(change, 6, "mods") or []:
+                    keys, values = _json(_field(mod, 0, "keys")), _typed(_json(_field(mod, 1, "new_values")))
+                    self.records += 1
+                    self._emit(make_event(table, mod_type, keys, dict(values, **keys), commit_timestamp,
+                                          columns=list(values) if mod_type == "UPDATE" else None, source=self.name))
+            resume_at = max(resume_at, commit_timestamp)
+        for heartbeat in _field(record, 1, "heartbeat_record") or []:
+            self.heartbeats += 1
+            resume_at = max(resume_at, _field(heartbeat, 0, "timestamp"))
+        for children in _field(record, 2, "child_partitions_record") or []:
+            for partition in _field(children, 2, "child_partitions") or []:
+                self._spawn(_field(partition, 0, "token"), _field(children, 0, "start_timestamp"))
+        return resume_at
+
+    def stats(self):
+        with self._lock:
+            return {"stream": self.stream_name, "active_partitions": self._active,
+                    "partitions_started": self.partitions_started, "records": self.records,
+                    "heartbeats": self.heartbeats, "errors": self.errors}
+
+
+_SOURCES = {"change_stream": ChangeStreamSource, "polling": PollingSource, "in_process": InProcessSource}
+
+
+# --- Feed ---
+class ChangeFeed:
+    """
+    Fans change events from one source out to in-process subscribers.
+
+    Args:
+        source (str | object): A CHANGE_FEED_SOURCE name, or a source object.
+    """
+
+    def __init__(self, source=SOURCE):
+        if isinstance(source, str):
+            if source != "off" and source not in _SOURCES:
+                print(f"change_feed: Unknown CHANGE_FEED_SOURCE '{source}'; change feed is off.")
+            source = _SOURCES[source]() if source in _SOURCES else None
+        self.source = source
+        self._subscribers = []  # [(callback, tables or None)]
+        self._lock = threading.Lock()
+        self._dispatch_lock = threading.Lock()  # one event at a time, in arrival order
+        self.started = False
+        self.events = {}
+        self.subscriber_errors = 0
+        self.last_commit_timestamp = None
+
+    @property
+    def complete(self):
+        """True while the feed runs and its source reports every writer's commits, not just this process's."""
+        return self.started and self.source.sees_all_writers
+
+    def subscribe(self, callback, tables=None):
+        """
+        Calls callback(event) for every change (to the given tables only, if any). Callbacks
+        run on the source's threads and should be quick; exceptions are logged and counted.
+
+        Returns:
+            The callback, for unsubscribe().
+        """
+        with self._lock:
+            self._subscribers.append((callback, frozenset(tables) if tables else None))
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = [(cb, tables) for cb, tables in self._subscribers if cb is not callback]
+
+    def start(self):
+        """Starts the source (once). Returns False if the feed is off."""
+        with self._lock:
+            if self.started or self.source is None:
+                return self.started
+            self.started = True
+        self.source.start(self._dispatch)
+        print(f"change_feed: Started ({self.source.name}).")
+        return True
+
+    def stop(self):
+        with self._lock:
+            if not self.started:
+                return
+            self.started = False
+        self.source.stop()
+
+    def publish(self, table, keys, mod_type="UPDATE", values=None):
+        """
+        Announces a write this process committed. Only the in_process source turns it
+        into an event; the other sources see the commit in Spanner themselves.
+        """
+        if isinstance(self.source, InProcessSource):
+            self.source.publish(table, keys, mod_type=mod_type, values=values)
+
+    def _dispatch(self, event):
+        with self._dispatch_lock:
+            with self._lock:
+                subscribers = list(self._subscribers)
+                self.events[event["table"]] = self.events.get(event["table"], 0) + 1
+                if event["commit_timestamp"] is not None:
+                    self.last_commit_timestamp = event["commit_timestamp"]
+            for callback, tables in subscribers:
+                if tables is not None and event["table"] not in tables:
+                    continue
+                try:
+                    callback(event)
+                except Exception as e:
+                    with self._lock:
+                        self.subscriber_errors += 1
+                    print(f"change_feed: Subscriber {getattr(callback, '__name__', callback)} failed on "
+                          f"{event['table']} {event['mod_type']}: {e}")
+                    traceback.print_exc()
+
+    def stats(self):
+        with self._lock:
+            last = self.last_commit_timestamp
+            stats = {
+                "source": self.source.name if self.source is not None else "off",
+                "started": self.started,
+                "complete": self.complete,
+                "subscribers": len(self._subscribers),
+                "events": dict(self.events),
+                "subscriber_errors": self.subscriber_errors,
+                "last_commit_timestamp": last.isoformat() if last else None,
+                "lag_seconds": round(time.time() - last.timestamp(), 3) if last else None,
+            }
+        if self.source is not None:
+            stats["source_stats"] = self.source.stats()
+        return stats
+
+
+# Process-wide feed shared by every subscriber.
+change_feed = ChangeFeed()
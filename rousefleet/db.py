@@ -1,72 +1,48 @@
 # db.py for Rouse FleetPro (Spanner Graph Query Examples)
 
 import os
-import traceback
+import threading
+import time
 from datetime import datetime # Keep for potential date handling in results
 import json # For example usage printing
 
-from google.cloud import spanner
 from google.cloud.spanner_v1 import param_types
-from google.api_core import exceptions
-
-# --- Spanner Configuration for FleetPro ---
-# Ensure these match your FleetPro Spanner setup
-INSTANCE_ID = os.environ.get("SPANNER_INSTANCE_ID", "rousefleet-graph-instance")
-DATABASE_ID = os.environ.get("SPANNER_DATABASE_ID", "graphdb") # This was 'graphdb' in your setup
-PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT")
-
-if not PROJECT_ID:
-    print("Warning: GOOGLE_CLOUD_PROJECT environment variable not set in db.py. Spanner connection will fail.")
-
-# --- Spanner Client Initialization ---
-db = None # This will be the database object
-spanner_client = None
-try:
-    if PROJECT_ID:
-        spanner_client = spanner.Client(project=PROJECT_ID)
-        instance = spanner_client.instance(INSTANCE_ID)
-        database = instance.database(DATABASE_ID)
-        print(f"db.py: Attempting to connect to Spanner: {instance.name}/databases/{database.name}")
-
-        if not database.exists():
-             print(f"db.py: Error - Database '{database.name}' does not exist in instance '{instance.name}'.")
-             print(f"db.py: Please ensure the database and FleetGraph schema are created.")
-             db = None
-        else:
-            print("db.py: Spanner database connection check successful.")
-            db = database # Assign the database object
-    else:
-        print("db.py: Skipping Spanner client initialization due to missing GOOGLE_CLOUD_PROJECT.")
 
-except exceptions.NotFound:
-    print(f"db.py: Error - Spanner instance '{INSTANCE_ID}' not found in project '{PROJECT_ID}'.")
-    db = None
-except Exception as e:
-    print(f"db.py: An unexpected error occurred during Spanner initialization: {e}")
-    traceback.print_exc()
-    db = None
+from spanner_data import get_database, run_query, STALE_READ_CONSISTENCY, staleness_bound_seconds
+from read_cache import register_cache
+from graph_engine import graph_engine, co_location_pairs
+
+# --- Spanner Connection ---
+# Client, session pool and query execution are shared with app.py through spanner_data.
+# Connection settings (GOOGLE_CLOUD_PROJECT, SPANNER_INSTANCE_ID, SPANNER_DATABASE_ID,
+# SPANNER_POOL_*) are read from the environment on first use.
+# Graph examples read with bounded staleness (SPANNER_STALE_READ_CONSISTENCY, default
+# "max:10"); pass consistency="strong" to run_graph_query when a query must see the latest commit.
 
 # --- Utility Function (Graph Query Specific) ---
 
-def run_graph_query(db_instance, graph_sql, params=None, param_types_map=None, expected_fields=None):
+def run_graph_query(db_instance, graph_sql, params=None, param_types_map=None, expected_fields=None,
+                    consistency=STALE_READ_CONSISTENCY, query_name=None):
     """
     Executes a Spanner Graph Query (GQL).
 
     Args:
-        db_instance: The Spanner database object.
+        db_instance: The Spanner database object (None uses the shared spanner_data connection).
         graph_sql (str): The GQL query string (starting with 'Graph ...').
         params (dict, optional): Dictionary of query parameters.
         param_types_map (dict, optional): Dictionary mapping param names to Spanner types.
         expected_fields (list[str], optional): Expected column names in order. Essential for GQL.
+        consistency (optional): Read consistency for spanner_data.run_query; stale by default.
+        query_name (str, optional): Name the query is recorded under in query_stats.
 
     Returns:
         list[dict]: A list of dictionaries representing the rows, or None on error.
     """
+    db_instance = db_instance or get_database()
     if not db_instance:
         print("db.py - run_graph_query: Error - Database connection is not available.")
         return None
 
-    results_list = []
     print(f"--- db.py: Executing Graph Query ---")
     # print(f"GQL: {graph_sql}") # Uncomment for verbose query logging
     # if params: print(f"Params: {params}")
@@ -75,99 +51,420 @@ def run_graph_query(db_instance, graph_sql, params=None, param_types_map=None, e
         print("db.py - run_graph_query: Error - 'expected_fields' must be provided for graph queries.")
         return None
 
-    try:
-        with db_instance.snapshot() as snapshot:
-            results = snapshot.execute_sql(
-                graph_sql,
-                params=params,
-                param_types=param_types_map
-            )
-            for row in results:
-                if len(expected_fields) != len(row):
-                     print(f"db.py - run_graph_query: Warning - Mismatch between field names ({len(expected_fields)}) and row values ({len(row)}). Skipping row: {row}")
-                     continue
-                results_list.append(dict(zip(expected_fields, row)))
-            # print(f"db.py - run_graph_query: Successful, fetched {len(results_list)} rows.")
-    except (exceptions.NotFound, exceptions.PermissionDenied, exceptions.InvalidArgument) as spanner_err:
-        print(f"db.py - run_graph_query: Spanner Graph Query Error ({type(spanner_err).__name__}): {spanner_err}")
-        return None # Return None to indicate a query failure
-    except Exception as e:
-        print(f"db.py - run_graph_query: An unexpected error occurred: {e}")
-        traceback.print_exc()
-        return None
+    return run_query(graph_sql, params=params, param_types_map=param_types_map,
+                     expected_fields=expected_fields, database=db_instance, consistency=consistency,
+                     query_name=query_name)
 
-    return results_list
 
+# --- Graph Query Registry ---
+# Named, parameterized FleetGraph queries with declared parameter types and result
+# columns. Results are cached per (query name, parameters) in a read_cache TTL cache
+# that is cleared by notify_write() on any table the query reads, so an agent asking
+# the same graph question again within GRAPH_QUERY_TTL_SECONDS gets the rows from
+# memory instead of a fresh multi-hop evaluation. Reads are stale by default, so
+# values stored just after an invalidation only live out the staleness window.
+# Cached rows are shared: callers get copies of the row dicts.
 
-# --- FleetPro Graph Data Fetching Functions ---
+GRAPH_QUERY_TTL_SECONDS = float(os.environ.get("GRAPH_QUERY_TTL_SECONDS", "120"))
+GRAPH_QUERY_CACHE_ENTRIES = int(os.environ.get("GRAPH_QUERY_CACHE_ENTRIES", "256"))
 
-def get_equipment_with_customers_graph(db_instance, limit=20):
+_UNSET = object()
+STRING_ARRAY = param_types.Array(param_types.STRING)
+
+
+class GraphQuery:
     """
-    Fetches equipment and their operating customers using FleetGraph.
+    One registered FleetGraph query.
+
+    Args:
+        name (str): Registry key; also the query_stats name ("graph.<name>").
+        gql (str): The GQL text.
+        params (dict): {param_name: (spanner param type, default)}; _UNSET marks a required parameter.
+        fields (list[str]): Result columns, in order.
+        depends_on (dict): {table: column tuple or None} whose writes invalidate cached results.
+        ttl_seconds (float): Lifetime of a cached result; 0 disables caching.
+        postprocess (callable, optional): Applied to the rows once, before they are cached.
+    """
+
+    def __init__(self, name, gql, params, fields, depends_on, ttl_seconds=GRAPH_QUERY_TTL_SECONDS, postprocess=None):
+        self.name = name
+        self.gql = gql
+        self.params = dict(params)
+        self.fields = list(fields)
+        self.postprocess = postprocess
+        self.cache = register_cache(
+            f"graph_query:{name}",
+            max_entries=GRAPH_QUERY_CACHE_ENTRIES,
+            ttl_seconds=ttl_seconds,
+            depends_on=depends_on,
+            settle_seconds=staleness_bound_seconds(STALE_READ_CONSISTENCY),
+        )
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.executions = 0
+        self.errors = 0
+        self.execution_ms = 0.0
+
+    def bind(self, kwargs):
+        """Fills defaults and rejects unknown or missing parameters (ValueError)."""
+        unknown = set(kwargs) - set(self.params)
+        if unknown:
+            raise ValueError(f"Graph query '{self.name}' has no parameter(s) {', '.join(sorted(unknown))}.")
+        bound = {}
+        for param, (_, default) in self.params.items():
+            value = kwargs.get(param, default)
+            if value is _UNSET:
+                raise ValueError(f"Graph query '{self.name}' requires parameter '{param}'.")
+            bound[param] = value
+        return bound
+
+    def execute(self, db_instance, bound, consistency):
+        started = time.perf_counter()
+        rows = run_graph_query(db_instance, self.gql, params=bound,
+                               param_types_map={param: spec[0] for param, spec in self.params.items()},
+                               expected_fields=self.fields, consistency=consistency, query_name=f"graph.{self.name}")
+        with self._lock:
+            self.executions += 1
+            self.execution_ms += (time.perf_counter() - started) * 1000
+            if rows is None:
+                self.errors += 1
+        if rows is not None and self.postprocess:
+            rows = self.postprocess(rows)
+        return rows
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "calls": self.calls,
+                "executions": self.executions,
+                "errors": self.errors,
+                "mean_execution_ms": round(self.execution_ms / self.executions, 2) if self.executions else None,
+                "params": list(self.params),
+                "fields": self.fields,
+            }
+        stats["cache"] = self.cache.stats()
+        return stats
+
+
+GRAPH_QUERIES = {}
+
+
+def register_graph_query(name, gql, params, fields, depends_on, **kwargs):
+    """Adds a GraphQuery to the registry (replacing one of the same name) and returns it."""
+    query = GraphQuery(name, gql, params, fields, depends_on, **kwargs)
+    GRAPH_QUERIES[name] = query
+    return query
+
+
+def run_named_graph_query(name, db_instance=None, consistency=STALE_READ_CONSISTENCY, use_cache=True, **params):
+    """
+    Runs a registered graph query, answering repeats from its result cache.
+
+    Args:
+        name (str): Registered query name.
+        db_instance (optional): Explicit Database object; defaults to the shared one.
+        consistency (optional): Read consistency. Strong reads bypass the cache.
+        use_cache (bool): False forces a fresh evaluation that bypasses the cache.
+        **params: Query parameters; missing ones take their declared defaults.
+
+    Returns:
+        list[dict]: Rows as declared by the query's fields, or None on error.
+
+    Raises:
+        KeyError: If no query is registered under name.
+        ValueError: If a parameter is unknown or a required one is missing.
+    """
+    query = GRAPH_QUERIES[name]
+    bound = query.bind(params)
+    with query._lock:
+        query.calls += 1
+    # Strong reads must see the latest commit, so they never come from (or fill) the cache.
+    if staleness_bound_seconds(consistency) == 0:
+        return query.execute(db_instance, bound, consistency)
+    if not use_cache:
+        rows = query.execute(db_instance, bound, consistency)
+    else:
+        key = tuple(sorted((param, tuple(value) if isinstance(value, list) else value) for param, value in bound.items()))
+        rows = query.cache.get_or_load(key, lambda: query.execute(db_instance, bound, consistency))
+    return [dict(row) for row in rows] if rows is not None else None
+
+
+def invalidate_graph_queries(name=None):
+    """Drops cached results of one registered query, or of all of them."""
+    for query in ([GRAPH_QUERIES[name]] if name else GRAPH_QUERIES.values()):
+        query.cache.invalidate()
+
+
+def graph_query_stats():
+    """Per-query call/execution counts, mean evaluation time and cache stats."""
+    return {name: query.stats() for name, query in GRAPH_QUERIES.items()}
+
+
+def _isoformat_job_dates(rows):
+    # Convert datetime objects for easier JSON serialization
+    for row in rows:
+        if isinstance(row.get('job_date'), datetime):
+            row['job_date'] = row['job_date'].isoformat()
+    return rows
+
+
+register_graph_query(
+    "equipment_with_customers",
     """
-    if not db_instance: return None
-    graph_sql = """
         Graph FleetGraph
         MATCH (eq:EquipmentNode)-[op:EquipmentOperatedBy]->(c:CustomerNode)
         RETURN eq.serial_number AS equipment_serial, eq.make AS equipment_make, eq.model AS equipment_model,
                c.customer_name AS customer_name, c.industry_type AS customer_industry
         ORDER BY c.customer_name, eq.make, eq.model
         LIMIT @limit
+    """,
+    params={"limit": (param_types.INT64, 20)},
+    fields=["equipment_serial", "equipment_make", "equipment_model", "customer_name", "customer_industry"],
+    depends_on={"Equipment": ("serial_number", "make", "model"), "Customer": None, "CustomerEquipmentAssignment": None},
+)
+
+def _co_location_members(rows):
+    # ARRAY<STRUCT> columns arrive as lists of [equipment_id, serial_number, make].
+    for row in rows:
+        row["members"] = [{"equipment_id": member[0], "serial_number": member[1], "make": member[2]}
+                          for member in row["members"] or []]
+    return rows
+
+
+# Each location once with its members, instead of one row per pair of co-located units.
+# Spanner's ARRAY_AGG takes no ORDER BY / LIMIT, so the members come from a correlated
+# ARRAY subquery over the LocatedAtServiceDepot edge's table (Equipment by
+# current_service_location_id, served by EquipmentByCurrentServiceLocation).
+register_graph_query(
+    "co_location_groups",
     """
-    params = {"limit": limit}
-    param_types_map = {"limit": param_types.INT64}
-    fields = ["equipment_serial", "equipment_make", "equipment_model", "customer_name", "customer_industry"]
-    return run_graph_query(db_instance, graph_sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+        SELECT location_id, location_name, unit_count,
+               ARRAY(SELECT AS STRUCT unit.equipment_id, unit.serial_number, unit.make
+                     FROM Equipment AS unit
+                     WHERE unit.current_service_location_id = located.location_id
+                     ORDER BY unit.serial_number
+                     LIMIT @member_limit) AS members
+        FROM (
+            SELECT location_id, location_name, COUNT(*) AS unit_count
+            FROM GRAPH_TABLE(FleetGraph
+                MATCH (eq:EquipmentNode)-[:LocatedAtServiceDepot]->(sl:ServiceLocationNode)
+                WHERE (@location_name_param IS NULL OR sl.name = @location_name_param)
+                  AND (@location_names IS NULL OR sl.name IN UNNEST(@location_names))
+                COLUMNS (sl.location_id AS location_id, sl.name AS location_name, eq.equipment_id AS equipment_id))
+            GROUP BY location_id, location_name
+            HAVING COUNT(*) >= @min_units
+            ORDER BY location_name
+            LIMIT @limit
+        ) AS located
+        ORDER BY location_name
+    """,
+    params={"location_name_param": (param_types.STRING, None), "location_names": (STRING_ARRAY, None),
+            "min_units": (param_types.INT64, 2),
+            "member_limit": (param_types.INT64, 50), "limit": (param_types.INT64, 100)},
+    fields=["location_id", "location_name", "unit_count", "members"],
+    depends_on={"Equipment": ("serial_number", "make", "current_service_location_id"), "ServiceLocation": ("name",)},
+    postprocess=_co_location_members,
+)
+
+register_graph_query(
+    "maintenance_for_customer_equipment",
+    """
+        Graph FleetGraph
+        MATCH (cust:CustomerNode {customer_name: @customer_name_param})-[:OperatesEquipment]->(eq:EquipmentNode)<-[:PerformedOnEquipment]-(job:MaintenanceJobNode)
+        RETURN cust.customer_name, eq.serial_number AS equipment_serial, eq.make AS equipment_make,
+               job.job_id, job.job_description, job.service_type, job.job_date, job.cost
+        ORDER BY eq.serial_number, job.job_date DESC
+        LIMIT @limit
+    """,
+    params={"customer_name_param": (param_types.STRING, _UNSET), "limit": (param_types.INT64, 20)},
+    fields=["customer_name", "equipment_serial", "equipment_make", "job_id", "job_description", "service_type", "job_date", "cost"],
+    depends_on={"Customer": ("customer_name",), "CustomerEquipmentAssignment": None,
+                "Equipment": ("serial_number", "make"), "MaintenanceJob": None},
+    postprocess=_isoformat_job_dates,
+)
+
+# Batched forms: many customers (by name or id via UNNEST) in one request, with a
+# per-customer row limit applied by ROW_NUMBER() so one large account can't crowd out the rest.
+# customer_key is whichever of name or id the caller asked by; same-named customers share a key.
+_CUSTOMER_FILTER = """(@customer_names IS NULL OR cust.customer_name IN UNNEST(@customer_names))
+              AND (@customer_ids IS NULL OR cust.customer_id IN UNNEST(@customer_ids))"""
+_CUSTOMER_PARAMS = {"customer_names": (STRING_ARRAY, None), "customer_ids": (STRING_ARRAY, None),
+                    "per_customer_limit": (param_types.INT64, 20)}
+
+register_graph_query(
+    "maintenance_for_customers",
+    f"""
+        SELECT customer_key, customer_name, equipment_serial, equipment_make,
+               job_id, job_description, service_type, job_date, cost
+        FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY customer_key ORDER BY equipment_serial, job_date DESC) AS row_number
+            FROM GRAPH_TABLE(FleetGraph
+                MATCH (cust:CustomerNode)-[:OperatesEquipment]->(eq:EquipmentNode)<-[:PerformedOnEquipment]-(job:MaintenanceJobNode)
+                WHERE {_CUSTOMER_FILTER}
+                COLUMNS (IF(@customer_names IS NULL, cust.customer_id, cust.customer_name) AS customer_key,
+                         cust.customer_name AS customer_name, eq.serial_number AS equipment_serial, eq.make AS equipment_make, job.job_id AS job_id,
+                         job.job_description AS job_description, job.service_type AS service_type,
+                         job.job_date AS job_date, job.cost AS cost))
+        )
+        WHERE row_number <= @per_customer_limit
+        ORDER BY customer_key, row_number
+    """,
+    params=_CUSTOMER_PARAMS,
+    fields=["customer_key", "customer_name", "equipment_serial", "equipment_make", "job_id", "job_description",
+            "service_type", "job_date", "cost"],
+    depends_on={"Customer": ("customer_name",), "CustomerEquipmentAssignment": None,
+                "Equipment": ("serial_number", "make"), "MaintenanceJob": None},
+    postprocess=_isoformat_job_dates,
+)
+
+register_graph_query(
+    "equipment_for_customers",
+    f"""
+        SELECT customer_key, equipment_serial, equipment_make, equipment_model, customer_name, customer_industry
+        FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY customer_key ORDER BY equipment_make, equipment_model) AS row_number
+            FROM GRAPH_TABLE(FleetGraph
+                MATCH (cust:CustomerNode)-[:OperatesEquipment]->(eq:EquipmentNode)
+                WHERE {_CUSTOMER_FILTER}
+                COLUMNS (IF(@customer_names IS NULL, cust.customer_id, cust.customer_name) AS customer_key,
+                         eq.serial_number AS equipment_serial, eq.make AS equipment_make,
+                         eq.model AS equipment_model, cust.customer_name AS customer_name,
+                         cust.industry_type AS customer_industry))
+        )
+        WHERE row_number <= @per_customer_limit
+        ORDER BY customer_key, row_number
+    """,
+    params=_CUSTOMER_PARAMS,
+    fields=["customer_key", "equipment_serial", "equipment_make", "equipment_model", "customer_name", "customer_industry"],
+    depends_on={"Equipment": ("serial_number", "make", "model"), "Customer": None, "CustomerEquipmentAssignment": None},
+)
+
+
+# --- FleetPro Graph Data Fetching Functions ---
+# Answered by the in-process graph_engine (adjacency arrays, refreshed from commit
+# timestamps) when GRAPH_ENGINE_LOCAL is on and the graph has loaded; otherwise by the
+# registered GQL queries above. The graph loads in the background on first use, never
+# on the caller's thread.
+
+USE_LOCAL_GRAPH = os.environ.get("GRAPH_ENGINE_LOCAL", "true").lower() == "true"
+# Bounds of the grouped read behind the pair form; pairs need every member of a location.
+# The pair form reads at most limit groups, since each holds at least one pair.
+CO_LOCATION_MAX_MEMBERS = int(os.environ.get("CO_LOCATION_MAX_MEMBERS", "10000"))
+CO_LOCATION_MAX_GROUPS = int(os.environ.get("CO_LOCATION_MAX_GROUPS", "10000"))
+
+def _local_graph():
+    if not USE_LOCAL_GRAPH:
+        return None
+    if not graph_engine.loaded:
+        graph_engine.load_in_background()
+        return None
+    return graph_engine
+
+def get_equipment_with_customers_graph(db_instance, limit=20):
+    """
+    Fetches equipment and their operating customers using FleetGraph.
+    """
+    if not db_instance: return None
+    local = _local_graph()
+    if local:
+        return local.equipment_with_customers(limit=limit)
+    return run_named_graph_query("equipment_with_customers", db_instance, limit=limit)
+
+def get_co_location_groups_graph(db_instance, location_name=None, min_units=2, member_limit=50, limit=100,
+                                 location_names=None):
+    """
+    Service locations holding at least min_units units, each returned once with its unit
+    count and up to member_limit members ({equipment_id, serial_number, make}, by serial).
+    Optionally filters by a specific location name, or a list of them (location_names).
+    """
+    if not db_instance: return None
+    location_names = list(location_names) if location_names is not None else None
+    local = _local_graph()
+    if local:
+        return local.co_location_groups(location_name=location_name, min_units=min_units, member_limit=member_limit,
+                                        limit=limit, location_names=location_names)
+    return run_named_graph_query("co_location_groups", db_instance, location_name_param=location_name,
+                                 location_names=location_names, min_units=min_units, member_limit=member_limit, limit=limit)
 
 def get_equipment_at_shared_location_graph(db_instance, location_name=None, limit=10):
     """
     Finds pairs of equipment at the same service location.
     Optionally filters by a specific location name.
+
+    Pairs are expanded from the grouped co-location result, only as far as limit: each
+    location with two or more units yields at least one pair, so limit locations suffice.
     """
     if not db_instance: return None
-    graph_sql = """
-        Graph FleetGraph
-        MATCH (eq1:EquipmentNode)-[:LocatedAtServiceDepot]->(sl:ServiceLocationNode)<-[:LocatedAtServiceDepot]-(eq2:EquipmentNode)
-        WHERE eq1.equipment_id < eq2.equipment_id
-          AND (@location_name_param IS NULL OR sl.name = @location_name_param)
-        RETURN eq1.serial_number AS equipment1_sn, eq1.make AS equipment1_make,
-               eq2.serial_number AS equipment2_sn, eq2.make AS equipment2_make,
-               sl.name AS shared_location_name
-        ORDER BY sl.name, equipment1_sn, equipment2_sn
-        LIMIT @limit
-    """
-    params = {"location_name_param": location_name, "limit": limit}
-    param_types_map = {"location_name_param": param_types.STRING, "limit": param_types.INT64}
-    fields = ["equipment1_sn", "equipment1_make", "equipment2_sn", "equipment2_make", "shared_location_name"]
-    return run_graph_query(db_instance, graph_sql, params=params, param_types_map=param_types_map, expected_fields=fields)
+    if limit <= 0: return []
+    groups = get_co_location_groups_graph(db_instance, location_name=location_name, min_units=2,
+                                          member_limit=CO_LOCATION_MAX_MEMBERS, limit=min(limit, CO_LOCATION_MAX_GROUPS))
+    if groups is None:
+        return None
+    return co_location_pairs(groups, limit)
 
 def get_maintenance_for_customer_equipment_graph(db_instance, customer_name_filter, limit=20):
     """
     Multi-hop: Gets maintenance jobs for equipment operated by a specific customer.
     """
     if not db_instance: return None
-    graph_sql = """
-        Graph FleetGraph
-        MATCH (cust:CustomerNode {customer_name: @customer_name_param})-[:OperatesEquipment]->(eq:EquipmentNode)<-[:PerformedOnEquipment]-(job:MaintenanceJobNode)
-        RETURN cust.customer_name, eq.serial_number AS equipment_serial, eq.make AS equipment_make,
-               job.job_id, job.job_description, job.service_type, job.job_date, job.cost
-        ORDER BY eq.serial_number, job.job_date DESC
-        LIMIT @limit
+    local = _local_graph()
+    if local:
+        return local.maintenance_for_customer_equipment(customer_name_filter, limit=limit)
+    return run_named_graph_query("maintenance_for_customer_equipment", db_instance,
+                                 customer_name_param=customer_name_filter, limit=limit)
+
+def _group_by_customer(rows, customer_names, customer_ids):
+    """{requested name or id: [rows]} with an entry (possibly empty) for every customer asked for."""
+    grouped = {key: [] for key in (customer_names if customer_names is not None else customer_ids)}
+    for row in rows:
+        grouped.setdefault(row.pop("customer_key"), []).append(row)
+    return grouped
+
+def _batched_customer_query(name, local_method, db_instance, customer_names, customer_ids, per_customer_limit):
+    if not db_instance: return None
+    if customer_names is None and customer_ids is None:
+        raise ValueError("Pass customer_names or customer_ids.")
+    customer_names = list(customer_names) if customer_names is not None else None
+    customer_ids = list(customer_ids) if customer_names is None else None
+    local = _local_graph()
+    if local:
+        return getattr(local, local_method)(customer_names=customer_names, customer_ids=customer_ids,
+                                            per_customer_limit=per_customer_limit)
+    rows = run_named_graph_query(name, db_instance, customer_names=customer_names, customer_ids=customer_ids,
+                                 per_customer_limit=per_customer_limit)
+    if rows is None:
+        return None
+    return _group_by_customer(rows, customer_names, customer_ids)
+
+def get_maintenance_for_customers_graph(db_instance, customer_names=None, customer_ids=None, per_customer_limit=20):
     """
-    params = {"customer_name_param": customer_name_filter, "limit": limit}
-    param_types_map = {"customer_name_param": param_types.STRING, "limit": param_types.INT64}
-    fields = ["customer_name", "equipment_serial", "equipment_make", "job_id", "job_description", "service_type", "job_date", "cost"]
-    
-    results = run_graph_query(db_instance, graph_sql, params=params, param_types_map=param_types_map, expected_fields=fields)
-    if results: # Convert datetime objects for easier JSON serialization if needed
-        for row in results:
-            if isinstance(row.get('job_date'), datetime):
-                row['job_date'] = row['job_date'].isoformat()
-    return results
+    Batched get_maintenance_for_customer_equipment_graph: one request for many customers.
+
+    Args:
+        customer_names (list[str], optional): Customers by name.
+        customer_ids (list[str], optional): Customers by id (used when customer_names is None).
+        per_customer_limit (int): Rows kept per customer.
+
+    Returns:
+        dict: {name or id: [rows]}, every requested customer present; None on error.
+    """
+    return _batched_customer_query("maintenance_for_customers", "maintenance_for_customers", db_instance,
+                                   customer_names, customer_ids, per_customer_limit)
+
+def get_equipment_for_customers_graph(db_instance, customer_names=None, customer_ids=None, per_customer_limit=20):
+    """
+    Batched get_equipment_with_customers_graph: each listed customer's equipment, by make and model.
+
+    Returns:
+        dict: {name or id: [rows]}, every requested customer present; None on error.
+    """
+    return _batched_customer_query("equipment_for_customers", "equipment_for_customers", db_instance,
+                                   customer_names, customer_ids, per_customer_limit)
 
 
 # --- Example Usage (if run directly) ---
 if __name__ == "__main__":
+    db = get_database()
     if db: # Check if db object was successfully initialized
         print("\n--- db.py: Testing FleetPro Graph Data Fetching Functions ---")
 
@@ -187,6 +484,13 @@ if __name__ == "__main__":
         else:
             print(f"Failed to fetch equipment at shared location '{test_location_name}'. (Is the location name correct and has multiple equipment?)")
 
+        print(f"\n2b. Grouped co-location (each location once, up to 5 members listed)")
+        groups = get_co_location_groups_graph(db, member_limit=5, limit=5)
+        if groups is not None:
+            print(json.dumps(groups, indent=2))
+        else:
+            print("Failed to fetch co-location groups.")
+
         # Example: Replace "ConstructAll Ltd." with an actual customer name from your data
         test_customer_name = "ConstructAll Ltd."
         print(f"\n3. Fetching Maintenance for Equipment operated by Customer: {test_customer_name} (Graph Query)")
@@ -195,6 +499,18 @@ if __name__ == "__main__":
             print(json.dumps(customer_maintenance, indent=2))
         else:
             print(f"Failed to fetch maintenance for customer '{test_customer_name}'. (Is the customer name correct and do their equipment have maintenance jobs?)")
+
+        print(f"\n3b. Batched maintenance for several customers (3 rows each)")
+        batched = get_maintenance_for_customers_graph(db, customer_names=[test_customer_name, "BuildRight Inc."], per_customer_limit=3)
+        if batched is not None:
+            print(json.dumps(batched, indent=2))
+        else:
+            print("Failed to fetch batched customer maintenance.")
+
+        print("\n4. Repeating query 3 (served from the graph query cache or the local graph) and printing stats")
+        get_maintenance_for_customer_equipment_graph(db, customer_name_filter=test_customer_name, limit=5)
+        print(json.dumps(graph_query_stats(), indent=2))
+        print(json.dumps(graph_engine.stats(), indent=2))
     else:
         print("\n--- db.py: Cannot run examples - Spanner database connection not established. ---")
         print("--- Please check GCP_PROJECT_ID, Spanner instance/database IDs, and permissions. ---")
\ No newline at end of file
@@ -0,0 +1,77 @@
+from flask import Blueprint, Response, jsonify, current_app
+import json
+import traceback
+from datetime import date, datetime
+
+from spanner_data import get_database, stream_query
+
+# Bulk NDJSON exports. Rows are streamed straight from execute_sql and written out in
+# small chunks, so a full-fleet export runs in constant memory in the Flask worker.
+
+export_bp = Blueprint('export', __name__)
+
+EXPORT_CHUNK_ROWS = 500
+
+EQUIPMENT_EXPORT_FIELDS = [
+    "equipment_id", "serial_number", "description", "list_price", "meter_hours",
+    "current_address", "current_city", "current_state_province", "current_postal_code", "current_country",
+    "category", "subcategory", "make", "model", "model_year",
+    "financing_eligible", "warranty_eligible", "photo_url", "video_url",
+    "latitude", "longitude", "current_service_location_id", "current_customer_id", "create_time"
+]
+
+MAINTENANCE_JOB_EXPORT_FIELDS = [
+    "job_id", "equipment_id", "job_date", "job_description", "cost", "service_type", "create_time"
+]
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _ndjson_lines(table, fields, rows):
+    """Encodes rows as NDJSON, yielding chunks of EXPORT_CHUNK_ROWS lines."""
+    row_count = 0
+    chunk = []
+    try:
+        for row in rows:
+            chunk.append(json.dumps(dict(zip(fields, row)), default=_json_default, separators=(",", ":")))
+            row_count += 1
+            if len(chunk) >= EXPORT_CHUNK_ROWS:
+                yield "\n".join(chunk) + "\n"
+                chunk = []
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+        print(f"export_routes: Exported {row_count} {table} rows.")
+    except Exception as e:
+        # Headers are already sent; the trailing error line tells the consumer the export is truncated.
+        print(f"export_routes: Error after {row_count} {table} rows: {e}")
+        traceback.print_exc()
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+        yield json.dumps({"error": f"Export of {table} aborted after {row_count} rows: {e}"}) + "\n"
+
+
+def _export_table(table, fields, order_by):
+    if not get_database():
+        return jsonify({"error": "Database connection unavailable"}), 503
+    sql = f"SELECT {', '.join(fields)} FROM {table} ORDER BY {order_by}"
+    try:
+        rows = stream_query(sql, expected_fields=fields, query_name=f"export_routes.export[{table}]")
+    except ConnectionError as ce:
+        current_app.logger.error(f"Export {table}: {ce}")
+        return jsonify({"error": "Database connection unavailable"}), 503
+    return Response(_ndjson_lines(table, fields, rows), mimetype='application/x-ndjson',
+                    headers={"Content-Disposition": f"attachment; filename={table}.ndjson"})
+
+
+@export_bp.route('/api/export/equipment', methods=['GET'])
+def export_equipment():
+    return _export_table("Equipment", EQUIPMENT_EXPORT_FIELDS, "equipment_id")
+
+
+@export_bp.route('/api/export/maintenance-jobs', methods=['GET'])
+def export_maintenance_jobs():
+    return _export_table("MaintenanceJob", MAINTENANCE_JOB_EXPORT_FIELDS, "job_id")
@@ -1,6 +1,9 @@
 import os
 import json
+import asyncio
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from vertexai import agent_engines
 
@@ -22,62 +25,99 @@ else:
     print("fleet_advisor_agent_logic: ERROR - Missing required environment variable: FLEET_ORCHESTRATOR_AGENT_ID")
 
 
-def call_dispatch_agent_for_recommendation(job_date, job_location, equipment_category,
-                                           equipment_make=None, duration_days=1,
-                                           notes=None, requestor_name="User",
-                                           user_id="dispatch_advisor_user_session"):
-    # This function is correct and unchanged.
-    global agent_engine_client
-    if not agent_engine_client:
-        yield {"type": "error", "data": {"message": "Fleet Orchestrator Agent client not initialized. Check server configuration and environment variables.", "code": "ORCHESTRATOR_CLIENT_INIT_FAIL"}}
-        return
+def _find_recommendation_candidate(equipment_category, equipment_make, job_location=None, job_date=None, duration_days=1):
+    """
+    Ranks the units of the category (and make) that are free for the job window on
+    distance to the site, meter hours, maintenance recency and spend, and yard occupancy.
 
+    Returns:
+        (list[dict] | None, dict | None): The top candidates, best first, or an error event.
+    """
     try:
-        from app import run_query
-        from google.cloud.spanner_v1 import param_types
+        from candidate_ranking import rank_candidates
     except ImportError:
-        yield {"type": "error", "data": {"message": "Internal Server Error: Could not import database utilities.", "code": "DB_IMPORT_ERROR"}}
-        return
+        return None, {"type": "error", "data": {"message": "Internal Server Error: Could not import database utilities.", "code": "DB_IMPORT_ERROR"}}
 
-    yield {"type": "thought", "data": f"--- Finding best equipment candidate from database ---"}
-    yield {"type": "thought", "data": f"Job Details: Date: {job_date}, Location: {job_location}, Category: {equipment_category}, Make: {equipment_make or 'Any'}"}
-
-    initial_candidates = []
     try:
-        sql = """
-            SELECT equipment_id, serial_number, make, model, meter_hours, description
-            FROM Equipment
-            WHERE category = @category
-              AND (@make IS NULL OR make = @make)
-            ORDER BY meter_hours ASC
-            LIMIT 1
-        """
-        params = {"category": equipment_category, "make": equipment_make if equipment_make else None}
-        param_types_map = {"category": param_types.STRING, "make": param_types.STRING}
-        expected_fields = ["equipment_id", "serial_number", "make", "model", "meter_hours", "description"]
-        initial_candidates = run_query(sql, params, param_types_map, expected_fields)
-        
-        if not initial_candidates:
-            yield {"type": "error", "data": {"message": "No suitable equipment candidates found in the database for the specified criteria.", "code": "NO_INITIAL_CANDIDATES_FOUND"}}
-            return
-            
-        candidate_display_name = [f"{c.get('make')} {c.get('model')} (SN: {c.get('serial_number')})" for c in initial_candidates]
-        yield {"type": "thought", "data": f"Found best candidate: {', '.join(candidate_display_name)}. Now sending to agent for analysis."}
-
+        initial_candidates = rank_candidates(equipment_category, equipment_make, job_location=job_location,
+                                             job_date=job_date, duration_days=duration_days)
     except Exception as db_query_exc:
-        yield {"type": "error", "data": {"message": f"A database error occurred: {db_query_exc}", "code": "DB_QUERY_ERROR"}}
-        return
+        return None, {"type": "error", "data": {"message": f"A database error occurred: {db_query_exc}", "code": "DB_QUERY_ERROR"}}
 
-    prompt_to_orchestrator = f"""
+    if not initial_candidates:
+        return None, {"type": "error", "data": {"message": "No suitable equipment candidates are free for the requested dates and criteria.", "code": "NO_INITIAL_CANDIDATES_FOUND"}}
+    return initial_candidates, None
+
+
+def _candidate_display_names(initial_candidates):
+    names = []
+    for c in initial_candidates:
+        name = f"{c.get('make')} {c.get('model')} (SN: {c.get('serial_number')}, score {c.get('score')})"
+        if c.get('distance_km') is not None:
+            name += f", {c['distance_km']:.0f} km from the job"
+        names.append(name)
+    return names
+
+
+def _recommendation_prompt(initial_candidates, equipment_category, job_location):
+    return f"""
 **Equipment Candidate to Analyze:**
 - {initial_candidates[0].get('make')} {initial_candidates[0].get('model')} (ID: {initial_candidates[0].get('equipment_id')})
-
+{_alternatives_prompt(initial_candidates[1:])}
 **Your Tasks:**
 1. Generate a full, detailed status report for this specific piece of equipment.
 2. Perform market research for this type of equipment ({equipment_category}) in the job's region ({job_location}).
 
 Combine both reports into a single, easy-to-read textual response.
 """
+
+
+def _alternatives_prompt(alternatives):
+    if not alternatives:
+        return ""
+    lines = [f"- {c.get('make')} {c.get('model')} (ID: {c.get('equipment_id')}, ranking score {c.get('score')})" for c in alternatives]
+    return "\n**Ranked alternatives (for reference only, no report needed):**\n" + "\n".join(lines) + "\n"
+
+
+def _recommendation_result(initial_candidates, accumulated_raw_output):
+    final_agent_output = accumulated_raw_output.strip()
+    if final_agent_output:
+        response_payload = {
+            "recommendation_text": final_agent_output,
+            "recommended_equipment_id": initial_candidates[0].get('equipment_id'),
+            "equipment_details": initial_candidates[0],
+            "ranked_candidates": initial_candidates
+        }
+        return {"type": "recommendation_complete", "data": response_payload}
+    return {"type": "error", "data": {"message": "Orchestrator agent did not provide a final recommendation response.", "raw_output": "No textual output from orchestrator."}}
+
+
+def _recommendation_failure(e):
+    error_details = traceback.format_exc()
+    print(f"fleet_advisor_agent_logic: Error calling remote Orchestrator (recommendation): {e}\n{error_details}")
+    return {"type": "error", "data": {"message": f"Error interacting with Orchestrator Agent: {str(e)}", "code": "ORCHESTRATOR_CALL_FAIL", "raw_output": error_details}}
+
+
+def call_dispatch_agent_for_recommendation(job_date, job_location, equipment_category,
+                                           equipment_make=None, duration_days=1,
+                                           notes=None, requestor_name="User",
+                                           user_id="dispatch_advisor_user_session"):
+    global agent_engine_client
+    if not agent_engine_client:
+        yield {"type": "error", "data": {"message": "Fleet Orchestrator Agent client not initialized. Check server configuration and environment variables.", "code": "ORCHESTRATOR_CLIENT_INIT_FAIL"}}
+        return
+
+    yield {"type": "thought", "data": f"--- Finding best equipment candidate from database ---"}
+    yield {"type": "thought", "data": f"Job Details: Date: {job_date}, Location: {job_location}, Category: {equipment_category}, Make: {equipment_make or 'Any'}"}
+
+    initial_candidates, error_event = _find_recommendation_candidate(equipment_category, equipment_make, job_location, job_date, duration_days)
+    if error_event:
+        yield error_event
+        return
+    candidate_display_name = _candidate_display_names(initial_candidates)
+    yield {"type": "thought", "data": f"Ranked {len(candidate_display_name)} candidates: {'; '.join(candidate_display_name)}. Now sending the top one to agent for analysis."}
+
+    prompt_to_orchestrator = _recommendation_prompt(initial_candidates, equipment_category, job_location)
     yield {"type": "thought", "data": "Sending prompt to Fleet Orchestrator Agent..."}
 
     accumulated_raw_output = ""
@@ -87,37 +127,14 @@ Combine both reports into a single, easy-to-read textual response.
             event_as_string = str(event)
             yield {"type": "thought", "data": f"RAW AGENT EVENT: {event_as_string}"}
             accumulated_raw_output += event_as_string + "\n"
-        
-        final_agent_output = accumulated_raw_output.strip()
-        
-        if final_agent_output:
-            response_payload = {
-                "recommendation_text": final_agent_output,
-                "recommended_equipment_id": initial_candidates[0].get('equipment_id'),
-                "equipment_details": initial_candidates[0]
-            }
-            yield {"type": "recommendation_complete", "data": response_payload}
-        else:
-            yield {"type": "error", "data": {"message": "Orchestrator agent did not provide a final recommendation response.", "raw_output": "No textual output from orchestrator."}}
-
+        yield _recommendation_result(initial_candidates, accumulated_raw_output)
     except Exception as e:
-        error_details = traceback.format_exc()
-        print(f"fleet_advisor_agent_logic: Error calling remote Orchestrator (recommendation): {e}\n{error_details}")
-        yield {"type": "error", "data": {"message": f"Error interacting with Orchestrator Agent: {str(e)}", "code": "ORCHESTRATOR_CALL_FAIL", "raw_output": error_details}}
+        yield _recommendation_failure(e)
 
 
-def execute_dispatch_assignment(user_name, equipment_id, equipment_details, job_details, agent_session_user_id):
-    global agent_engine_client
-    if not agent_engine_client:
-        yield {"type": "error", "data": {"message": "Fleet Orchestrator Agent client not initialized. Check configuration.", "code": "ORCHESTRATOR_CLIENT_INIT_FAIL_EXEC"}}
-        return
-
-    yield {"type": "thought", "data": f"--- Dispatch Advisor to Remote Orchestrator: Execution Call ---"}
-    yield {"type": "thought", "data": f"User ID for this session with Orchestrator: {agent_session_user_id}"}
-    
+def _execution_prompt(user_name, equipment_id, equipment_details, job_details):
     serial_number = equipment_details.get('serial_number', 'N/A')
-
-    prompt_to_orchestrator_for_execution = f"""
+    return f"""
 User '{user_name}' .Equipment ID '{equipment_id}'.
 Original Job Details:
 - Location: {job_details.get('location')}
@@ -130,6 +147,37 @@ Your task is to:
 
 Provide a final summary of actions performed.
 """
+
+
+def _is_final_agent_event(event):
+    return getattr(event, 'is_final', False) or getattr(event, 'turn_complete', False) or getattr(event, 'done', False)
+
+
+def _execution_result(execution_summary):
+    if execution_summary:
+        return {"type": "dispatch_complete", "data": {"success": True, "message": f"Orchestrator processed dispatch confirmation. Final Status from Orchestrator: {execution_summary.strip()}"}}
+    return {"type": "error", "data": {"message": "Orchestrator agent did not provide a confirmation for dispatch execution.", "raw_output": "No final message from orchestrator execution phase."}}
+
+
+def _execution_failure_events(e):
+    error_details = traceback.format_exc()
+    print(f"fleet_advisor_agent_logic: Error calling remote Orchestrator (execution): {e}\n{error_details}")
+    return [
+        {"type": "thought", "data": f"Error calling remote Orchestrator agent for dispatch execution: {e}"},
+        {"type": "error", "data": {"message": f"Error interacting with Orchestrator Agent for execution: {str(e)}", "code": "ORCHESTRATOR_EXEC_FAIL", "raw_output": error_details}},
+    ]
+
+
+def execute_dispatch_assignment(user_name, equipment_id, equipment_details, job_details, agent_session_user_id):
+    global agent_engine_client
+    if not agent_engine_client:
+        yield {"type": "error", "data": {"message": "Fleet Orchestrator Agent client not initialized. Check configuration.", "code": "ORCHESTRATOR_CLIENT_INIT_FAIL_EXEC"}}
+        return
+
+    yield {"type": "thought", "data": f"--- Dispatch Advisor to Remote Orchestrator: Execution Call ---"}
+    yield {"type": "thought", "data": f"User ID for this session with Orchestrator: {agent_session_user_id}"}
+
+    prompt_to_orchestrator_for_execution = _execution_prompt(user_name, equipment_id, equipment_details, job_details)
     yield {"type": "thought", "data": f"Sending confirmation to remote Fleet Orchestrator Agent to execute dispatch for Equipment ID: {equipment_id}..."}
 
     try:
@@ -142,15 +190,139 @@ Provide a final summary of actions performed.
             event_as_string = str(event)
             yield {"type": "dispatch_update", "data": {"status": "orchestrator_exec_update", "message": f"RAW AGENT EVENT: {event_as_string}"}}
             execution_summary += event_as_string + "\n"
-            if getattr(event, 'is_final', False) or getattr(event, 'turn_complete', False) or getattr(event, 'done', False):
+            if _is_final_agent_event(event):
                 break
-        
-        if execution_summary:
-            yield {"type": "dispatch_complete", "data": {"success": True, "message": f"Orchestrator processed dispatch confirmation. Final Status from Orchestrator: {execution_summary.strip()}"}}
-        else:
-            yield {"type": "error", "data": {"message": "Orchestrator agent did not provide a confirmation for dispatch execution.", "raw_output": "No final message from orchestrator execution phase."}}
+        yield _execution_result(execution_summary)
+    except Exception as e:
+        for event in _execution_failure_events(e):
+            yield event
+
+
+# --- Async variants (ASGI serving mode, see asgi.py) ---
+# Same events as the generators above, but the agent stream is consumed on the event loop,
+# so an open advisor stream costs a coroutine rather than a server thread.
+
+# Only used when the Agent Engine client has no async_stream_query: each open stream then
+# drains the sync stream on one of these threads, so at most AGENT_STREAM_FALLBACK_THREADS
+# advisor streams per process make progress at once (later ones wait for a free thread).
+AGENT_STREAM_FALLBACK_THREADS = int(os.environ.get("AGENT_STREAM_FALLBACK_THREADS", "32"))
+_agent_stream_executor = None
+
+
+async def _agent_events(user_id, message):
+    """Yields Agent Engine stream events without blocking the event loop."""
+    global _agent_stream_executor
+    async_stream_query = getattr(agent_engine_client, "async_stream_query", None)
+    if async_stream_query is not None:
+        async for event in async_stream_query(user_id=user_id, message=message):
+            yield event
+        return
+
+    if _agent_stream_executor is None:
+        _agent_stream_executor = ThreadPoolExecutor(max_workers=AGENT_STREAM_FALLBACK_THREADS, thread_name_prefix="agent-stream")
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = threading.Event()
+    finished = object()
+
+    def hand_over(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:  # the event loop has closed
+            cancelled.set()
+
+    def drain():
+        # The cancel flag is checked between next() calls: a closed stream stops here
+        # after the event in flight instead of reading the agent's reply to the end.
+        stream = None
+        try:
+            if cancelled.is_set():
+                return
+            stream = agent_engine_client.stream_query(user_id=user_id, message=message)
+            for event in stream:
+                if cancelled.is_set():
+                    return
+                hand_over(event)
+        except Exception as e:
+            hand_over(e)
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+            hand_over(finished)
+
+    _agent_stream_executor.submit(drain)
+    try:
+        while True:
+            item = await queue.get()
+            if item is finished:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+
+
+async def call_dispatch_agent_for_recommendation_async(job_date, job_location, equipment_category,
+                                                       equipment_make=None, duration_days=1,
+                                                       notes=None, requestor_name="User",
+                                                       user_id="dispatch_advisor_user_session"):
+    """Async counterpart of call_dispatch_agent_for_recommendation (same events)."""
+    if not agent_engine_client:
+        yield {"type": "error", "data": {"message": "Fleet Orchestrator Agent client not initialized. Check server configuration and environment variables.", "code": "ORCHESTRATOR_CLIENT_INIT_FAIL"}}
+        return
+
+    yield {"type": "thought", "data": f"--- Finding best equipment candidate from database ---"}
+    yield {"type": "thought", "data": f"Job Details: Date: {job_date}, Location: {job_location}, Category: {equipment_category}, Make: {equipment_make or 'Any'}"}
+
+    initial_candidates, error_event = await asyncio.to_thread(_find_recommendation_candidate, equipment_category, equipment_make,
+                                                                  job_location, job_date, duration_days)
+    if error_event:
+        yield error_event
+        return
+    candidate_display_name = _candidate_display_names(initial_candidates)
+    yield {"type": "thought", "data": f"Ranked {len(candidate_display_name)} candidates: {'; '.join(candidate_display_name)}. Now sending the top one to agent for analysis."}
+
+    prompt_to_orchestrator = _recommendation_prompt(initial_candidates, equipment_category, job_location)
+    yield {"type": "thought", "data": "Sending prompt to Fleet Orchestrator Agent..."}
+
+    accumulated_raw_output = ""
+    try:
+        async for event in _agent_events(user_id, prompt_to_orchestrator):
+            event_as_string = str(event)
+            yield {"type": "thought", "data": f"RAW AGENT EVENT: {event_as_string}"}
+            accumulated_raw_output += event_as_string + "\n"
+        yield _recommendation_result(initial_candidates, accumulated_raw_output)
+    except Exception as e:
+        yield _recommendation_failure(e)
+
+
+async def execute_dispatch_assignment_async(user_name, equipment_id, equipment_details, job_details, agent_session_user_id):
+    """Async counterpart of execute_dispatch_assignment (same events)."""
+    if not agent_engine_client:
+        yield {"type": "error", "data": {"message": "Fleet Orchestrator Agent client not initialized. Check configuration.", "code": "ORCHESTRATOR_CLIENT_INIT_FAIL_EXEC"}}
+        return
+
+    yield {"type": "thought", "data": f"--- Dispatch Advisor to Remote Orchestrator: Execution Call ---"}
+    yield {"type": "thought", "data": f"User ID for this session with Orchestrator: {agent_session_user_id}"}
+
+    prompt_to_orchestrator_for_execution = _execution_prompt(user_name, equipment_id, equipment_details, job_details)
+    yield {"type": "thought", "data": f"Sending confirmation to remote Fleet Orchestrator Agent to execute dispatch for Equipment ID: {equipment_id}..."}
+
+    try:
+        execution_summary = ""
+        events = _agent_events(agent_session_user_id, prompt_to_orchestrator_for_execution)
+        try:
+            async for event in events:
+                event_as_string = str(event)
+                yield {"type": "dispatch_update", "data": {"status": "orchestrator_exec_update", "message": f"RAW AGENT EVENT: {event_as_string}"}}
+                execution_summary += event_as_string + "\n"
+                if _is_final_agent_event(event):
+                    break
+        finally:
+            await events.aclose()
+        yield _execution_result(execution_summary)
     except Exception as e:
-        error_details = traceback.format_exc()
-        print(f"fleet_advisor_agent_logic: Error calling remote Orchestrator (execution): {e}\n{error_details}")
-        yield {"type": "thought", "data": f"Error calling remote Orchestrator agent for dispatch execution: {e}"}
-        yield {"type": "error", "data": {"message": f"Error interacting with Orchestrator Agent for execution: {str(e)}", "code": "ORCHESTRATOR_EXEC_FAIL", "raw_output": error_details}}
\ No newline at end of file
+        for event in _execution_failure_events(e):
+            yield event
@@ -1,41 +1,50 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, Response, stream_with_context, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, Response, stream_with_context, current_app, jsonify
 import json
 import traceback
 from datetime import datetime, timezone
 import uuid
 
 from fleet_advisor_agent_logic import call_dispatch_agent_for_recommendation, execute_dispatch_assignment
+from read_cache import register_cache
+from spanner_data import STALE_READ_CONSISTENCY, staleness_bound_seconds
 
 
 
 fleet_advisor_bp = Blueprint('fleet_advisor', __name__, template_folder='templates')
 
+# DISTINCT category/make scans over Equipment; only new equipment can change them.
+# Read with bounded staleness, so a reload within that bound of a write only lives until it passes.
+advisor_form_cache = register_cache(
+    "advisor_form_reference",
+    max_entries=4,
+    depends_on={"Equipment": ("category", "make")},
+    settle_seconds=staleness_bound_seconds(STALE_READ_CONSISTENCY),
+)
+
+def _distinct_equipment_values(column):
+    from spanner_data import run_query as main_app_run_query
+    sql = f"SELECT DISTINCT {column} FROM Equipment WHERE {column} IS NOT NULL ORDER BY {column}"
+    result = main_app_run_query(sql=sql, expected_fields=[column], consistency=STALE_READ_CONSISTENCY)
+    return [row[column] for row in result] if result is not None else None
+
 def get_form_data_for_advisor_page():
     equipment_categories = []
     equipment_makes = []
     try:
-        from app import db as current_main_app_db, run_query as main_app_run_query
+        from spanner_data import get_database
 
+        current_main_app_db = get_database()
         if not current_main_app_db:
             current_app.logger.error("Error in get_form_data_for_advisor_page: main_app_db is not available.")
             return {"categories": [], "makes": []}
 
-        cat_sql = "SELECT DISTINCT category FROM Equipment WHERE category IS NOT NULL ORDER BY category"
-        cat_fields = ["category"]
-        categories_result = main_app_run_query(sql=cat_sql, expected_fields=cat_fields)
-        if categories_result:
-            equipment_categories = [row['category'] for row in categories_result]
-
-        make_sql = "SELECT DISTINCT make FROM Equipment WHERE make IS NOT NULL ORDER BY make"
-        make_fields = ["make"]
-        makes_result = main_app_run_query(sql=make_sql, expected_fields=make_fields)
-        if makes_result:
-            equipment_makes = [row['make'] for row in makes_result]
+        equipment_categories = advisor_form_cache.get_or_load("category", lambda: _distinct_equipment_values("category")) or []
+        equipment_makes = advisor_form_cache.get_or_load("make", lambda: _distinct_equipment_values("make")) or []
 
         return {"categories": equipment_categories, "makes": equipment_makes}
 
     except ImportError:
-        current_app.logger.error("ERROR in get_form_data_for_advisor_page: Could not import db or run_query from app.py.", exc_info=True)
+        current_app.logger.error("ERROR in get_form_data_for_advisor_page: Could not import get_database or run_query from spanner_data.", exc_info=True)
         return {"categories": [], "makes": []}
     except Exception as e:
         current_app.logger.error(f"Error fetching form data in fleet_advisor_routes: {e}", exc_info=True)
@@ -81,10 +90,32 @@ def submit_dispatch_request():
         return redirect(url_for('fleet_advisor.dispatch_advisor_review_page'))
     return redirect(url_for('fleet_advisor.dispatch_advisor_form_page'))
 
+@fleet_advisor_bp.route('/api/dispatch-advisor/candidates', methods=['GET'])
+def ranked_dispatch_candidates():
+    """Top-k ranked units (with per-factor breakdown) for ?category=&make=&location=&job_date=&duration_days=&k=."""
+    from candidate_ranking import rank_candidates, parse_weights, WEIGHTS
+    equipment_category = request.args.get('category')
+    if not equipment_category:
+        return jsonify({"error": "Missing required parameter: category"}), 400
+    try:
+        k = max(1, min(request.args.get('k', type=int, default=5), 100))
+        weights = parse_weights(request.args['weights'], base=WEIGHTS) if request.args.get('weights') else None
+        candidates = rank_candidates(equipment_category, request.args.get('make') or None,
+                                     job_location=request.args.get('location'), job_date=request.args.get('job_date'),
+                                     duration_days=request.args.get('duration_days', type=int, default=1), k=k, weights=weights)
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except ConnectionError:
+        return jsonify({"error": "Database connection unavailable"}), 503
+    if candidates is None:
+        return jsonify({"error": "Failed to load candidates"}), 500
+    return jsonify({"candidates": candidates}), 200
+
 @fleet_advisor_bp.route('/dispatch-advisor/stream-recommendation')
 def stream_dispatch_recommendation():
     try:
-        from app import db
+        from spanner_data import get_database
+        db = get_database()
     except ImportError:
         db = None
     print("WARNING in fleet_advisor_routes: Could not import main_app_db from app.py at module level.")
@@ -225,7 +256,8 @@ def dispatch_advisor_post_status_page():
 @fleet_advisor_bp.route('/dispatch-advisor/stream-post-status')
 def stream_dispatch_post_status():
     try:
-        from app import db
+        from spanner_data import get_database
+        db = get_database()
     except ImportError:
         db = None
 
@@ -0,0 +1,443 @@
+# fleet_summary.py - In-memory fleet overview aggregates
+#
+# Built once from Spanner (a narrow stream of Equipment plus a GROUP BY over
+# MaintenanceJob), then kept current by the app's write paths calling the on_* hooks
+# after their commits, and by the process change feed (change_feed.py) for writes made
+# by other workers or tools. Serving /api/fleet/summary is a dictionary read; no
+# request scans a table.
+#
+# The aggregates are also rebuilt in the background every FLEET_SUMMARY_REBUILD_SECONDS
+# (the only way other writers are seen when the feed is off). Events recorded while a
+# rebuild runs are replayed onto the new state before it is swapped in. Unit events are
+# idempotent; maintenance jobs are counted once per job_id, and jobs the spend query
+# already included (committed before its cutoff) are skipped on replay and on late
+# delivery by the feed.
+#
+# Service-location occupancy (units per location against capacity) is the part the
+# dispatch advisor depends on, so it is also reconciled on its own, cheaper schedule
+# (OCCUPANCY_RECONCILE_SECONDS) from the EquipmentByCurrentServiceLocation index.
+
+import os
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import datetime, timezone
+
+from google.cloud.spanner_v1 import param_types
+
+from change_feed import change_feed
+from spanner_data import stream_query, run_query
+
+REBUILD_SECONDS = float(os.environ.get("FLEET_SUMMARY_REBUILD_SECONDS", "900"))
+OCCUPANCY_RECONCILE_SECONDS = float(os.environ.get("OCCUPANCY_RECONCILE_SECONDS", "120"))
+TOP_N = int(os.environ.get("FLEET_SUMMARY_TOP_N", "25"))
+
+UNASSIGNED = "unassigned"
+_UNSET = object()
+
+
+def _month(value):
+    if value is None:
+        value = datetime.now(timezone.utc)
+    return value.strftime("%Y-%m")
+
+
+class _SummaryState:
+    """One generation of aggregates. Mutated only under FleetSummary._lock."""
+
+    def __init__(self):
+        self.units = {}  # equipment_id -> {"category", "make", "city", "location_id", "customer_id"}
+        self.by_category = Counter()
+        self.by_make = Counter()
+        self.by_city = Counter()
+        self.by_location = Counter()
+        self.locations = {}  # location_id -> {"name", "city", "capacity"}
+        self.customer_names = {}
+        self.spend = {}  # (customer_id, "YYYY-MM") -> [total_cost, job_count]
+        self.counted_before = None  # the spend query counted every job committed before this
+        self.job_ids = set()  # jobs added since (or known to be in) the spend query
+        self.built_at = None
+
+    def _count(self, unit, delta):
+        for counter, key in ((self.by_category, unit["category"]), (self.by_make, unit["make"]),
+                             (self.by_city, unit["city"]), (self.by_location, unit["location_id"])):
+            if key is None:
+                continue
+            counter[key] += delta
+            if counter[key] <= 0:
+                del counter[key]
+
+    def put_unit(self, equipment_id, unit):
+        previous = self.units.get(equipment_id)
+        if previous is not None:
+            self._count(previous, -1)
+        self.units[equipment_id] = unit
+        self._count(unit, +1)
+
+    def add_unit(self, equipment_id, unit):
+        """put_unit for a unit not seen yet; a repeated INSERT event must not undo a later move."""
+        if equipment_id not in self.units:
+            self.put_unit(equipment_id, unit)
+
+    def move_unit(self, equipment_id, city=_UNSET, location_id=_UNSET):
+        unit = self.units.get(equipment_id)
+        if unit is None:
+            return
+        moved = dict(unit)
+        if city is not _UNSET:
+            moved["city"] = city
+        if location_id is not _UNSET:
+            moved["location_id"] = location_id
+        self.put_unit(equipment_id, moved)
+
+    def add_spend(self, customer_id, month, cost, jobs=1):
+        entry = self.spend.setdefault((customer_id or UNASSIGNED, month), [0.0, 0])
+        entry[0] += float(cost or 0.0)
+        entry[1] += jobs
+
+    def add_job(self, job_id, equipment_id, cost, job_date, committed_at=None):
+        if job_id in self.job_ids:
+            return
+        if committed_at is not None and self.counted_before is not None and committed_at < self.counted_before:
+            return
+        self.job_ids.add(job_id)
+        unit = self.units.get(equipment_id)
+        self.add_spend(unit["customer_id"] if unit else None, _month(job_date), cost)
+
+
+def _occupancy_rows(locations, by_location):
+    rows = []
+    for location_id, location in locations.items():
+        units = by_location.get(location_id, 0)
+        capacity = location["capacity"]
+        rows.append({
+            "location_id": location_id, "name": location["name"], "city": location["city"],
+            "units": units, "capacity": capacity,
+            "utilization": round(units / capacity, 3) if capacity else None,
+            "over_capacity": bool(capacity) and units > capacity,
+        })
+    rows.sort(key=lambda row: (row["utilization"] is None, -(row["utilization"] or 0), row["name"] or ""))
+    return rows
+
+
+class FleetSummary:
+    """
+    Fleet-level aggregates: units per category/make/city, per service location against
+    its capacity, and maintenance spend per customer and month.
+    """
+
+    def __init__(self, rebuild_seconds=REBUILD_SECONDS, reconcile_seconds=OCCUPANCY_RECONCILE_SECONDS, feed=None):
+        self.rebuild_seconds = rebuild_seconds
+        self.reconcile_seconds = reconcile_seconds
+        self._state = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._pending_events = None  # list while a rebuild is in progress
+        self._pending_job_ids = None  # job_ids the local hooks reported meanwhile
+        self._threads = {}
+        self.rebuilds = 0
+        self.reconciles = 0
+        self.reconciled_moves = 0
+        self.feed_events = 0
+        if feed is not None:
+            feed.subscribe(self.apply_change, tables=("Equipment", "MaintenanceJob"))
+
+    # --- Building ---
+    def ensure_built(self):
+        """Builds the aggregates on first use. Returns False if the build failed."""
+        if self._state is None:
+            with self._build_lock:
+                if self._state is None:
+                    self._rebuild_locked()
+        self._ensure_rebuilder()
+        return self._state is not None
+
+    def build_in_background(self):
+        """Starts the first build on its own thread (once); returns immediately."""
+        if self._state is not None:
+            return
+        with self._lock:
+            thread = self._threads.get("fleet-summary-build")
+            if thread is not None and thread.is_alive():
+                return
+            thread = threading.Thread(target=self.ensure_built, name="fleet-summary-build", daemon=True)
+            self._threads["fleet-summary-build"] = thread
+            thread.start()
+
+    def rebuild(self):
+        """Recomputes every aggregate from Spanner and swaps the result in."""
+        with self._build_lock:
+            return self._rebuild_locked()
+
+    def _rebuild_locked(self):
+        started_at = time.time()
+        with self._lock:
+            self._pending_events = []
+            self._pending_job_ids = []
+        try:
+            state = self._load_state()
+            self._mark_counted_jobs(state)
+        except Exception as e:
+            print(f"fleet_summary: Rebuild failed: {e}")
+            traceback.print_exc()
+            with self._lock:
+                self._pending_events = None
+                self._pending_job_ids = None
+            return False
+        with self._lock:
+            # Writes committed while the load ran may be missing from it; apply them again.
+            # add_job skips the jobs _mark_counted_jobs found in the spend query.
+            for apply in self._pending_events:
+                apply(state)
+            self._pending_events = None
+            self._pending_job_ids = None
+            self._state = state
+            self.rebuilds += 1
+        print(f"fleet_summary: Rebuilt from {len(state.units)} units in {(time.time() - started_at) * 1000:.0f} ms.")
+        return True
+
+    def _load_state(self):
+        state = _SummaryState()
+        sql = "SELECT equipment_id, category, make, current_city, current_service_location_id, current_customer_id FROM Equipment"
+        fields = ["equipment_id", "category", "make", "current_city", "current_service_location_id", "current_customer_id"]
+        for equipment_id, category, make, city, location_id, customer_id in stream_query(sql, expected_fields=fields):
+            state.put_unit(equipment_id, {"category": category, "make": make, "city": city,
+                                          "location_id": location_id, "customer_id": customer_id})
+
+        locations = run_query("SELECT location_id, name, city, capacity FROM ServiceLocation",
+                              expected_fields=["location_id", "name", "city", "capacity"])
+        customers = run_query("SELECT customer_id, customer_name FROM Customer", expected_fields=["customer_id", "customer_name"])
+        # A fixed cutoff tells which jobs the GROUP BY counted, independent of when it reads.
+        now = run_query("SELECT CURRENT_TIMESTAMP() AS now", expected_fields=["now"])
+        if not now:
+            raise RuntimeError("could not read the spend cutoff")
+        state.counted_before = now[0]["now"]
+        spend = run_query("""
+            SELECT eq.current_customer_id AS customer_id,
+                   FORMAT_TIMESTAMP('%Y-%m', COALESCE(mj.job_date, mj.create_time), 'UTC') AS month,
+                   SUM(mj.cost) AS total_cost, COUNT(*) AS job_count
+            FROM MaintenanceJob AS mj
+            JOIN Equipment AS eq ON eq.equipment_id = mj.equipment_id
+            WHERE mj.create_time < @counted_before
+            GROUP BY customer_id, month
+        """, params={"counted_before": state.counted_before}, param_types_map={"counted_before": param_types.TIMESTAMP},
+            expected_fields=["customer_id", "month", "total_cost", "job_count"])
+        if locations is None or customers is None or spend is None:
+            raise RuntimeError("one of the summary queries failed")
+
+        state.locations = {row["location_id"]: {"name": row["name"], "city": row["city"], "capacity": row["capacity"]}
+                           for row in locations}
+        state.customer_names = {row["customer_id"]: row["customer_name"] for row in customers}
+        for row in spend:
+            state.add_spend(row["customer_id"], row["month"], row["total_cost"], jobs=row["job_count"])
+        state.built_at = datetime.now(timezone.utc)
+        return state
+
+    def _mark_counted_jobs(self, state):
+        """Adds the jobs reported during the load that the spend query counted to state.job_ids."""
+        with self._lock:
+            job_ids = list(self._pending_job_ids)
+        if not job_ids:
+            return
+        rows = run_query(
+            "SELECT job_id FROM MaintenanceJob WHERE job_id IN UNNEST(@job_ids) AND create_time < @counted_before",
+            params={"job_ids": job_ids, "counted_before": state.counted_before},
+            param_types_map={"job_ids": param_types.Array(param_types.STRING), "counted_before": param_types.TIMESTAMP},
+            expected_fields=["job_id"])
+        if rows is None:
+            raise RuntimeError("the counted-jobs query failed")
+        state.job_ids.update(row["job_id"] for row in rows)
+
+    def _ensure_rebuilder(self):
+        self._ensure_periodic("fleet-summary-rebuild", self.rebuild_seconds, self.rebuild)
+        self._ensure_periodic("occupancy-reconcile", self.reconcile_seconds, self.reconcile_occupancy)
+
+    def _ensure_periodic(self, name, interval, task):
+        if interval <= 0:
+            return
+        with self._lock:
+            thread = self._threads.get(name)
+            if thread is not None and thread.is_alive():
+                return
+            thread = threading.Thread(target=self._run_periodically, args=(interval, task), name=name, daemon=True)
+            self._threads[name] = thread
+            thread.start()
+
+    @staticmethod
+    def _run_periodically(interval, task):
+        while True:
+            time.sleep(interval)
+            try:
+                task()
+            except Exception as e:
+                print(f"fleet_summary: Periodic task {task.__name__} failed: {e}")
+                traceback.print_exc()
+
+    def reconcile_occupancy(self):
+        """
+        Re-reads every unit's service location (and the locations' capacities) and corrects
+        the occupancy counters, e.g. for moves made by other workers. Returns the number of
+        corrected units, or None if the read failed.
+        """
+        if self._state is None:
+            return None
+        sql = """
+            SELECT equipment_id, current_service_location_id
+            FROM Equipment@{FORCE_INDEX=EquipmentByCurrentServiceLocation}
+            WHERE current_service_location_id IS NOT NULL
+        """
+        try:
+            placed = dict(stream_query(sql, expected_fields=["equipment_id", "current_service_location_id"]))
+        except Exception as e:
+            print(f"fleet_summary: Occupancy reconcile failed: {e}")
+            return None
+        locations = run_query("SELECT location_id, name, city, capacity FROM ServiceLocation",
+                              expected_fields=["location_id", "name", "city", "capacity"])
+        if locations is None:
+            return None
+
+        moved = 0
+        with self._lock:
+            state = self._state
+            for equipment_id, unit in list(state.units.items()):
+                location_id = placed.get(equipment_id)
+                if unit["location_id"] != location_id:
+                    state.move_unit(equipment_id, location_id=location_id)
+                    moved += 1
+            state.locations = {row["location_id"]: {"name": row["name"], "city": row["city"], "capacity": row["capacity"]}
+                               for row in locations}
+            self.reconciles += 1
+            self.reconciled_moves += moved
+        if moved:
+            print(f"fleet_summary: Occupancy reconcile corrected {moved} units.")
+        return moved
+
+    # --- Write-path hooks (call after the commit succeeded) ---
+    def _apply(self, apply, job_ids=()):
+        with self._lock:
+            if self._state is not None:
+                apply(self._state)
+            if self._pending_events is not None:
+                self._pending_events.append(apply)
+                self._pending_job_ids.extend(job_ids)
+
+    def on_equipment_added(self, equipment_id, category=None, make=None, city=None, location_id=None, customer_id=None):
+        unit = {"category": category, "make": make, "city": city, "location_id": location_id, "customer_id": customer_id}
+        self._apply(lambda state: state.put_unit(equipment_id, unit))
+
+    def on_equipment_moved(self, equipment_id, city=_UNSET, location_id=_UNSET):
+        """Records a location change; leave an argument out if that column wasn't written."""
+        self._apply(lambda state: state.move_unit(equipment_id, city=city, location_id=location_id))
+
+    def on_maintenance_jobs_added(self, jobs):
+        """
+        Args:
+            jobs (list[tuple]): (job_id, equipment_id, cost, job_date) per committed job.
+        """
+        jobs = list(jobs)
+        def apply(state):
+            for job_id, equipment_id, cost, job_date in jobs:
+                state.add_job(job_id, equipment_id, cost, job_date)
+        self._apply(apply, job_ids=[job[0] for job in jobs])
+
+    def apply_change(self, event):
+        """Change-feed subscriber: folds in Equipment and MaintenanceJob rows written by any worker or tool."""
+        table, mod_type, values = event["table"], event["mod_type"], event["values"]
+        if table == "Equipment":
+            equipment_id = event["keys"].get("equipment_id")
+            if mod_type == "INSERT" and values.get("category"):
+                unit = {"category": values["category"], "make": values.get("make"), "city": values.get("current_city"),
+                        "location_id": values.get("current_service_location_id"),
+                        "customer_id": values.get("current_customer_id")}
+                self._apply(lambda state: state.add_unit(equipment_id, unit))
+            elif mod_type == "UPDATE":
+                moved = {field: values[column] for field, column in
+                         (("city", "current_city"), ("location_id", "current_service_location_id")) if column in values}
+                if not moved:
+                    return
+                self._apply(lambda state: state.move_unit(equipment_id, **moved))
+            else:
+                return
+        elif table == "MaintenanceJob" and mod_type == "INSERT" and values.get("equipment_id"):
+            job_id, committed_at = event["keys"].get("job_id"), event["commit_timestamp"]
+            self._apply(lambda state: state.add_job(job_id, values["equipment_id"], values.get("cost"), values.get("job_date"),
+                                                    committed_at=committed_at))
+        else:
+            return
+        with self._lock:
+            self.feed_events += 1
+
+    # --- Reading ---
+    def summary(self, top_n=TOP_N):
+        """
+        Returns the aggregates as a JSON-ready dict, or None if they couldn't be built.
+        """
+        if not self.ensure_built():
+            return None
+        with self._lock:
+            state = self._state
+            by_location = dict(state.by_location)
+            locations = dict(state.locations)
+            spend = {key: tuple(value) for key, value in state.spend.items()}
+            result = {
+                "built_at": state.built_at.isoformat() if state.built_at else None,
+                "total_units": len(state.units),
+                "units_by_category": dict(state.by_category.most_common()),
+                "units_by_make": dict(state.by_make.most_common(top_n)),
+                "units_by_city": dict(state.by_city.most_common(top_n)),
+            }
+            customer_names = dict(state.customer_names)
+
+        result["service_locations"] = _occupancy_rows(locations, by_location)
+
+        by_customer = {}
+        for (customer_id, month), (total_cost, job_count) in spend.items():
+            entry = by_customer.setdefault(customer_id, {
+                "customer_id": customer_id, "customer_name": customer_names.get(customer_id),
+                "total_cost": 0.0, "job_count": 0, "months": {},
+            })
+            entry["total_cost"] += total_cost
+            entry["job_count"] += job_count
+            entry["months"][month] = {"total_cost": round(total_cost, 2), "job_count": job_count}
+        customers = sorted(by_customer.values(), key=lambda entry: -entry["total_cost"])[:top_n]
+        for entry in customers:
+            entry["total_cost"] = round(entry["total_cost"], 2)
+            entry["months"] = dict(sorted(entry["months"].items()))
+        result["maintenance_spend_by_customer"] = customers
+        return result
+
+    def occupancy(self):
+        """
+        Returns units vs. capacity for every service location, fullest first, or None until
+        the aggregates are built. Never builds on the caller's thread: a first call starts
+        the build in the background instead.
+        """
+        if self._state is None:
+            self.build_in_background()
+            return None
+        with self._lock:
+            return _occupancy_rows(dict(self._state.locations), dict(self._state.by_location))
+
+    def over_capacity_location_ids(self):
+        """Service locations holding more units than their capacity (empty until built)."""
+        return [row["location_id"] for row in self.occupancy() or [] if row["over_capacity"]]
+
+    def stats(self):
+        with self._lock:
+            state = self._state
+            return {
+                "built": state is not None,
+                "built_at": state.built_at.isoformat() if state and state.built_at else None,
+                "units": len(state.units) if state else 0,
+                "rebuilds": self.rebuilds,
+                "rebuild_seconds": self.rebuild_seconds,
+                "occupancy_reconciles": self.reconciles,
+                "occupancy_reconciled_moves": self.reconciled_moves,
+                "occupancy_reconcile_seconds": self.reconcile_seconds,
+                "feed_events": self.feed_events,
+            }
+
+
+# Process-wide summary, built on first use.
+fleet_summary = FleetSummary(feed=change_feed)
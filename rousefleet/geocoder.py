@@ -0,0 +1,258 @@
+# geocoder.py - Offline geocoder for free-text job locations
+#
+# Turns strings like "Houston, TX", "houston texas", "M5V 2N1", "Ft. Worth" or
+# "43.65, -79.38" into coordinates without calling an external maps API. Places come
+# from the bundled gazetteer (gazetteer.csv: city, state/province, country, coordinates
+# and postal prefixes) and are extended at worker start with every ServiceLocation row,
+# so a yard's exact postal code, its city and its name ("Toronto Central Depot") all
+# resolve. Results, including misses, are memoized in a bounded LRU keyed by the
+# normalized text (by the parsed latitude and longitude for coordinates).
+#
+#   GEOCODER_GAZETTEER   path of the gazetteer CSV (default: gazetteer.csv next to this file)
+#   GEOCODER_MEMO_SIZE   normalized queries remembered (default 4096)
+
+import csv
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+try:
+    from . import spanner_data  # staged inside the fleet_analyzer package
+except ImportError:
+    import spanner_data
+
+GAZETTEER_PATH = os.environ.get("GEOCODER_GAZETTEER", os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.csv"))
+MEMO_SIZE = int(os.environ.get("GEOCODER_MEMO_SIZE", "4096"))
+
+STATE_CODES = {
+    "alabama": "al", "alaska": "ak", "arizona": "az", "arkansas": "ar", "california": "ca", "colorado": "co",
+    "connecticut": "ct", "delaware": "de", "district of columbia": "dc", "florida": "fl", "georgia": "ga",
+    "hawaii": "hi", "idaho": "id", "illinois": "il", "indiana": "in", "iowa": "ia", "kansas": "ks",
+    "kentucky": "ky", "louisiana": "la", "maine": "me", "maryland": "md", "massachusetts": "ma",
+    "michigan": "mi", "minnesota": "mn", "mississippi": "ms", "missouri": "mo", "montana": "mt",
+    "nebraska": "ne", "nevada": "nv", "new hampshire": "nh", "new jersey": "nj", "new mexico": "nm",
+    "new york": "ny", "north carolina": "nc", "north dakota": "nd", "ohio": "oh", "oklahoma": "ok",
+    "oregon": "or", "pennsylvania": "pa", "rhode island": "ri", "south carolina": "sc", "south dakota": "sd",
+    "tennessee": "tn", "texas": "tx", "utah": "ut", "vermont": "vt", "virginia": "va", "washington": "wa",
+    "west virginia": "wv", "wisconsin": "wi", "wyoming": "wy",
+    "alberta": "ab", "british columbia": "bc", "manitoba": "mb", "new brunswick": "nb",
+    "newfoundland and labrador": "nl", "nova scotia": "ns", "ontario": "on", "prince edward island": "pe",
+    "quebec": "qc", "saskatchewan": "sk",
+}
+COUNTRY_WORDS = {"usa", "us", "united states", "united states of america", "america", "canada"}
+# Leading-word abbreviations in city names ("St. Louis", "Ft Worth", "Mt. Vernon").
+CITY_PREFIXES = {"st": "saint", "ste": "sainte", "ft": "fort", "mt": "mount"}
+
+_US_ZIP = re.compile(r"\b(\d{5})(?:-\d{4})?\b")
+_CA_POSTAL = re.compile(r"\b([a-z]\d[a-z])\s?(\d[a-z]\d)\b")
+_COORDINATES = re.compile(r"^\s*(-?\d{1,2}(?:\.\d+)?)\s*[, ]\s*(-?\d{1,3}(?:\.\d+)?)\s*$")
+
+
+def _fold(text):
+    """Lowercases, strips accents and punctuation (except commas) and collapses whitespace."""
+    text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode("ascii").casefold()
+    text = re.sub(r"[^a-z0-9, ]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _memo_key(text):
+    """The folded text, or the parsed (lat, lon) for coordinates: folding drops their signs and dots."""
+    match = _COORDINATES.match(str(text))
+    if match:
+        return ("coordinates", float(match.group(1)), float(match.group(2)))
+    return _fold(text)
+
+
+def normalize_city(city):
+    words = _fold(city).replace(",", " ").split()
+    if words and words[0] in CITY_PREFIXES:
+        words[0] = CITY_PREFIXES[words[0]]
+    return " ".join(words)
+
+
+def normalize_state(state):
+    folded = _fold(state).replace(",", " ").strip()
+    return STATE_CODES.get(folded, folded)
+
+
+def normalize_postal(postal):
+    """"M5V 2N1" -> "m5v2n1", "90001-1234" -> "90001"; None if it isn't a US or Canadian code."""
+    folded = _fold(postal)
+    match = _CA_POSTAL.search(folded)
+    if match:
+        return match.group(1) + match.group(2)
+    match = _US_ZIP.search(folded)
+    return match.group(1) if match else None
+
+
+class Geocoder:
+    """
+    Offline geocoder over the bundled gazetteer plus ServiceLocation rows.
+
+    Args:
+        gazetteer_path (str): CSV with city, state_province, country, latitude, longitude, postal_prefixes.
+        memo_size (int): Bound on memoized queries (least recently used dropped first).
+    """
+
+    def __init__(self, gazetteer_path=GAZETTEER_PATH, memo_size=MEMO_SIZE):
+        self.memo_size = max(1, memo_size)
+        self._by_city_state = {}  # (city, state) -> place
+        self._by_city = {}        # city -> [place, ...]
+        self._by_postal = {}      # exact postal code -> place
+        self._by_prefix = {}      # postal prefix -> place
+        self._by_name = {}        # normalized ServiceLocation name -> place
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self.locations_loaded = False
+        self.hits = 0
+        self.misses = 0
+        self._load_gazetteer(gazetteer_path)
+
+    # --- Loading ---
+    def _load_gazetteer(self, path):
+        try:
+            with open(path, newline="", encoding="utf-8") as f:
+                for row in csv.DictReader(f):
+                    place = self._place(row["city"], row["state_province"], row["country"], row["latitude"], row["longitude"], "gazetteer")
+                    self._add_place(place)
+                    for prefix in (row.get("postal_prefixes") or "").split():
+                        self._by_prefix[prefix.casefold()] = place
+        except (OSError, KeyError, ValueError) as e:
+            print(f"geocoder: Could not load gazetteer {path}: {e}")
+            return
+        print(f"geocoder: Loaded {len(self._by_city_state)} gazetteer places from {path}.")
+
+    @staticmethod
+    def _place(city, state, country, latitude, longitude, source):
+        return {"city": city, "state_province": state, "country": country,
+                "latitude": float(latitude), "longitude": float(longitude), "source": source}
+
+    def _add_place(self, place):
+        """Indexes a place by city and state, unless an earlier source already has that city/state."""
+        key = (normalize_city(place["city"]), normalize_state(place["state_province"] or ""))
+        if key in self._by_city_state:
+            return
+        self._by_city_state[key] = place
+        same_city = [p for p in self._by_city.get(key[0], []) if normalize_state(p["state_province"] or "") != key[1]]
+        self._by_city[key[0]] = same_city + [place]
+
+    def load_service_locations(self):
+        """
+        Adds every ServiceLocation with coordinates: its exact postal code, its name and
+        (when the gazetteer doesn't know it) its city.
+
+        Returns:
+            int | None: Number of locations added, or None if the query failed.
+        """
+        sql = """
+            SELECT name, city, state_province, postal_code, country, latitude, longitude
+            FROM ServiceLocation
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        """
+        rows = spanner_data.run_query(sql, expected_fields=["name", "city", "state_province", "postal_code", "country", "latitude", "longitude"])
+        if rows is None:
+            return None
+        with self._lock:
+            for row in rows:
+                place = self._place(row["city"], row["state_province"], row["country"], row["latitude"], row["longitude"], "service_location")
+                if row["city"]:
+                    self._add_place(place)
+                postal = normalize_postal(row["postal_code"] or "")
+                if postal:
+                    self._by_postal[postal] = place
+                if row["name"]:
+                    self._by_name[normalize_city(row["name"])] = place
+            self._memo.clear()  # cached misses may resolve now
+            self.locations_loaded = True
+        print(f"geocoder: Added {len(rows)} service locations.")
+        return len(rows)
+
+    # --- Lookup ---
+    def geocode(self, text):
+        """
+        Resolves a free-text location.
+
+        Returns:
+            dict | None: {latitude, longitude, city, state_province, country, source, matched_by},
+            or None if nothing matched.
+        """
+        if not text or not str(text).strip():
+            return None
+        key = _memo_key(text)
+        with self._lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                self.hits += 1
+                return self._memo[key]
+            self.misses += 1
+            result = self._resolve(text, _fold(text))
+            self._memo[key] = result
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return result
+
+    def _resolve(self, raw, folded):
+        match = _COORDINATES.match(str(raw))
+        if match:
+            lat, lon = float(match.group(1)), float(match.group(2))
+            if -90 <= lat <= 90 and -180 <= lon <= 180:
+                return {"latitude": lat, "longitude": lon, "city": None, "state_province": None,
+                        "country": None, "source": "coordinates", "matched_by": "coordinates"}
+
+        postal = normalize_postal(folded)
+        if postal and postal in self._by_postal:
+            return self._matched(self._by_postal[postal], "postal_code")
+
+        name_place = self._by_name.get(normalize_city(folded))
+        if name_place:
+            return self._matched(name_place, "location_name")
+
+        # "City, ST[, Country]" or "City State": try the longest city/state split that is known.
+        parts = [part.strip() for part in folded.split(",") if part.strip() and part.strip() not in COUNTRY_WORDS]
+        parts = [_CA_POSTAL.sub("", _US_ZIP.sub("", part)).strip() for part in parts]
+        parts = [part for part in parts if part]
+        if len(parts) >= 2:
+            place = self._by_city_state.get((normalize_city(parts[0]), normalize_state(parts[1])))
+            if place:
+                return self._matched(place, "city_state")
+        words = " ".join(parts).split()
+        for split in range(len(words) - 1, 0, -1):
+            place = self._by_city_state.get((normalize_city(" ".join(words[:split])), normalize_state(" ".join(words[split:]))))
+            if place:
+                return self._matched(place, "city_state")
+        for candidate in ([parts[0]] if parts else []) + [" ".join(words)]:
+            places = self._by_city.get(normalize_city(candidate))
+            if places:
+                # Ambiguous city names (e.g. Portland) go to the gazetteer's first entry.
+                return self._matched(places[0], "city")
+        # Postal prefixes last: a five-digit street number can look like a ZIP code.
+        if postal:
+            for length in range(len(postal) - 1, 0, -1):
+                place = self._by_prefix.get(postal[:length])
+                if place:
+                    return self._matched(place, "postal_prefix")
+        return None
+
+    @staticmethod
+    def _matched(place, matched_by):
+        return dict(place, matched_by=matched_by)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "places": len(self._by_city_state),
+                "postal_codes": len(self._by_postal),
+                "postal_prefixes": len(self._by_prefix),
+                "location_names": len(self._by_name),
+                "locations_loaded": self.locations_loaded,
+                "memo_entries": len(self._memo),
+                "memo_size": self.memo_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# Process-wide geocoder shared by every caller.
+geocoder = Geocoder()
@@ -0,0 +1,692 @@
+# graph_engine.py - In-process FleetGraph for multi-hop traversals
+#
+# Holds the FleetGraph property graph (setup.py: Equipment, ServiceLocation, Customer
+# and MaintenanceJob nodes; PerformedOnEquipment, LocatedAtServiceDepot and the two
+# CustomerEquipmentAssignment edge tables) in memory. Every node gets a dense integer
+# id per label; each edge direction is a CSR pair (indptr, indices) of NumPy int arrays,
+# so "jobs of this unit" or "units at this depot" is an array slice:
+#
+#   location -> equipment      LocatedAtServiceDepot, reversed
+#   equipment -> jobs          PerformedOnEquipment, reversed, newest job first
+#   customer -> assignments    OperatesEquipment (one edge per assignment row)
+#   equipment -> assignments   EquipmentOperatedBy
+#
+# While the process change feed (change_feed.py) runs from a source that sees every
+# writer (change_feed.complete), the engine follows it: each Equipment, MaintenanceJob
+# and CustomerEquipmentAssignment event is applied as it arrives, and the timed poll
+# below is skipped. The feed doesn't carry ServiceLocation or Customer, so an event
+# naming a node the graph doesn't have asks for one poll, and the full reload picks up
+# renames.
+#
+# Without the feed, refreshes are incremental polls: every table carries commit timestamps
+# (create_time, plus last_update_time on the updatable ones), so each poll reads only rows
+# committed after the newest timestamp already applied. The poll is a strong read, which
+# sees every commit up to its read timestamp, so no row can slip in behind the watermark. New edges
+# go to small per-node delta lists that queries merge in, and the CSR arrays are
+# rebuilt once GRAPH_ENGINE_COMPACT_THRESHOLD deltas have built up: on a copy of the
+# graph, off the lock, which is then swapped in like a fresh load. Rows are never
+# deleted by the app; a full reload every GRAPH_ENGINE_FULL_RELOAD_SECONDS drops any
+# removed elsewhere.
+#
+#   GRAPH_ENGINE_REFRESH_SECONDS       incremental poll interval when the engine isn't following the feed
+#                                      (default 15; each poll scans the commit-timestamp columns,
+#                                      which are not indexed)
+#   GRAPH_ENGINE_FULL_RELOAD_SECONDS   full reload interval (default 900)
+#   GRAPH_ENGINE_COMPACT_THRESHOLD     delta entries tolerated before the CSR is rebuilt (default 1024)
+
+import os
+import threading
+import time
+import traceback
+from datetime import datetime
+
+import numpy as np
+from google.cloud.spanner_v1 import param_types
+
+from spanner_data import run_queries_batch
+from change_feed import change_feed
+
+REFRESH_SECONDS = float(os.environ.get("GRAPH_ENGINE_REFRESH_SECONDS", "15"))
+FULL_RELOAD_SECONDS = float(os.environ.get("GRAPH_ENGINE_FULL_RELOAD_SECONDS", "900"))
+COMPACT_THRESHOLD = int(os.environ.get("GRAPH_ENGINE_COMPACT_THRESHOLD", "1024"))
+
+NO_NODE = -1
+
+# Per table: the columns read, and the commit-timestamp expression the watermark follows.
+_TABLES = {
+    "ServiceLocation": (["location_id", "name"], "COALESCE(last_update_time, create_time)"),
+    "Customer": (["customer_id", "customer_name", "industry_type"], "COALESCE(last_update_time, create_time)"),
+    "Equipment": (["equipment_id", "serial_number", "make", "model", "current_service_location_id"],
+                  "COALESCE(last_update_time, create_time)"),
+    "MaintenanceJob": (["job_id", "equipment_id", "job_date", "job_description", "service_type", "cost"], "create_time"),
+    "CustomerEquipmentAssignment": (["assignment_id", "customer_id", "equipment_id", "assignment_type",
+                                     "assignment_start_date", "assignment_end_date"], "create_time"),
+}
+
+
+class _Csr:
+    """Compressed sparse rows: the neighbours of node i are indices[indptr[i]:indptr[i + 1]]."""
+
+    def __init__(self, node_count, sources, targets, sort_key=None):
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        keep = sources >= 0
+        sources, targets = sources[keep], targets[keep]
+        order = np.lexsort((np.asarray(sort_key)[keep], sources)) if sort_key is not None else np.argsort(sources, kind="stable")
+        self.indices = targets[order].astype(np.int32)
+        self.indptr = np.zeros(node_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=node_count), out=self.indptr[1:])
+
+    def neighbors(self, node):
+        if node >= len(self.indptr) - 1:
+            return self.indices[:0]
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+
+class _Label:
+    """Dense integer ids and column-wise attributes for one node label."""
+
+    def __init__(self, key, fields):
+        self.key = key
+        self.index = {}  # key value -> node id
+        self.columns = {field: [] for field in fields}
+
+    def __len__(self):
+        return len(self.columns[self.key])
+
+    def upsert(self, row):
+        """Returns (node id, previous row values or None if new)."""
+        node = self.index.get(row[self.key])
+        if node is None:
+            node = self.index[row[self.key]] = len(self)
+            for field, values in self.columns.items():
+                values.append(row.get(field))
+            return node, None
+        previous = {field: values[node] for field, values in self.columns.items()}
+        for field, values in self.columns.items():
+            values[node] = row.get(field)
+        return node, previous
+
+    def get(self, node, field):
+        return self.columns[field][node]
+
+    def copy(self):
+        label = _Label(self.key, [])
+        label.index = dict(self.index)
+        label.columns = {field: list(values) for field, values in self.columns.items()}
+        return label
+
+
+def _job_sort_key(job_date):
+    # ORDER BY job_date DESC: newest first, undated jobs last.
+    return -job_date.timestamp() if isinstance(job_date, datetime) else float("inf")
+
+
+class _GraphState:
+    """One generation of the graph. Mutated only under FleetGraphEngine._lock."""
+
+    def __init__(self):
+        self.locations = _Label("location_id", ["location_id", "name"])
+        self.customers = _Label("customer_id", ["customer_id", "customer_name", "industry_type"])
+        self.equipment = _Label("equipment_id", ["equipment_id", "serial_number", "make", "model", "current_service_location_id"])
+        self.jobs = _Label("job_id", ["job_id", "equipment_id", "job_date", "job_description", "service_type", "cost"])
+        self.assignments = _Label("assignment_id", ["assignment_id", "customer_id", "equipment_id", "assignment_type",
+                                                     "assignment_start_date", "assignment_end_date"])
+        self.equipment_location = []  # equipment node -> location node (NO_NODE if none)
+        self.job_equipment = []       # job node -> equipment node
+        self.assignment_ends = []     # assignment node -> (customer node, equipment node)
+        self.locations_by_name = {}   # name -> [location node]
+        self.customers_by_name = {}   # customer_name -> [customer node]
+        self.watermarks = {table: None for table in _TABLES}
+        self._empty_csr()
+
+    def _empty_csr(self):
+        self.location_equipment = _Csr(0, [], [])
+        self.equipment_jobs = _Csr(0, [], [])
+        self.customer_assignments = _Csr(0, [], [])
+        self.equipment_assignments = _Csr(0, [], [])
+        # Changes since the CSR arrays were built.
+        self.moved_equipment = set()  # equipment nodes whose location changed (or that are new)
+        self.new_jobs = {}            # equipment node -> [job node]
+        self.new_customer_assignments = {}   # customer node -> [assignment node]
+        self.new_equipment_assignments = {}  # equipment node -> [assignment node]
+        self.delta_count = 0
+
+    # --- Applying rows ---
+    def apply(self, results, advance_watermarks=True):
+        """Upserts polled rows (parents before children) and advances the watermarks."""
+        for row in results["ServiceLocation"]:
+            node, previous = self.locations.upsert(row)
+            self._index_name(self.locations_by_name, node, row["name"], previous and previous["name"])
+        for row in results["Customer"]:
+            node, previous = self.customers.upsert(row)
+            self._index_name(self.customers_by_name, node, row["customer_name"], previous and previous["customer_name"])
+        for row in results["Equipment"]:
+            node, previous = self.equipment.upsert(row)
+            location = self.locations.index.get(row["current_service_location_id"], NO_NODE)
+            if previous is None:
+                self.equipment_location.append(location)
+            elif self.equipment_location[node] == location:
+                continue
+            else:
+                self.equipment_location[node] = location
+            self.moved_equipment.add(node)
+            self.delta_count += 1
+        for row in results["MaintenanceJob"]:
+            equipment = self.equipment.index.get(row["equipment_id"])
+            if equipment is None:
+                continue
+            node, previous = self.jobs.upsert(row)
+            if previous is not None:
+                continue  # jobs are insert-only; a re-read row keeps its edge
+            self.job_equipment.append(equipment)
+            self.new_jobs.setdefault(equipment, []).append(node)
+            self.delta_count += 1
+        for row in results["CustomerEquipmentAssignment"]:
+            customer = self.customers.index.get(row["customer_id"])
+            equipment = self.equipment.index.get(row["equipment_id"])
+            if customer is None or equipment is None:
+                continue
+            node, previous = self.assignments.upsert(row)
+            if previous is not None:
+                continue
+            self.assignment_ends.append((customer, equipment))
+            self.new_customer_assignments.setdefault(customer, []).append(node)
+            self.new_equipment_assignments.setdefault(equipment, []).append(node)
+            self.delta_count += 1
+        for table, rows in results.items():
+            if not advance_watermarks:
+                break
+            for row in rows:
+                if self.watermarks[table] is None or row["commit_version"] > self.watermarks[table]:
+                    self.watermarks[table] = row["commit_version"]
+
+    @staticmethod
+    def _index_name(by_name, node, name, previous_name):
+        if previous_name is not None and previous_name != name:
+            by_name[previous_name] = [other for other in by_name.get(previous_name, []) if other != node]
+        if node not in by_name.setdefault(name, []):
+            by_name[name].append(node)
+
+    def compact(self):
+        """Rebuilds every CSR from the node arrays and clears the deltas."""
+        equipment_count = len(self.equipment)
+        location_of = np.array(self.equipment_location, dtype=np.int64)
+        equipment_nodes = np.arange(equipment_count)
+        job_equipment = np.array(self.job_equipment, dtype=np.int64)
+        job_keys = np.array([_job_sort_key(job_date) for job_date in self.jobs.columns["job_date"]], dtype=float)
+        ends = np.array(self.assignment_ends, dtype=np.int64).reshape(-1, 2)
+        assignment_nodes = np.arange(len(ends))
+        self._empty_csr()
+        self.location_equipment = _Csr(len(self.locations), location_of, equipment_nodes)
+        self.equipment_jobs = _Csr(equipment_count, job_equipment, np.arange(len(job_equipment)), sort_key=job_keys)
+        self.customer_assignments = _Csr(len(self.customers), ends[:, 0], assignment_nodes)
+        self.equipment_assignments = _Csr(equipment_count, ends[:, 1], assignment_nodes)
+
+    def copy(self):
+        """A copy that shares only the CSR arrays (never mutated, only replaced)."""
+        state = _GraphState.__new__(_GraphState)
+        state.__dict__.update(self.__dict__)
+        for name in ("locations", "customers", "equipment", "jobs", "assignments"):
+            setattr(state, name, getattr(self, name).copy())
+        state.equipment_location = list(self.equipment_location)
+        state.job_equipment = list(self.job_equipment)
+        state.assignment_ends = list(self.assignment_ends)
+        state.locations_by_name = {name: list(nodes) for name, nodes in self.locations_by_name.items()}
+        state.customers_by_name = {name: list(nodes) for name, nodes in self.customers_by_name.items()}
+        state.watermarks = dict(self.watermarks)
+        state.moved_equipment = set(self.moved_equipment)
+        state.new_jobs = {node: list(jobs) for node, jobs in self.new_jobs.items()}
+        state.new_customer_assignments = {node: list(nodes) for node, nodes in self.new_customer_assignments.items()}
+        state.new_equipment_assignments = {node: list(nodes) for node, nodes in self.new_equipment_assignments.items()}
+        return state
+
+    # --- Traversal primitives (caller holds the lock) ---
+    def equipment_at(self, location):
+        members = {int(node) for node in self.location_equipment.neighbors(location) if self.equipment_location[node] == location}
+        members.update(node for node in self.moved_equipment if self.equipment_location[node] == location)
+        return sorted(members)
+
+    def jobs_of(self, equipment):
+        jobs = self.equipment_jobs.neighbors(equipment).tolist()
+        extra = self.new_jobs.get(equipment)
+        if extra:
+            jobs = sorted(jobs + extra, key=lambda job: _job_sort_key(self.jobs.get(job, "job_date")))
+        return jobs
+
+    def assignments_of_customer(self, customer):
+        return self.customer_assignments.neighbors(customer).tolist() + self.new_customer_assignments.get(customer, [])
+
+    def assignments_of_equipment(self, equipment):
+        return self.equipment_assignments.neighbors(equipment).tolist() + self.new_equipment_assignments.get(equipment, [])
+
+
+# Change-feed tables: the label they fill, and the (column, parent label) edges they need.
+_FEED_LABELS = {
+    "Equipment": ("equipment", [("current_service_location_id", "locations")]),
+    "MaintenanceJob": ("jobs", [("equipment_id", "equipment")]),
+    "CustomerEquipmentAssignment": ("assignments", [("customer_id", "customers"), ("equipment_id", "equipment")]),
+}
+
+
+def co_location_pairs(groups, limit):
+    """
+    Expands co-location groups into the legacy pair rows, only as far as limit: pairs of
+    members with eq1 id < eq2 id, ordered by location name, then serial numbers.
+
+    Args:
+        groups (list[dict]): From co_location_groups, with complete member lists.
+        limit (int): Pairs wanted.
+
+    Returns:
+        list[dict]: {equipment1_sn, equipment1_make, equipment2_sn, equipment2_make, shared_location_name}.
+    """
+    rows = []
+    for group in groups:
+        members = group["members"]
+        for first in members:
+            for second in members:
+                if second["equipment_id"] <= first["equipment_id"]:
+                    continue
+                if len(rows) >= limit:
+                    return rows
+                rows.append({
+                    "equipment1_sn": first["serial_number"], "equipment1_make": first["make"],
+                    "equipment2_sn": second["serial_number"], "equipment2_make": second["make"],
+                    "shared_location_name": group["location_name"],
+                })
+    return rows
+
+
+def _customer_groups(state, customer_names, customer_ids):
+    """[(requested name or id, [customer node, ...])] in request order (caller holds the lock)."""
+    if customer_names is not None:
+        return [(name, state.customers_by_name.get(name, [])) for name in dict.fromkeys(customer_names)]
+    groups = []
+    for customer_id in dict.fromkeys(customer_ids or ()):
+        node = state.customers.index.get(customer_id)
+        groups.append((customer_id, [node] if node is not None else []))
+    return groups
+
+
+def _operated_by_row(state, customer, equipment):
+    return {
+        "equipment_serial": state.equipment.get(equipment, "serial_number"),
+        "equipment_make": state.equipment.get(equipment, "make"),
+        "equipment_model": state.equipment.get(equipment, "model"),
+        "customer_name": state.customers.get(customer, "customer_name"),
+        "customer_industry": state.customers.get(customer, "industry_type"),
+    }
+
+
+def _maintenance_rows(state, customers, limit):
+    """customer -> equipment -> jobs rows, by serial number then newest job (caller holds the lock)."""
+    # One path per (assignment, job): a unit assigned twice repeats its jobs, as in GQL.
+    paths_per_unit = {}
+    for customer in customers:
+        for assignment in state.assignments_of_customer(customer):
+            equipment = state.assignment_ends[assignment][1]
+            paths_per_unit.setdefault(equipment, []).append(customer)
+    serials = state.equipment.columns["serial_number"]
+    jobs = state.jobs.columns
+    rows = []
+    # Serial numbers are unique and each unit's jobs are already newest first.
+    for equipment in sorted(paths_per_unit, key=lambda node: serials[node] or ""):
+        for job in state.jobs_of(equipment):
+            job_date = jobs["job_date"][job]
+            for customer in paths_per_unit[equipment]:
+                if len(rows) >= limit:
+                    return rows
+                rows.append({
+                    "customer_name": state.customers.get(customer, "customer_name"),
+                    "equipment_serial": serials[equipment],
+                    "equipment_make": state.equipment.get(equipment, "make"),
+                    "job_id": jobs["job_id"][job],
+                    "job_description": jobs["job_description"][job],
+                    "service_type": jobs["service_type"][job],
+                    "job_date": job_date.isoformat() if isinstance(job_date, datetime) else job_date,
+                    "cost": jobs["cost"][job],
+                })
+    return rows
+
+
+class FleetGraphEngine:
+    """
+    Thread-safe in-memory FleetGraph with incremental refresh.
+
+    Args:
+        refresh_seconds (float): Incremental poll interval; 0 disables background refresh.
+        full_reload_seconds (float): Full reload interval; 0 disables it.
+        compact_threshold (int): Delta entries tolerated before the CSR arrays are rebuilt.
+        feed (ChangeFeed, optional): Change feed to follow instead of polling while it runs.
+    """
+
+    def __init__(self, refresh_seconds=REFRESH_SECONDS, full_reload_seconds=FULL_RELOAD_SECONDS,
+                 compact_threshold=COMPACT_THRESHOLD, feed=None):
+        self.refresh_seconds = refresh_seconds
+        self.full_reload_seconds = full_reload_seconds
+        self.compact_threshold = max(1, compact_threshold)
+        self._state = _GraphState()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refresh_thread = None
+        self._load_thread = None
+        self._compact_thread = None
+        self._load_started_at = 0.0
+        self.loaded = False
+        self.loaded_at = None
+        self.refreshed_at = None
+        self.refreshes = 0
+        self.compactions = 0
+        self.queries = 0
+        self.feed = feed
+        self.feed_events = 0
+        self._events_during_fetch = None  # list while a load or poll reads; replayed onto its result
+        self._poll_requested = False
+        if feed is not None:
+            feed.subscribe(self.apply_change, tables=_FEED_LABELS)
+
+    # --- Loading ---
+    @staticmethod
+    def _fetch(watermarks):
+        queries = {}
+        for table, (fields, version) in _TABLES.items():
+            since = watermarks.get(table)
+            queries[table] = {
+                "sql": f"SELECT {', '.join(fields)}, {version} AS commit_version FROM {table}"
+                       + (f" WHERE {version} > @since" if since is not None else ""),
+                "params": {"since": since} if since is not None else None,
+                "param_types_map": {"since": param_types.TIMESTAMP} if since is not None else None,
+                "expected_fields": fields + ["commit_version"],
+            }
+        results = run_queries_batch(queries, consistency="strong")
+        if any(results.get(table) is None for table in queries):
+            return None
+        return results
+
+    def warm_load(self):
+        """
+        Loads the whole graph into a new generation and swaps it in.
+
+        Returns:
+            int | None: Number of nodes loaded, or None if the load failed.
+        """
+        with self._load_lock:
+            started = time.perf_counter()
+            with self._lock:
+                self._events_during_fetch = []
+            try:
+                results = self._fetch({})
+            except Exception as e:
+                print(f"graph_engine: Load failed: {e}")
+                results = None
+            if results is None:
+                with self._lock:
+                    self._events_during_fetch = None
+                return None
+            state = _GraphState()
+            state.apply(results)
+            state.compact()
+            with self._lock:
+                # Changes committed while the load read may be missing from it; apply them again.
+                for event in self._events_during_fetch:
+                    self._apply_event_locked(state, event)
+                self._events_during_fetch = None
+                self._state = state
+                self.loaded = True
+                self.loaded_at = self.refreshed_at = time.time()
+            nodes = sum(len(label) for label in (state.locations, state.customers, state.equipment, state.jobs))
+            print(f"graph_engine: Loaded {nodes} nodes and {len(state.assignments)} assignments in "
+                  f"{(time.perf_counter() - started) * 1000:.0f} ms.")
+        self._ensure_refresher()
+        return nodes
+
+    def refresh(self):
+        """
+        Applies rows committed since the last load or refresh.
+
+        Returns:
+            int | None: Number of rows applied, or None if the poll failed.
+        """
+        if not self.loaded:
+            return self.warm_load()
+        with self._load_lock:
+            with self._lock:
+                state = self._state
+                self._events_during_fetch = []
+            results = self._fetch(dict(state.watermarks))
+            if results is None:
+                with self._lock:
+                    self._events_during_fetch = None
+                return None
+            applied = sum(len(rows) for rows in results.values())
+            with self._lock:
+                events, self._events_during_fetch = self._events_during_fetch, None
+                if state is self._state:
+                    state.apply(results)
+                    # The poll read before these were applied; don't let it roll them back.
+                    for event in events:
+                        self._apply_event_locked(state, event)
+                self.refreshes += 1
+                self.refreshed_at = time.time()
+        self.compact()
+        return applied
+
+    def compact(self):
+        """
+        Rebuilds the CSR arrays once the deltas pass compact_threshold: compacts a copy of
+        the graph without holding the lock, applies the changes that arrived meanwhile,
+        and swaps the copy in. Returns True if it compacted.
+        """
+        with self._load_lock:
+            with self._lock:
+                state = self._state
+                if not self.loaded or state.delta_count <= self.compact_threshold:
+                    return False
+                compacted = state.copy()
+                self._events_during_fetch = []
+            compacted.compact()
+            with self._lock:
+                events, self._events_during_fetch = self._events_during_fetch, None
+                if state is not self._state:
+                    return False
+                for event in events:
+                    self._apply_event_locked(compacted, event)
+                self._state = compacted
+                self.compactions += 1
+        return True
+
+    def _compact_in_background(self):
+        # Caller holds self._lock.
+        if self._compact_thread is not None and self._compact_thread.is_alive():
+            return
+        self._compact_thread = threading.Thread(target=self.compact, name="graph-engine-compact", daemon=True)
+        self._compact_thread.start()
+
+    def ensure_loaded(self):
+        """Loads the graph if it isn't yet. Returns True if it is available."""
+        return self.loaded or self.warm_load() is not None
+
+    def load_in_background(self):
+        """
+        Starts the first load on its own thread and returns at once. A failed load is
+        retried no sooner than refresh_seconds after the previous attempt started.
+        """
+        with self._lock:
+            if self.loaded or (self._load_thread is not None and self._load_thread.is_alive()):
+                return
+            if time.time() - self._load_started_at < max(self.refresh_seconds, 1):
+                return
+            self._load_started_at = time.time()
+            self._load_thread = threading.Thread(target=self.warm_load, name="graph-engine-load", daemon=True)
+            self._load_thread.start()
+
+    def _ensure_refresher(self):
+        if self.refresh_seconds <= 0 or (self._refresh_thread is not None and self._refresh_thread.is_alive()):
+            return
+        self._refresh_thread = threading.Thread(target=self._refresh_forever, name="graph-engine-refresh", daemon=True)
+        self._refresh_thread.start()
+
+    def _refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                if self.full_reload_seconds > 0 and time.time() - (self.loaded_at or 0) >= self.full_reload_seconds:
+                    self.warm_load()
+                elif self.feed is None or not self.feed.complete or self._poll_requested:
+                    self._poll_requested = False
+                    self.refresh()
+            except Exception as e:
+                print(f"graph_engine: Refresh failed: {e}")
+                traceback.print_exc()
+
+    def apply_change(self, event):
+        """Change-feed subscriber: applies one Equipment, MaintenanceJob or assignment change."""
+        if event["mod_type"] == "DELETE":
+            return  # the app never deletes; the full reload drops rows removed elsewhere
+        with self._lock:
+            if self._events_during_fetch is not None:
+                self._events_during_fetch.append(event)
+            if self.loaded:
+                self._apply_event_locked(self._state, event)
+                self.feed_events += 1
+                if self._state.delta_count > self.compact_threshold:
+                    self._compact_in_background()
+
+    def _apply_event_locked(self, state, event):
+        label_name, parents = _FEED_LABELS[event["table"]]
+        label = getattr(state, label_name)
+        key = event["keys"].get(label.key)
+        node = label.index.get(key)
+        row = {field: label.get(node, field) for field in label.columns} if node is not None else {}
+        row.update((field, value) for field, value in event["values"].items() if field in label.columns)
+        row[label.key] = key
+        if node is None and any(field not in row for field in label.columns):
+            self._poll_requested = True  # an update to a row the graph never saw; the poll reads it whole
+            return
+        if any(row[column] is not None and row[column] not in getattr(state, parent).index for column, parent in parents):
+            self._poll_requested = True  # names a node the feed doesn't carry (or hasn't delivered yet)
+            if event["table"] != "Equipment":
+                return  # the edge can't be placed; the poll re-reads the row with its parent
+        results = {table: [] for table in _TABLES}
+        results[event["table"]] = [row]
+        state.apply(results, advance_watermarks=False)
+
+    # --- Traversals ---
+    def equipment_with_customers(self, limit=20):
+        """Local EquipmentOperatedBy traversal; same rows and order as db.get_equipment_with_customers_graph."""
+        with self._lock:
+            self.queries += 1
+            state = self._state
+            rows = [_operated_by_row(state, customer, equipment) for customer, equipment in state.assignment_ends]
+        rows.sort(key=lambda row: (row["customer_name"] or "", row["equipment_make"] or "", row["equipment_model"] or ""))
+        return rows[:limit]
+
+    def co_location_groups(self, location_name=None, min_units=2, member_limit=None, limit=None, location_names=None):
+        """
+        Service locations with the units based there, each location once: linear in the
+        number of units, where the pair form grows with the square of a yard's size.
+
+        Args:
+            location_name (str, optional): Only locations with this name.
+            location_names (list[str], optional): Only locations with one of these names.
+            min_units (int): Leave out locations with fewer units.
+            member_limit (int, optional): Members listed per location (unit_count is always the full count).
+            limit (int, optional): Locations returned.
+
+        Returns:
+            list[dict]: {location_id, location_name, unit_count, members: [{equipment_id, serial_number,
+            make}, ...]} ordered by location name, members by serial number.
+        """
+        with self._lock:
+            self.queries += 1
+            state = self._state
+            if location_name is not None or location_names is not None:
+                wanted = set(location_names or ()) | ({location_name} if location_name is not None else set())
+                locations = {node for name in wanted for node in state.locations_by_name.get(name, [])}
+            else:
+                locations = range(len(state.locations))
+            names = state.locations.columns["name"]
+            serials = state.equipment.columns["serial_number"]
+            groups = []
+            for location in sorted(locations, key=lambda node: names[node] or ""):
+                members = state.equipment_at(location)
+                if len(members) < max(1, min_units):
+                    continue
+                members.sort(key=lambda node: serials[node] or "")
+                groups.append({
+                    "location_id": state.locations.get(location, "location_id"),
+                    "location_name": names[location],
+                    "unit_count": len(members),
+                    "members": [{"equipment_id": state.equipment.get(node, "equipment_id"), "serial_number": serials[node],
+                                 "make": state.equipment.get(node, "make")} for node in members[:member_limit]],
+                })
+                if limit is not None and len(groups) >= limit:
+                    break
+            return groups
+
+    def maintenance_for_customer_equipment(self, customer_name, limit=20):
+        """Local customer -> equipment -> jobs traversal; same rows and order as db.get_maintenance_for_customer_equipment_graph."""
+        with self._lock:
+            self.queries += 1
+            state = self._state
+            return _maintenance_rows(state, state.customers_by_name.get(customer_name, []), limit)
+
+    def maintenance_for_customers(self, customer_names=None, customer_ids=None, per_customer_limit=20):
+        """
+        The customer -> equipment -> jobs traversal for many customers at once.
+
+        Args:
+            customer_names (list[str], optional): Customers by name (same-named customers are merged).
+            customer_ids (list[str], optional): Customers by id; used when customer_names is None.
+            per_customer_limit (int): Rows kept per customer.
+
+        Returns:
+            dict: {name or id: [rows as in maintenance_for_customer_equipment]}, one entry per requested customer.
+        """
+        with self._lock:
+            self.queries += 1
+            state = self._state
+            return {key: _maintenance_rows(state, customers, per_customer_limit)
+                    for key, customers in _customer_groups(state, customer_names, customer_ids)}
+
+    def equipment_for_customers(self, customer_names=None, customer_ids=None, per_customer_limit=20):
+        """
+        EquipmentOperatedBy rows for many customers at once, grouped like maintenance_for_customers.
+
+        Returns:
+            dict: {name or id: [rows as in equipment_with_customers, by make and model]}.
+        """
+        with self._lock:
+            self.queries += 1
+            state = self._state
+            grouped = {}
+            for key, customers in _customer_groups(state, customer_names, customer_ids):
+                rows = [_operated_by_row(state, customer, state.assignment_ends[assignment][1])
+                        for customer in customers for assignment in state.assignments_of_customer(customer)]
+                rows.sort(key=lambda row: (row["equipment_make"] or "", row["equipment_model"] or ""))
+                grouped[key] = rows[:per_customer_limit]
+            return grouped
+
+    def stats(self):
+        with self._lock:
+            state = self._state
+            return {
+                "loaded": self.loaded,
+                "loaded_at": self.loaded_at,
+                "refreshed_at": self.refreshed_at,
+                "nodes": {"equipment": len(state.equipment), "service_locations": len(state.locations),
+                          "customers": len(state.customers), "maintenance_jobs": len(state.jobs)},
+                "assignment_edges": len(state.assignments),
+                "pending_deltas": state.delta_count,
+                "refreshes": self.refreshes,
+                "compactions": self.compactions,
+                "following_feed": self.feed is not None and self.feed.complete,
+                "feed_events": self.feed_events,
+                "queries": self.queries,
+                "watermarks": {table: value.isoformat() if value else None for table, value in state.watermarks.items()},
+            }
+
+
+# Process-wide graph shared by every caller.
+graph_engine = FleetGraphEngine(feed=change_feed)
@@ -0,0 +1,58 @@
+# gunicorn.conf.py - Production server for Rouse FleetPro
+#
+#   gunicorn --config gunicorn.conf.py
+#
+# Runs WEB_CONCURRENCY worker processes (default: one per CPU). The app is imported in
+# each worker after the fork (preload_app is off), so every worker creates its own
+# spanner.Client, gRPC channels and session pool; post_fork resets spanner_data anyway
+# in case the app is ever preloaded. post_worker_init warms the pool before the worker
+# accepts connections, and /healthz/ready reports 200 only once that has succeeded.
+#
+#   SERVING_MODE                  wsgi (default, threaded Flask) | asgi (uvicorn workers, see asgi.py)
+#   WEB_CONCURRENCY               worker processes
+#   GUNICORN_THREADS              request threads per worker in wsgi mode (default 8)
+#   SPANNER_POOL_SIZE_PER_WORKER  Spanner sessions per worker (default: GUNICORN_THREADS
+#                                 in wsgi mode, SPANNER_POOL_SIZE in asgi mode)
+
+import multiprocessing
+import os
+
+SERVING_MODE = os.environ.get("SERVING_MODE", "wsgi").lower()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', os.environ.get('APP_PORT', '8080'))}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+preload_app = False
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+accesslog = "-"
+
+if SERVING_MODE == "asgi":
+    worker_class = "uvicorn.workers.UvicornWorker"
+    wsgi_app = "asgi:application"
+else:
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+    wsgi_app = "app:app"
+
+
+def _pool_size_per_worker():
+    configured = os.environ.get("SPANNER_POOL_SIZE_PER_WORKER")
+    if configured:
+        return int(configured)
+    return threads if SERVING_MODE != "asgi" else None
+
+
+def post_fork(server, worker):
+    import spanner_data
+    spanner_data.reset()
+    pool_size = _pool_size_per_worker()
+    if pool_size:
+        spanner_data.configure(pool_size=pool_size)
+
+
+def post_worker_init(worker):
+    from app import warm_up_worker
+    if warm_up_worker():
+        worker.log.info(f"Worker {worker.pid}: Spanner pool warm, accepting traffic.")
+    else:
+        worker.log.warning(f"Worker {worker.pid}: Spanner warm-up failed; /healthz/ready returns 503 until it succeeds.")
@@ -0,0 +1,258 @@
+# location_ingest.py - Coalescing buffer for high-rate telematics location pings
+#
+# Pings are buffered per equipment_id for a short flush window. Repeated pings for the
+# same unit within the window collapse to the latest one (by ping timestamp, then
+# arrival), and the survivors are written as blind batched UPDATE mutations: no
+# read-then-write transaction per ping. Spanner rejects a mutation batch that updates
+# a missing row, so only when that happens are the batch's keys read back to find the
+# unknown IDs; those pings get a per-item error and the rest are re-committed.
+#
+# Callers get one Future per ping, resolved when the flush containing it commits.
+
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from datetime import datetime, timezone
+
+from google.cloud import spanner
+from google.api_core import exceptions
+from dateutil import parser as dateutil_parser
+
+from spanner_data import get_database
+from read_cache import notify_write
+
+FLUSH_INTERVAL_SECONDS = float(os.environ.get("LOCATION_FLUSH_INTERVAL_SECONDS", "1.0"))
+FLUSH_MAX_UNITS = int(os.environ.get("LOCATION_FLUSH_MAX_UNITS", "5000"))
+# Each updated row costs one mutation per column plus its EquipmentByLocation index entry.
+UPDATE_ROWS_PER_COMMIT = int(os.environ.get("LOCATION_UPDATE_ROWS_PER_COMMIT", "2000"))
+
+# Ping field -> Equipment column
+PING_COLUMNS = {
+    "new_city": "current_city",
+    "new_address": "current_address",
+    "latitude": "latitude",
+    "longitude": "longitude",
+}
+
+# Called with {equipment_id: {column: value}} after every successful flush.
+_flush_listeners = []
+
+
+def add_flush_listener(listener):
+    """Registers a callable receiving {equipment_id: {column: value}} for every committed flush."""
+    _flush_listeners.append(listener)
+
+
+class LocationIngestBuffer:
+    """
+    Buffers location pings, coalesces them per unit and flushes them in batches.
+
+    Args:
+        flush_interval (float): Seconds between flushes.
+        max_units (int): Flush early once this many distinct units are pending.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL_SECONDS, max_units=FLUSH_MAX_UNITS):
+        self.flush_interval = flush_interval
+        self.max_units = max(1, max_units)
+        self._pending = {}  # equipment_id -> {"values": {...}, "ts": datetime, "futures": [...]}
+        self._cond = threading.Condition()
+        self._thread = None
+        self.pings_received = 0
+        self.pings_coalesced = 0
+        self.rows_written = 0
+        self.flushes = 0
+
+    def submit(self, pings):
+        """
+        Queues pings for the next flush.
+
+        Args:
+            pings (list[dict]): Each with equipment_id, a column->value dict under "values",
+                and an aware datetime under "timestamp".
+
+        Returns:
+            list[Future]: One per ping, resolving to {"status": "updated", ...} or
+            {"status": "error", "error": ...}.
+        """
+        futures = []
+        with self._cond:
+            for ping in pings:
+                future = Future()
+                futures.append(future)
+                self.pings_received += 1
+                entry = self._pending.get(ping["equipment_id"])
+                if entry is None:
+                    self._pending[ping["equipment_id"]] = {
+                        "values": dict(ping["values"]), "ts": ping["timestamp"], "futures": [future],
+                    }
+                    continue
+                self.pings_coalesced += 1
+                entry["futures"].append(future)
+                if ping["timestamp"] >= entry["ts"]:
+                    entry["values"].update(ping["values"])
+                    entry["ts"] = ping["timestamp"]
+                else:
+                    # An older ping only fills in columns the newer one didn't report.
+                    for column, value in ping["values"].items():
+                        entry["values"].setdefault(column, value)
+            if len(self._pending) >= self.max_units:
+                self._cond.notify()
+            self._ensure_flusher()
+        return futures
+
+    def _ensure_flusher(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="location-ingest-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.max_units:
+                    self._cond.wait(timeout=self.flush_interval)
+                batch, self._pending = self._pending, {}
+            if batch:
+                self._flush(batch)
+
+    def flush_now(self):
+        """Flushes whatever is pending on the calling thread (used at shutdown)."""
+        with self._cond:
+            batch, self._pending = self._pending, {}
+        if batch:
+            self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        try:
+            missing, failed = self._write({eid: entry["values"] for eid, entry in batch.items()})
+        except Exception as e:
+            print(f"location_ingest: Flush of {len(batch)} units failed: {e}")
+            traceback.print_exc()
+            missing, failed = set(), {eid: str(e) for eid in batch}
+
+        written = {}
+        for equipment_id, entry in batch.items():
+            if equipment_id in missing:
+                result = {"status": "error", "error": f"Equipment ID '{equipment_id}' not found"}
+            elif equipment_id in failed:
+                result = {"status": "error", "error": f"Failed to update equipment location: {failed[equipment_id]}"}
+            else:
+                result = {"status": "updated", "coalesced_pings": len(entry["futures"])}
+                written[equipment_id] = entry["values"]
+            for future in entry["futures"]:
+                future.set_result(result)
+
+        self.flushes += 1
+        self.rows_written += len(written)
+        if written:
+            columns = {column for values in written.values() for column in values}
+            notify_write("Equipment", columns=columns)
+            for listener in list(_flush_listeners):
+                try:
+                    listener(written)
+                except Exception as e:
+                    print(f"location_ingest: Flush listener {listener} failed: {e}")
+                    traceback.print_exc()
+        print(f"location_ingest: Flushed {len(written)}/{len(batch)} units in {(time.perf_counter() - started) * 1000:.0f} ms.")
+
+    def _write(self, updates):
+        """Writes {equipment_id: {column: value}}. Returns (missing_ids, {failed_id: error})."""
+        db = get_database()
+        if not db:
+            raise ConnectionError("Spanner database connection not initialized.")
+
+        # batch.update() needs one column list per call, so group units by the columns they report.
+        groups = {}
+        for equipment_id, values in updates.items():
+            groups.setdefault(tuple(sorted(values)), []).append(equipment_id)
+
+        missing, failed = set(), {}
+        for columns, ids in groups.items():
+            for start in range(0, len(ids), UPDATE_ROWS_PER_COMMIT):
+                chunk_ids = ids[start:start + UPDATE_ROWS_PER_COMMIT]
+                try:
+                    self._commit_updates(db, columns, chunk_ids, updates)
+                except exceptions.NotFound:
+                    existing = self._existing_ids(db, chunk_ids)
+                    missing.update(eid for eid in chunk_ids if eid not in existing)
+                    remaining = [eid for eid in chunk_ids if eid in existing]
+                    try:
+                        if remaining:
+                            self._commit_updates(db, columns, remaining, updates)
+                    except Exception as e:
+                        failed.update({eid: str(e) for eid in remaining})
+                except Exception as e:
+                    print(f"location_ingest: Commit of {len(chunk_ids)} location updates failed: {e}")
+                    failed.update({eid: str(e) for eid in chunk_ids})
+        return missing, failed
+
+    @staticmethod
+    def _commit_updates(db, columns, ids, updates):
+        # last_update_time versions the equipment detail pages (ETag).
+        with db.batch() as batch:
+            batch.update(
+                table="Equipment",
+                columns=["equipment_id"] + list(columns) + ["last_update_time"],
+                values=[[eid] + [updates[eid][column] for column in columns] + [spanner.COMMIT_TIMESTAMP] for eid in ids],
+            )
+
+    @staticmethod
+    def _existing_ids(db, ids):
+        with db.snapshot() as snapshot:
+            rows = snapshot.read(table="Equipment", columns=["equipment_id"], keyset=spanner.KeySet(keys=[[eid] for eid in ids]))
+            return {row[0] for row in rows}
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "pending_units": pending,
+            "pings_received": self.pings_received,
+            "pings_coalesced": self.pings_coalesced,
+            "rows_written": self.rows_written,
+            "flushes": self.flushes,
+            "flush_interval_seconds": self.flush_interval,
+        }
+
+
+def parse_ping(item):
+    """
+    Validates one raw ping from the API.
+
+    Returns:
+        (dict | None, str | None): The normalized ping or an error message.
+    """
+    if not isinstance(item, dict) or not item.get("equipment_id"):
+        return None, "Missing required field: equipment_id"
+    values = {}
+    for field, column in PING_COLUMNS.items():
+        value = item.get(field)
+        if value is None:
+            continue
+        if column in ("latitude", "longitude"):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return None, f"Invalid {field} value. Must be a number."
+        values[column] = value
+    if not values:
+        return None, "Ping must include latitude/longitude, new_city or new_address"
+
+    timestamp = item.get("timestamp")
+    if timestamp:
+        try:
+            timestamp = dateutil_parser.isoparse(timestamp)
+        except (ValueError, TypeError):
+            return None, "Invalid timestamp. Must be ISO 8601."
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+    else:
+        timestamp = datetime.now(timezone.utc)
+    return {"equipment_id": item["equipment_id"], "values": values, "timestamp": timestamp}, None
+
+
+# Process-wide buffer; its flusher thread starts on the first submit.
+location_buffer = LocationIngestBuffer()
@@ -0,0 +1,100 @@
+# pagination.py - Keyset (cursor) pagination helpers for FleetPro listings
+#
+# A page is fetched with "WHERE (sort columns..., primary key) > (last row of previous page)
+# ORDER BY sort columns..., primary key LIMIT page_size + 1", so Spanner seeks straight to
+# the next key instead of scanning past OFFSET rows. The extra row tells us whether a
+# next page exists. Cursors are opaque, URL-safe encodings of the last row's key values.
+
+import base64
+import json
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(key_values):
+    """Encodes a list of key values (str/int/float/None) into an opaque URL-safe cursor."""
+    raw = json.dumps(list(key_values), separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, key_count):
+    """
+    Decodes a cursor produced by encode_cursor.
+
+    Returns:
+        list | None: The key values, or None when no cursor was given.
+
+    Raises:
+        ValueError: If the cursor is malformed or has the wrong number of key values.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key_values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid page cursor: {e}")
+    if not isinstance(key_values, list) or len(key_values) != key_count:
+        raise ValueError("Invalid page cursor: unexpected key layout.")
+    return key_values
+
+
+def clamp_page_size(page_size, default=DEFAULT_PAGE_SIZE):
+    try:
+        page_size = int(page_size) if page_size is not None else default
+    except (TypeError, ValueError):
+        page_size = default
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def keyset_after_condition(columns, key_values, param_prefix="after"):
+    """
+    Builds a SQL condition selecting rows strictly after key_values in ascending column order.
+
+    Spanner sorts NULLs first in ascending order; NULL cursor values are compared with
+    IS [NOT] NULL rather than bound, so every comparison stays a plain range predicate.
+    The condition leads with a bound on the first column alone ("col >= @p"; none is
+    needed when the cursor's first value is NULL) so Spanner can seek an index on the
+    sort columns instead of scanning from its start; the tie-break tree behind it drops
+    the rows at or before the cursor. The last column must be the (non-NULL) primary key.
+
+    Returns:
+        (str, dict): The condition and the parameter values it binds.
+    """
+    params = {}
+
+    def bind(i, value):
+        params[f"{param_prefix}_{i}"] = value
+        return f"@{param_prefix}_{i}"
+
+    def greater(i):
+        return f"{columns[i]} IS NOT NULL" if key_values[i] is None else f"{columns[i]} > {bind(i, key_values[i])}"
+
+    def equal(i):
+        return f"{columns[i]} IS NULL" if key_values[i] is None else f"{columns[i]} = {bind(i, key_values[i])}"
+
+    last = len(columns) - 1
+    condition = greater(last)
+    for i in reversed(range(last)):
+        condition = f"({greater(i)} OR ({equal(i)} AND {condition}))"
+    if last > 0 and key_values[0] is not None:
+        condition = f"{columns[0]} >= {bind(0, key_values[0])} AND {condition}"
+    return condition, params
+
+
+def build_page(rows, page_size, key_fields):
+    """
+    Trims a LIMIT page_size + 1 result to a page and computes the next cursor.
+
+    Returns:
+        dict: {"items": [...], "next_cursor": str | None, "has_more": bool}
+    """
+    if rows is None:
+        return None
+    has_more = len(rows) > page_size
+    items = rows[:page_size]
+    next_cursor = None
+    if has_more and items:
+        next_cursor = encode_cursor([items[-1].get(field) for field in key_fields])
+    return {"items": items, "next_cursor": next_cursor, "has_more": has_more}
@@ -0,0 +1,187 @@
+# query_stats.py - Per-query latency / row / byte instrumentation for the data layer
+#
+# spanner_data records every query here under a query name (the data-access function
+# that issued it, e.g. "app.get_all_equipment_db") together with the route that was
+# being served. Each name keeps running totals plus a bounded window of recent
+# latencies for p50/p95/p99. A small fraction of queries can be run in PROFILE mode
+# (SPANNER_PROFILE_SAMPLE_RATE) to capture Spanner's execution statistics.
+#
+#   SPANNER_QUERY_STATS_WINDOW   latencies kept per query name for percentiles (default 1024)
+#   SPANNER_PROFILE_SAMPLE_RATE  fraction of queries run with query_mode=PROFILE (default 0)
+#   SPANNER_SLOW_QUERY_MS        log queries slower than this; 0 disables (default 0)
+
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+LATENCY_WINDOW = max(1, int(os.environ.get("SPANNER_QUERY_STATS_WINDOW", "1024")))
+PROFILE_SAMPLE_RATE = float(os.environ.get("SPANNER_PROFILE_SAMPLE_RATE", "0"))
+SLOW_QUERY_MS = float(os.environ.get("SPANNER_SLOW_QUERY_MS", "0"))
+PROFILES_KEPT = 5
+REQUEST_TAG_MAX_LENGTH = 50  # Spanner rejects longer request tags
+
+# Frames skipped when naming a query: the data layer itself and thin pass-through wrappers.
+_WRAPPER_MODULES = {"spanner_data", "query_stats", "read_cache"}
+_WRAPPER_FUNCTIONS = {"run_graph_query", "run_sql_query", "<lambda>", "<genexpr>"}
+
+_current_route = contextvars.ContextVar("spanner_query_route", default=None)
+_lock = threading.Lock()
+_stats = {}
+
+
+def set_route(route):
+    """Sets the route name attributed to queries issued from this context (e.g. a Flask endpoint)."""
+    return _current_route.set(route)
+
+
+def current_route():
+    return _current_route.get() or "-"
+
+
+def caller_query_name():
+    """Names a query after the first function up the stack that isn't part of the data layer."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "").rsplit(".", 1)[-1]
+        function = frame.f_code.co_name
+        if module not in _WRAPPER_MODULES and function not in _WRAPPER_FUNCTIONS:
+            return f"{module}.{function}"
+        frame = frame.f_back
+    return "unknown"
+
+
+def request_tag(query_name, route=None):
+    """Builds the Spanner request tag for a query, so it can be found in SPANNER_SYS query stats."""
+    tag = f"q={query_name},r={route or current_route()}"
+    return tag[:REQUEST_TAG_MAX_LENGTH]
+
+
+def should_profile():
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def approx_row_bytes(row):
+    """Rough decoded size of a result row, good enough to spot queries pulling wide columns."""
+    size = 0
+    for value in row:
+        if value is None:
+            continue
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+        elif isinstance(value, (list, tuple)):
+            size += approx_row_bytes(value)
+        else:
+            size += 8
+    return size
+
+
+def record(query_name, route, elapsed_seconds, rows=0, bytes_decoded=0, error=None, profile=None):
+    """
+    Records one finished query.
+
+    Args:
+        query_name (str): Name the query is aggregated under.
+        route (str): Route (or "-") that issued the query.
+        elapsed_seconds (float): Wall time, including streaming every row.
+        rows (int): Rows returned.
+        bytes_decoded (int): Approximate decoded result size.
+        error (Exception, optional): Set if the query failed.
+        profile (dict, optional): PROFILE-mode query stats to keep as a sample.
+    """
+    with _lock:
+        entry = _stats.get(query_name)
+        if entry is None:
+            entry = _stats[query_name] = {
+                "count": 0, "errors": 0, "rows": 0, "bytes": 0, "total_seconds": 0.0,
+                "max_seconds": 0.0, "latencies": deque(maxlen=LATENCY_WINDOW),
+                "routes": {}, "profiles": deque(maxlen=PROFILES_KEPT),
+            }
+        entry["count"] += 1
+        entry["rows"] += rows
+        entry["bytes"] += bytes_decoded
+        entry["total_seconds"] += elapsed_seconds
+        entry["max_seconds"] = max(entry["max_seconds"], elapsed_seconds)
+        entry["latencies"].append(elapsed_seconds)
+        entry["routes"][route] = entry["routes"].get(route, 0) + 1
+        if error is not None:
+            entry["errors"] += 1
+        if profile is not None:
+            entry["profiles"].append({"at": time.time(), "route": route, "stats": profile})
+    if SLOW_QUERY_MS and elapsed_seconds * 1000 >= SLOW_QUERY_MS:
+        print(f"query_stats: Slow query {query_name} (route {route}): {elapsed_seconds * 1000:.0f} ms, {rows} rows.")
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def snapshot(include_profiles=True):
+    """Returns {query_name: aggregate dict} with latencies in milliseconds."""
+    with _lock:
+        copied = {name: (dict(entry), sorted(entry["latencies"]), dict(entry["routes"]), list(entry["profiles"]))
+                  for name, entry in _stats.items()}
+    result = {}
+    for name, (entry, latencies, routes, profiles) in copied.items():
+        result[name] = {
+            "count": entry["count"],
+            "errors": entry["errors"],
+            "rows": entry["rows"],
+            "bytes_decoded": entry["bytes"],
+            "mean_ms": round(entry["total_seconds"] * 1000 / entry["count"], 2),
+            "max_ms": round(entry["max_seconds"] * 1000, 2),
+            "p50_ms": round(_percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+            "window": len(latencies),
+            "routes": routes,
+        }
+        if include_profiles and profiles:
+            result[name]["profiles"] = profiles
+    return result
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def prometheus_text():
+    """Renders the aggregates in the Prometheus text exposition format."""
+    with _lock:
+        copied = {name: (dict(entry), sorted(entry["latencies"]), dict(entry["routes"])) for name, entry in _stats.items()}
+    lines = [
+        "# HELP spanner_query_duration_seconds Wall time of Spanner queries (quantiles over a recent window).",
+        "# TYPE spanner_query_duration_seconds summary",
+    ]
+    for name, (entry, latencies, _) in sorted(copied.items()):
+        for quantile in (0.5, 0.95, 0.99):
+            lines.append(f'spanner_query_duration_seconds{{query="{_label(name)}",quantile="{quantile}"}} {_percentile(latencies, quantile):.6f}')
+        lines.append(f'spanner_query_duration_seconds_sum{{query="{_label(name)}"}} {entry["total_seconds"]:.6f}')
+        lines.append(f'spanner_query_duration_seconds_count{{query="{_label(name)}"}} {entry["count"]}')
+    counters = [
+        ("spanner_query_rows_total", "Rows returned by Spanner queries.", "rows"),
+        ("spanner_query_bytes_decoded_total", "Approximate decoded bytes returned by Spanner queries.", "bytes"),
+        ("spanner_query_errors_total", "Spanner queries that failed.", "errors"),
+    ]
+    for metric, help_text, key in counters:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for name, (entry, _, _) in sorted(copied.items()):
+            lines.append(f'{metric}{{query="{_label(name)}"}} {entry[key]}')
+    lines.append("# HELP spanner_route_queries_total Spanner queries issued per query name and route.")
+    lines.append("# TYPE spanner_route_queries_total counter")
+    for name, (_, _, routes) in sorted(copied.items()):
+        for route, count in sorted(routes.items()):
+            lines.append(f'spanner_route_queries_total{{query="{_label(name)}",route="{_label(route)}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _stats.clear()
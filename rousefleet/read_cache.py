@@ -0,0 +1,164 @@
+# read_cache.py - In-process read-through cache for FleetPro reference data
+#
+# Each cache is a size-bounded LRU with a per-entry TTL. Caches declare which tables
+# (and optionally which columns) they are derived from; write paths call
+# notify_write() after a successful commit and every dependent cache is cleared.
+# Cached values are shared between requests and must be treated as read-only.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL_SECONDS = float(os.environ.get("REFERENCE_CACHE_TTL_SECONDS", "300"))
+DEFAULT_MAX_ENTRIES = int(os.environ.get("REFERENCE_CACHE_MAX_ENTRIES", "256"))
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class TTLCache:
+    """
+    A thread-safe LRU cache with per-entry expiry and hit/miss counters.
+
+    Args:
+        name (str): Name used in stats output.
+        max_entries (int): Entries kept before the least recently used one is evicted.
+        ttl_seconds (float): Lifetime of an entry; 0 disables expiry.
+        depends_on (dict): {table_name: column tuple or None}. None means any write
+            to the table invalidates the cache; a tuple limits it to those columns.
+        settle_seconds (float): For caches filled by stale reads: values stored within
+            this many seconds of an invalidation may predate the write, so they only
+            live until the window has passed instead of for the full TTL.
+    """
+
+    def __init__(self, name, max_entries=DEFAULT_MAX_ENTRIES, ttl_seconds=DEFAULT_TTL_SECONDS, depends_on=None,
+                 settle_seconds=0):
+        self.name = name
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = float(ttl_seconds)
+        self.depends_on = dict(depends_on or {})
+        self.settle_seconds = float(settle_seconds)
+        self._invalidated_at = None
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns (True, value) on a fresh hit, (False, None) otherwise."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if not expires_at or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, generation=None):
+        """Stores a value. If generation is given and the cache was invalidated since, the value is dropped."""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            now = time.monotonic()
+            expires_at = now + self.ttl_seconds if self.ttl_seconds > 0 else 0
+            if self._invalidated_at is not None and now - self._invalidated_at < self.settle_seconds:
+                settled_at = self._invalidated_at + self.settle_seconds
+                expires_at = min(expires_at, settled_at) if expires_at else settled_at
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() on a miss.
+
+        None results (the data layer's "query failed" signal) are not cached.
+        """
+        hit, value = self.get(key)
+        if hit:
+            return value
+        generation = self._generation
+        value = loader()
+        if value is not None:
+            self.put(key, value, generation=generation)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._invalidated_at = time.monotonic()
+            self.invalidations += 1
+
+    def depends_on_write(self, table, columns=None):
+        if table not in self.depends_on:
+            return False
+        watched = self.depends_on[table]
+        if watched is None or columns is None:
+            return True
+        return bool(set(watched) & set(columns))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "settle_seconds": self.settle_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "depends_on": {t: list(c) if c else None for t, c in self.depends_on.items()},
+            }
+
+
+def register_cache(name, **kwargs):
+    """Returns the cache registered under name, creating it on first call."""
+    with _registry_lock:
+        cache = _registry.get(name)
+        if cache is None:
+            cache = TTLCache(name, **kwargs)
+            _registry[name] = cache
+        return cache
+
+
+def notify_write(table, columns=None):
+    """
+    Invalidates every cache derived from table. Call after the write has committed.
+
+    Args:
+        table (str): The Spanner table that was written.
+        columns (iterable[str], optional): Columns written; None means the whole row.
+    """
+    with _registry_lock:
+        caches = list(_registry.values())
+    for cache in caches:
+        if cache.depends_on_write(table, columns):
+            cache.invalidate()
+
+
+def clear_all():
+    with _registry_lock:
+        caches = list(_registry.values())
+    for cache in caches:
+        cache.invalidate()
+
+
+def cache_stats():
+    with _registry_lock:
+        caches = list(_registry.values())
+    return {cache.name: cache.stats() for cache in caches}
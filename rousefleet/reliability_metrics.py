@@ -0,0 +1,269 @@
+# reliability_metrics.py - Batch maintenance-reliability metrics per unit and per make/model
+#
+# One pass over MaintenanceJob (streamed, never buffered as rows) plus the Equipment
+# meter hours, turned into column arrays and reduced with NumPy:
+#
+#   job_count / repair_count   jobs on record; repairs are service types containing a
+#                              RELIABILITY_REPAIR_KEYWORDS word ("Repair - Engine"), all
+#                              other types (inspections, oil changes, ...) count as scheduled
+#   mean_days_between_jobs     (last job - first job) / (dated jobs - 1)
+#   cost_per_meter_hour        lifetime maintenance cost / current meter hours
+#   repair_ratio               repair_count / job_count
+#   trailing_spend             maintenance cost over the last RELIABILITY_TRAILING_DAYS
+#   last_job_date              most recent job
+#
+# Results are upserted into EquipmentReliability (one row per unit) and ModelReliability
+# (one row per make/model, pooled over its units), where the equipment page, the fleet
+# analyzer and the dispatch ranker read them with a single-row or single-scan query.
+# Recompute on a schedule: `python reliability_metrics.py` (a Cloud Run job / cron) or
+# POST /admin/reliability/recompute on the web app.
+#
+#   RELIABILITY_TRAILING_DAYS     window of trailing_spend (default 365)
+#   RELIABILITY_REPAIR_KEYWORDS   comma-separated service-type words marking a repair (default "repair")
+#   SPANNER_MUTATION_LIMIT        mutations per commit when writing results (default 80000)
+
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from google.cloud import spanner
+from google.cloud.spanner_v1 import param_types
+
+from spanner_data import get_database, run_query, stream_query
+
+TRAILING_DAYS = int(os.environ.get("RELIABILITY_TRAILING_DAYS", "365"))
+REPAIR_KEYWORDS = tuple(word.strip().casefold() for word in os.environ.get("RELIABILITY_REPAIR_KEYWORDS", "repair").split(",") if word.strip())
+SPANNER_MUTATION_LIMIT = int(os.environ.get("SPANNER_MUTATION_LIMIT", "80000"))
+
+METRIC_FIELDS = ["job_count", "repair_count", "mean_days_between_jobs", "cost_per_meter_hour", "repair_ratio",
+                 "trailing_spend", "last_job_date"]
+EQUIPMENT_COLUMNS = ["equipment_id", "make", "model"] + METRIC_FIELDS + ["computed_at"]
+# ModelReliability.trailing_spend is the mean per unit, so a unit compares directly with its model.
+MODEL_COLUMNS = ["make", "model", "unit_count"] + [field for field in METRIC_FIELDS if field != "last_job_date"] + ["computed_at"]
+
+
+def is_repair(service_type):
+    folded = (service_type or "").casefold()
+    return any(word in folded for word in REPAIR_KEYWORDS)
+
+
+def _nullable(value):
+    """NumPy scalar -> plain float, NaN -> None."""
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+# --- Computation ---
+def compute(units, jobs, now=None):
+    """
+    Computes the metrics from column data.
+
+    Args:
+        units (dict): Equal-length lists "equipment_id", "make", "model", "meter_hours".
+        jobs (dict): Equal-length lists "equipment_id", "job_date" (epoch seconds, NaN if
+            unknown), "cost" and "service_type".
+        now (float, optional): Epoch seconds the trailing window ends at.
+
+    Returns:
+        (list[dict], list[dict]): Equipment rows and make/model rows, keyed by the
+        EQUIPMENT_COLUMNS / MODEL_COLUMNS names (without computed_at).
+    """
+    now = now if now is not None else time.time()
+    ids = units["equipment_id"]
+    n = len(ids)
+    position = {equipment_id: i for i, equipment_id in enumerate(ids)}
+
+    # Jobs on units that no longer exist (or arrived after the Equipment read) are dropped.
+    unit_index = np.array([position.get(equipment_id, -1) for equipment_id in jobs["equipment_id"]], dtype=np.int64)
+    known = unit_index >= 0
+    unit_index = unit_index[known]
+    job_date = np.asarray(jobs["job_date"], dtype=float)[known]
+    cost = np.nan_to_num(np.asarray(jobs["cost"], dtype=float)[known])
+    # Classify each distinct service type once instead of once per job.
+    repair_types = {}
+    repair = np.array([repair_types[service_type] if service_type in repair_types else repair_types.setdefault(service_type, is_repair(service_type))
+                       for service_type in jobs["service_type"]], dtype=float)[known]
+
+    job_count = np.bincount(unit_index, minlength=n).astype(float)
+    repair_count = np.bincount(unit_index, weights=repair, minlength=n)
+    total_cost = np.bincount(unit_index, weights=cost, minlength=n)
+    trailing = np.bincount(unit_index, weights=np.where(job_date >= now - TRAILING_DAYS * 86400.0, cost, 0.0), minlength=n)
+
+    dated = ~np.isnan(job_date)
+    dated_count = np.bincount(unit_index[dated], minlength=n).astype(float)
+    first = np.full(n, np.inf)
+    last = np.full(n, -np.inf)
+    np.minimum.at(first, unit_index[dated], job_date[dated])
+    np.maximum.at(last, unit_index[dated], job_date[dated])
+    span_days = np.where(dated_count >= 2, (last - first) / 86400.0, 0.0)
+    gaps = np.maximum(dated_count - 1, 0)
+
+    hours = np.array([value if value is not None else np.nan for value in units["meter_hours"]], dtype=float)
+    has_hours = hours > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_days = np.where(gaps > 0, span_days / gaps, np.nan)
+        per_hour = np.where(has_hours, total_cost / hours, np.nan)
+        ratio = np.where(job_count > 0, repair_count / job_count, np.nan)
+
+    equipment_rows = []
+    for i, equipment_id in enumerate(ids):
+        equipment_rows.append({
+            "equipment_id": equipment_id, "make": units["make"][i], "model": units["model"][i],
+            "job_count": int(job_count[i]), "repair_count": int(repair_count[i]),
+            "mean_days_between_jobs": _nullable(mean_days[i]), "cost_per_meter_hour": _nullable(per_hour[i]),
+            "repair_ratio": _nullable(ratio[i]), "trailing_spend": float(trailing[i]),
+            "last_job_date": datetime.fromtimestamp(last[i], timezone.utc) if dated_count[i] else None,
+        })
+
+    # Make/model figures pool their units' sums, so large models aren't averaged like small ones.
+    model_keys, model_index = {}, np.empty(n, dtype=np.int64)
+    for i in range(n):
+        model_index[i] = model_keys.setdefault((units["make"][i], units["model"][i]), len(model_keys))
+    m = len(model_keys)
+
+    def by_model(values):
+        return np.bincount(model_index, weights=values, minlength=m)
+
+    model_units = np.bincount(model_index, minlength=m).astype(float)
+    model_jobs, model_repairs = by_model(job_count), by_model(repair_count)
+    model_span, model_gaps = by_model(span_days), by_model(gaps)
+    model_cost, model_hours = by_model(np.where(has_hours, total_cost, 0.0)), by_model(np.where(has_hours, hours, 0.0))
+    model_trailing = by_model(trailing)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        model_mean_days = np.where(model_gaps > 0, model_span / model_gaps, np.nan)
+        model_per_hour = np.where(model_hours > 0, model_cost / model_hours, np.nan)
+        model_ratio = np.where(model_jobs > 0, model_repairs / model_jobs, np.nan)
+
+    model_rows = []
+    for (make, model), j in model_keys.items():
+        if make is None or model is None:
+            continue  # ModelReliability is keyed by both
+        model_rows.append({
+            "make": make, "model": model, "unit_count": int(model_units[j]),
+            "job_count": int(model_jobs[j]), "repair_count": int(model_repairs[j]),
+            "mean_days_between_jobs": _nullable(model_mean_days[j]), "cost_per_meter_hour": _nullable(model_per_hour[j]),
+            "repair_ratio": _nullable(model_ratio[j]), "trailing_spend": float(model_trailing[j] / model_units[j]),
+        })
+    return equipment_rows, model_rows
+
+
+# --- Batch job ---
+def read_inputs():
+    """
+    Streams Equipment (id, make, model, meter hours) and MaintenanceJob into column lists.
+
+    Raises:
+        ConnectionError: If no database connection is available.
+    """
+    units = {"equipment_id": [], "make": [], "model": [], "meter_hours": []}
+    for equipment_id, make, model, meter_hours in stream_query(
+            "SELECT equipment_id, make, model, meter_hours FROM Equipment",
+            expected_fields=["equipment_id", "make", "model", "meter_hours"]):
+        units["equipment_id"].append(equipment_id)
+        units["make"].append(make)
+        units["model"].append(model)
+        units["meter_hours"].append(meter_hours)
+
+    jobs = {"equipment_id": [], "job_date": [], "cost": [], "service_type": []}
+    for equipment_id, job_date, cost, service_type in stream_query(
+            "SELECT equipment_id, job_date, cost, service_type FROM MaintenanceJob",
+            expected_fields=["equipment_id", "job_date", "cost", "service_type"]):
+        jobs["equipment_id"].append(equipment_id)
+        jobs["job_date"].append(job_date.timestamp() if job_date is not None else np.nan)
+        jobs["cost"].append(cost if cost is not None else np.nan)
+        jobs["service_type"].append(service_type or "")
+    return units, jobs
+
+
+def _write(db, table, columns, rows):
+    chunk_rows = max(1, SPANNER_MUTATION_LIMIT // len(columns))
+    for chunk_start in range(0, len(rows), chunk_rows):
+        values = [tuple(row[column] for column in columns[:-1]) + (spanner.COMMIT_TIMESTAMP,)
+                  for row in rows[chunk_start:chunk_start + chunk_rows]]
+        with db.batch() as batch:
+            batch.insert_or_update(table=table, columns=columns, values=values)
+
+
+def recompute():
+    """
+    Reads MaintenanceJob once, recomputes every unit's and every make/model's metrics
+    and upserts them. The caller notifies read caches of the EquipmentReliability /
+    ModelReliability writes.
+
+    Returns:
+        dict | None: {units, models, jobs, seconds}, or None if a read or write failed.
+
+    Raises:
+        ConnectionError: If no database connection is available.
+    """
+    db = get_database()
+    if not db: raise ConnectionError("DB not init.")
+    started = time.perf_counter()
+    try:
+        units, jobs = read_inputs()
+        equipment_rows, model_rows = compute(units, jobs)
+        _write(db, "EquipmentReliability", EQUIPMENT_COLUMNS, equipment_rows)
+        _write(db, "ModelReliability", MODEL_COLUMNS, model_rows)
+    except ConnectionError:
+        raise
+    except Exception as e:
+        print(f"reliability_metrics: Recompute failed: {e}")
+        return None
+    summary = {"units": len(equipment_rows), "models": len(model_rows), "jobs": len(jobs["equipment_id"]),
+               "seconds": round(time.perf_counter() - started, 3)}
+    print(f"reliability_metrics: Recomputed {summary['units']} units / {summary['models']} models "
+          f"from {summary['jobs']} jobs in {summary['seconds']} s.")
+    return summary
+
+
+# --- Reads ---
+def reliability_query(equipment_id):
+    sql = f"""
+        SELECT {', '.join('er.' + field for field in METRIC_FIELDS)}, er.computed_at,
+               mr.unit_count AS model_unit_count, mr.mean_days_between_jobs AS model_mean_days_between_jobs,
+               mr.cost_per_meter_hour AS model_cost_per_meter_hour, mr.repair_ratio AS model_repair_ratio,
+               mr.trailing_spend AS model_trailing_spend
+        FROM EquipmentReliability AS er
+        LEFT JOIN ModelReliability AS mr ON mr.make = er.make AND mr.model = er.model
+        WHERE er.equipment_id = @equipment_id
+    """
+    fields = METRIC_FIELDS + ["computed_at", "model_unit_count", "model_mean_days_between_jobs",
+                              "model_cost_per_meter_hour", "model_repair_ratio", "model_trailing_spend"]
+    return {"sql": sql, "params": {"equipment_id": equipment_id},
+            "param_types_map": {"equipment_id": param_types.STRING}, "expected_fields": fields}
+
+
+def get_equipment_reliability(equipment_id):
+    """
+    A unit's metrics alongside its make/model's (model_* fields).
+
+    Returns:
+        dict | None: None if the unit hasn't been computed yet or the query failed.
+    """
+    rows = run_query(**reliability_query(equipment_id))
+    return rows[0] if rows else None
+
+
+def get_model_reliability(make=None):
+    """
+    Make/model metrics, worst repair ratio first.
+
+    Args:
+        make (str, optional): Only models of this make.
+
+    Returns:
+        list[dict] | None: None if the query failed.
+    """
+    sql = f"""
+        SELECT {', '.join(MODEL_COLUMNS)}
+        FROM ModelReliability
+        WHERE @make IS NULL OR make = @make
+        ORDER BY repair_ratio DESC, make, model
+    """
+    return run_query(sql, params={"make": make}, param_types_map={"make": param_types.STRING}, expected_fields=MODEL_COLUMNS)
+
+
+if __name__ == "__main__":
+    result = recompute()
+    raise SystemExit(0 if result is not None else 1)
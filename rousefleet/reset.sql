@@ -11,17 +11,27 @@ DROP INDEX IF EXISTS Equipment_serial_number_key; -- This was a UNIQUE INDEX
 DROP INDEX IF EXISTS MaintenanceJobByEquipment;
 DROP INDEX IF EXISTS MaintenanceJobByDate;
 
+-- Listing sort-key indexes (keyset pagination)
 DROP INDEX IF EXISTS CustomerByName;
+DROP INDEX IF EXISTS EquipmentByMakeModel;
+DROP INDEX IF EXISTS ServiceLocationByName;
 
 DROP INDEX IF EXISTS CustomerEquipmentAssignmentByCustomerEquipment;
 DROP INDEX IF EXISTS CustomerEquipmentAssignmentByEquipment;
 
+-- Drop the Change Stream (it watches Equipment, MaintenanceJob and CustomerEquipmentAssignment)
+DROP CHANGE STREAM IF EXISTS FleetChanges;
+
 -- Drop the Property Graph
 DROP PROPERTY GRAPH IF EXISTS FleetGraph;
 
 -- Drop Tables in an order that respects foreign key constraints
 -- (Child tables or tables with foreign keys are dropped before the tables they reference)
 
+-- Batch reliability metrics have no foreign keys
+DROP TABLE IF EXISTS EquipmentReliability;
+DROP TABLE IF EXISTS ModelReliability;
+
 -- 1. MaintenanceJob has a FOREIGN KEY to Equipment
 DROP TABLE IF EXISTS MaintenanceJob;
 
@@ -0,0 +1,166 @@
+# serial_resolver.py - Shared serial number -> equipment_id resolver
+#
+# Keeps the whole serial -> equipment_id map in memory (warm-loaded from the
+# EquipmentBySerialNumber index, which covers both columns) so resolving a serial is a
+# dictionary lookup instead of a Spanner round trip. Serials that don't exist are
+# remembered for a short TTL so repeated bad lookups don't hit Spanner either; they
+# are re-checked once that expires, since another process may have added the unit.
+#
+# Used by the FleetPro web app and the fleet_analyzer agent tools.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from google.cloud.spanner_v1 import param_types
+
+try:
+    from . import spanner_data  # staged inside the fleet_analyzer package
+except ImportError:
+    import spanner_data
+
+NEGATIVE_TTL_SECONDS = float(os.environ.get("SERIAL_NEGATIVE_TTL_SECONDS", "30"))
+MAX_NEGATIVE_ENTRIES = int(os.environ.get("SERIAL_MAX_NEGATIVE_ENTRIES", "10000"))
+
+
+class SerialResolver:
+    """
+    Thread-safe serial number resolver with positive and negative caching.
+
+    Args:
+        negative_ttl_seconds (float): How long an unknown serial is answered from memory.
+        max_negative_entries (int): Bound on remembered unknown serials (oldest dropped first).
+    """
+
+    def __init__(self, negative_ttl_seconds=NEGATIVE_TTL_SECONDS, max_negative_entries=MAX_NEGATIVE_ENTRIES):
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.max_negative_entries = max(1, max_negative_entries)
+        self._ids = {}
+        self._negative = OrderedDict()  # serial -> expires_at (monotonic)
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.hits = 0
+        self.negative_hits = 0
+        self.db_lookups = 0
+
+    def warm_load(self):
+        """
+        Loads every serial number from the EquipmentBySerialNumber index.
+
+        Returns:
+            int | None: Number of serials loaded, or None if the load failed.
+        """
+        sql = "SELECT serial_number, equipment_id FROM Equipment@{FORCE_INDEX=EquipmentBySerialNumber}"
+        started = time.perf_counter()
+        loaded = {}
+        try:
+            for serial_number, equipment_id in spanner_data.stream_query(sql, expected_fields=["serial_number", "equipment_id"]):
+                loaded[serial_number] = equipment_id
+        except Exception as e:
+            print(f"serial_resolver: Warm load failed: {e}")
+            return None
+        with self._lock:
+            self._ids.update(loaded)
+            for serial_number in loaded:
+                self._negative.pop(serial_number, None)
+            self.loaded = True
+        print(f"serial_resolver: Loaded {len(loaded)} serial numbers in {(time.perf_counter() - started) * 1000:.0f} ms.")
+        return len(loaded)
+
+    def remember(self, serial_number, equipment_id):
+        """Records a serial -> equipment_id mapping (e.g. right after inserting the equipment)."""
+        with self._lock:
+            self._ids[serial_number] = equipment_id
+            self._negative.pop(serial_number, None)
+
+    def forget(self, serial_number):
+        with self._lock:
+            self._ids.pop(serial_number, None)
+            self._negative.pop(serial_number, None)
+
+    def resolve(self, serial_number, trust_negative=True):
+        """
+        Returns the equipment_id for a serial number, or None if there is none.
+
+        Args:
+            trust_negative (bool): Answer recently-unknown serials from memory. Pass False
+                for checks that must see equipment added by other processes just now.
+
+        Raises:
+            ConnectionError: If a lookup is needed and no database connection is available.
+        """
+        if not serial_number:
+            return None
+        resolved = self.resolve_many([serial_number], trust_negative=trust_negative)
+        return resolved.get(serial_number) if resolved is not None else None
+
+    def resolve_many(self, serial_numbers, trust_negative=True):
+        """
+        Resolves many serial numbers; cache misses are looked up with one IN UNNEST query.
+
+        Returns:
+            dict | None: {serial_number: equipment_id} for the serials that exist, or None
+            if the database lookup for the misses failed.
+        """
+        resolved = {}
+        misses = []
+        now = time.monotonic()
+        with self._lock:
+            for serial_number in {sn for sn in serial_numbers if sn}:
+                equipment_id = self._ids.get(serial_number)
+                if equipment_id is not None:
+                    self.hits += 1
+                    resolved[serial_number] = equipment_id
+                    continue
+                expires_at = self._negative.get(serial_number)
+                if trust_negative and expires_at is not None and expires_at > now:
+                    self.negative_hits += 1
+                    continue
+                misses.append(serial_number)
+        if not misses:
+            return resolved
+
+        found = self._lookup_db(misses)
+        if found is None:
+            return None
+        expires_at = time.monotonic() + self.negative_ttl_seconds
+        with self._lock:
+            for serial_number in misses:
+                equipment_id = found.get(serial_number)
+                if equipment_id is not None:
+                    self._ids[serial_number] = equipment_id
+                    self._negative.pop(serial_number, None)
+                    resolved[serial_number] = equipment_id
+                else:
+                    self._negative[serial_number] = expires_at
+                    self._negative.move_to_end(serial_number)
+            while len(self._negative) > self.max_negative_entries:
+                self._negative.popitem(last=False)
+        return resolved
+
+    def _lookup_db(self, serial_numbers):
+        self.db_lookups += 1
+        sql = "SELECT serial_number, equipment_id FROM Equipment WHERE serial_number IN UNNEST(@serials)"
+        params = {"serials": sorted(serial_numbers)}
+        param_types_map = {"serials": param_types.Array(param_types.STRING)}
+        results = spanner_data.run_query(sql, params=params, param_types_map=param_types_map,
+                                         expected_fields=["serial_number", "equipment_id"])
+        if results is None:
+            return None
+        return {row["serial_number"]: row["equipment_id"] for row in results}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "known_serials": len(self._ids),
+                "negative_entries": len(self._negative),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "db_lookups": self.db_lookups,
+            }
+
+
+# Process-wide resolver shared by every caller.
+serial_resolver = SerialResolver()
@@ -61,6 +61,14 @@ def setup_fleet_schema_and_indexes(db_instance):
         """CREATE TABLE IF NOT EXISTS Equipment (equipment_id STRING(36) NOT NULL, serial_number STRING(MAX) NOT NULL, description STRING(MAX), list_price FLOAT64, meter_hours INT64, current_address STRING(MAX), current_city STRING(MAX), current_state_province STRING(MAX), current_postal_code STRING(MAX), current_country STRING(MAX), category STRING(MAX), subcategory STRING(MAX), make STRING(MAX), model STRING(MAX), model_year INT64, financing_eligible BOOL, warranty_eligible BOOL, photo_url STRING(MAX), video_url STRING(MAX), latitude FLOAT64, longitude FLOAT64, current_service_location_id STRING(36), current_customer_id STRING(36), create_time TIMESTAMP NOT NULL OPTIONS(allow_commit_timestamp=true), CONSTRAINT FK_Equipment_ServiceLocation FOREIGN KEY (current_service_location_id) REFERENCES ServiceLocation (location_id), CONSTRAINT FK_Equipment_Customer FOREIGN KEY (current_customer_id) REFERENCES Customer (customer_id)) PRIMARY KEY (equipment_id)""",
         """CREATE TABLE IF NOT EXISTS MaintenanceJob (job_id STRING(36) NOT NULL, equipment_id STRING(36) NOT NULL, job_date TIMESTAMP, job_description STRING(MAX), cost FLOAT64, service_type STRING(MAX), create_time TIMESTAMP NOT NULL OPTIONS(allow_commit_timestamp=true), CONSTRAINT FK_MaintenanceJob_Equipment FOREIGN KEY (equipment_id) REFERENCES Equipment (equipment_id)) PRIMARY KEY (job_id)""",
         """CREATE TABLE IF NOT EXISTS CustomerEquipmentAssignment (assignment_id STRING(36) NOT NULL, customer_id STRING(36) NOT NULL, equipment_id STRING(36) NOT NULL, assignment_start_date TIMESTAMP, assignment_end_date TIMESTAMP, assignment_type STRING(MAX), create_time TIMESTAMP NOT NULL OPTIONS(allow_commit_timestamp=true), CONSTRAINT FK_Assignment_Customer FOREIGN KEY (customer_id) REFERENCES Customer (customer_id), CONSTRAINT FK_Assignment_Equipment FOREIGN KEY (equipment_id) REFERENCES Equipment (equipment_id)) PRIMARY KEY (assignment_id)""",
+        # last_update_time: commit timestamp of the latest in-place update (NULL until the first
+        # one); the app's detail-page ETags are built from it. ALTERs so existing databases get it too.
+        "ALTER TABLE ServiceLocation ADD COLUMN IF NOT EXISTS last_update_time TIMESTAMP OPTIONS(allow_commit_timestamp=true)",
+        "ALTER TABLE Customer ADD COLUMN IF NOT EXISTS last_update_time TIMESTAMP OPTIONS(allow_commit_timestamp=true)",
+        "ALTER TABLE Equipment ADD COLUMN IF NOT EXISTS last_update_time TIMESTAMP OPTIONS(allow_commit_timestamp=true)",
+        # Batch reliability metrics (reliability_metrics.py); rewritten wholesale on each recompute.
+        """CREATE TABLE IF NOT EXISTS EquipmentReliability (equipment_id STRING(36) NOT NULL, make STRING(MAX), model STRING(MAX), job_count INT64, repair_count INT64, mean_days_between_jobs FLOAT64, cost_per_meter_hour FLOAT64, repair_ratio FLOAT64, trailing_spend FLOAT64, last_job_date TIMESTAMP, computed_at TIMESTAMP NOT NULL OPTIONS(allow_commit_timestamp=true)) PRIMARY KEY (equipment_id)""",
+        """CREATE TABLE IF NOT EXISTS ModelReliability (make STRING(MAX) NOT NULL, model STRING(MAX) NOT NULL, unit_count INT64, job_count INT64, repair_count INT64, mean_days_between_jobs FLOAT64, cost_per_meter_hour FLOAT64, repair_ratio FLOAT64, trailing_spend FLOAT64, computed_at TIMESTAMP NOT NULL OPTIONS(allow_commit_timestamp=true)) PRIMARY KEY (make, model)""",
         "CREATE INDEX IF NOT EXISTS EquipmentBySerialNumber ON Equipment(serial_number)",
         "CREATE INDEX IF NOT EXISTS EquipmentByCategoryMakeModel ON Equipment(category, make, model, model_year)",
         "CREATE INDEX IF NOT EXISTS EquipmentByLocation ON Equipment(current_city, current_state_province)",
@@ -70,6 +78,8 @@ def setup_fleet_schema_and_indexes(db_instance):
         "CREATE INDEX IF NOT EXISTS MaintenanceJobByEquipment ON MaintenanceJob(equipment_id, job_date DESC)",
         "CREATE INDEX IF NOT EXISTS MaintenanceJobByDate ON MaintenanceJob(job_date DESC)",
         "CREATE INDEX IF NOT EXISTS CustomerByName ON Customer(customer_name)",
+        "CREATE INDEX IF NOT EXISTS EquipmentByMakeModel ON Equipment(make, model)",
+        "CREATE INDEX IF NOT EXISTS ServiceLocationByName ON ServiceLocation(name)",
         "CREATE INDEX IF NOT EXISTS CustomerEquipmentAssignmentByCustomerEquipment ON CustomerEquipmentAssignment(customer_id, equipment_id)",
         "CREATE INDEX IF NOT EXISTS CustomerEquipmentAssignmentByEquipment ON CustomerEquipmentAssignment(equipment_id)",
     ]
@@ -81,6 +91,31 @@ def setup_fleet_graph_definition(db_instance):
     ]
     return run_ddl_statements(db_instance, ddl_statements, "Create FleetPro Property Graph Definition")
 
+CHANGE_STREAM_NAME = os.environ.get("CHANGE_STREAM_NAME", "FleetChanges")
+
+def setup_fleet_change_stream(db_instance):
+    # Read by change_feed.py (CHANGE_FEED_SOURCE=change_stream) to push row changes to the app's caches.
+    # CREATE CHANGE STREAM has no IF NOT EXISTS, so look the stream up first.
+    if not db_instance:
+        print("Skipping DDL (Create FleetPro Change Stream) - database connection not available.")
+        return False
+    try:
+        with db_instance.snapshot() as snapshot:
+            existing = list(snapshot.execute_sql(
+                "SELECT change_stream_name FROM INFORMATION_SCHEMA.CHANGE_STREAMS WHERE change_stream_name = @name",
+                params={"name": CHANGE_STREAM_NAME}, param_types={"name": spanner.param_types.STRING}))
+    except Exception as e:
+        print(f"ERROR checking for change stream '{CHANGE_STREAM_NAME}': {type(e).__name__} - {e}")
+        traceback.print_exc()
+        return False
+    if existing:
+        print(f"\n--- Change stream '{CHANGE_STREAM_NAME}' already exists; skipping creation. ---")
+        return True
+    ddl_statements = [
+        f"""CREATE CHANGE STREAM {CHANGE_STREAM_NAME} FOR Equipment, MaintenanceJob, CustomerEquipmentAssignment OPTIONS (retention_period = '1d', value_capture_type = 'OLD_AND_NEW_VALUES')"""
+    ]
+    return run_ddl_statements(db_instance, ddl_statements, "Create FleetPro Change Stream")
+
 CITY_COORDS = {
     "Toronto": (43.6532, -79.3832), "Boston": (42.3601, -71.0589),
     "Los Angeles": (34.0522, -118.2437), "Houston": (29.7604, -95.3698),
@@ -278,6 +313,7 @@ if __name__ == "__main__":
     if not database_client_object: print("\nCritical Error: Spanner database connection not established. Aborting."); exit(1)
     if not setup_fleet_schema_and_indexes(database_client_object): print("\nAborting: errors during schema/index creation."); exit(1)
     if not setup_fleet_graph_definition(database_client_object): print("\nAborting: errors during graph definition creation."); exit(1)
+    if not setup_fleet_change_stream(database_client_object): print("\nAborting: errors during change stream creation."); exit(1)
     if not insert_fleet_data(database_client_object): print("\nScript finished with errors during data insertion."); exit(1)
     end_time = time.time()
     print("\n-----------------------------------------")
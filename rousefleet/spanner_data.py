@@ -0,0 +1,556 @@
+# spanner_data.py - Shared Spanner data-access layer for Rouse FleetPro
+#
+# Used by app.py, db.py and the fleet_analyzer agent tools. Owns the one
+# spanner.Client / Database / session pool per process and the single query
+# entry point (run_query) every data-access helper goes through.
+#
+# Pool configuration (environment variables, read on first use):
+#   SPANNER_POOL_TYPE           fixed (default) | bursty | pinging
+#   SPANNER_POOL_SIZE           sessions kept in the pool (default 10)
+#   SPANNER_POOL_TIMEOUT        seconds to wait for a free session (default 10)
+#   SPANNER_POOL_PING_INTERVAL  seconds between keep-alive pings, pinging pool only (default 300)
+#
+# Read consistency (see parse_consistency): "strong" (default), "exact:<seconds>" or
+# "max:<seconds>". Set per call with consistency=..., or for everything a route runs
+# with @with_read_consistency(...) / `with read_consistency(...)`.
+#   SPANNER_STALE_READ_CONSISTENCY  what stale-tolerant paths (lists, reference data,
+#                                   graph examples) use (default "max:10")
+#
+# Every query is timed and tagged (Spanner request_tag) under a query name, which is
+# the calling data-access function unless query_name=... is passed; see query_stats.
+
+import contextvars
+import functools
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+
+from google.cloud import spanner
+from google.cloud.spanner_v1 import ExecuteSqlRequest
+from google.api_core import exceptions
+
+try:
+    from . import query_stats  # staged inside the fleet_analyzer package
+except ImportError:
+    import query_stats
+
+POOL_TYPES = ("fixed", "bursty", "pinging")
+STRONG = "strong"
+STALE_READ_CONSISTENCY = os.environ.get("SPANNER_STALE_READ_CONSISTENCY", "max:10")
+INIT_RETRY_SECONDS = float(os.environ.get("SPANNER_INIT_RETRY_SECONDS", "10"))
+
+# --- Module State (one connection per process) ---
+_config_overrides = {}
+_spanner_client = None
+_database = None
+_pool = None
+_pool_settings = {}
+_init_attempted = False
+_init_retry_at = 0.0  # time.monotonic() before which a failed connection isn't retried
+_init_lock = threading.Lock()
+_ping_thread = None
+_batch_executor = None
+_warmed = False
+_route_consistency = contextvars.ContextVar("spanner_read_consistency", default=None)
+
+
+def configure(project_id=None, instance_id=None, database_id=None,
+              pool_type=None, pool_size=None, pool_timeout=None, ping_interval=None):
+    """
+    Overrides the environment-derived Spanner settings for this process.
+
+    Must be called before the first get_database()/run_query() call; settings
+    passed after the connection has been created are ignored.
+    """
+    if _init_attempted:
+        print("spanner_data: configure() called after the database was initialized. Ignoring new settings.")
+        return
+    overrides = {
+        "project_id": project_id, "instance_id": instance_id, "database_id": database_id,
+        "pool_type": pool_type, "pool_size": pool_size, "pool_timeout": pool_timeout,
+        "ping_interval": ping_interval,
+    }
+    _config_overrides.update({k: v for k, v in overrides.items() if v is not None})
+
+
+def _resolve_settings():
+    settings = {
+        "project_id": os.environ.get("GOOGLE_CLOUD_PROJECT"),
+        "instance_id": os.environ.get("SPANNER_INSTANCE_ID", "rousefleet-graph-instance"),
+        "database_id": os.environ.get("SPANNER_DATABASE_ID", "graphdb"),
+        "pool_type": os.environ.get("SPANNER_POOL_TYPE", "fixed"),
+        "pool_size": os.environ.get("SPANNER_POOL_SIZE", "10"),
+        "pool_timeout": os.environ.get("SPANNER_POOL_TIMEOUT", "10"),
+        "ping_interval": os.environ.get("SPANNER_POOL_PING_INTERVAL", "300"),
+    }
+    settings.update(_config_overrides)
+    settings["pool_type"] = str(settings["pool_type"]).lower()
+    if settings["pool_type"] not in POOL_TYPES:
+        print(f"spanner_data: Warning - Unknown SPANNER_POOL_TYPE '{settings['pool_type']}'. Falling back to 'fixed'.")
+        settings["pool_type"] = "fixed"
+    settings["pool_size"] = max(1, int(settings["pool_size"]))
+    settings["pool_timeout"] = float(settings["pool_timeout"])
+    settings["ping_interval"] = max(1, int(settings["ping_interval"]))
+    return settings
+
+
+def _build_pool(settings):
+    pool_type = settings["pool_type"]
+    if pool_type == "bursty":
+        return spanner.BurstyPool(target_size=settings["pool_size"])
+    if pool_type == "pinging":
+        return spanner.PingingPool(
+            size=settings["pool_size"],
+            default_timeout=settings["pool_timeout"],
+            ping_interval=settings["ping_interval"],
+        )
+    return spanner.FixedSizePool(size=settings["pool_size"], default_timeout=settings["pool_timeout"])
+
+
+def _ping_forever(pool, interval):
+    # PingingPool only refreshes sessions when ping() is called; keep that off the request path.
+    while True:
+        try:
+            pool.ping()
+        except Exception as e:
+            print(f"spanner_data: Session pool ping failed: {e}")
+        time.sleep(min(interval, 60))
+
+
+def reset():
+    """
+    Forgets this process's client, pool and worker threads so the next get_database()
+    reconnects. Call in a freshly forked worker: gRPC channels, pooled sessions and
+    threads inherited from the parent must not be used by the child.
+    """
+    global _spanner_client, _database, _pool, _pool_settings, _init_attempted, _init_retry_at, _ping_thread, _batch_executor, _warmed, _init_lock
+    _init_lock = threading.Lock()  # may have been held by another parent thread at fork time
+    _spanner_client = None
+    _database = None
+    _pool = None
+    _pool_settings = {}
+    _init_attempted = False
+    _init_retry_at = 0.0
+    _ping_thread = None
+    _batch_executor = None
+    _warmed = False
+
+
+def is_warm():
+    """True once warm_up() has succeeded in this process."""
+    return _warmed
+
+
+def get_database():
+    """
+    Returns the process-wide Spanner Database object, connecting on first use.
+
+    Returns None if the connection could not be established (missing project,
+    unknown instance/database, permissions...). A failed attempt is retried on the
+    first call after SPANNER_INIT_RETRY_SECONDS, so a worker whose warm-up failed
+    recovers through its readiness probe once Spanner is reachable.
+    """
+    global _spanner_client, _database, _pool, _pool_settings, _init_attempted, _init_retry_at, _ping_thread
+    if _database is not None or (_init_attempted and time.monotonic() < _init_retry_at):
+        return _database
+
+    with _init_lock:
+        if _database is not None or (_init_attempted and time.monotonic() < _init_retry_at):
+            return _database
+        _init_attempted = True
+        _init_retry_at = time.monotonic() + INIT_RETRY_SECONDS
+
+        settings = _resolve_settings()
+        if not settings["project_id"]:
+            print("spanner_data: Error - GOOGLE_CLOUD_PROJECT is not set. Cannot initialize Spanner client.")
+            return None
+
+        try:
+            _spanner_client = spanner.Client(project=settings["project_id"])
+            instance = _spanner_client.instance(settings["instance_id"])
+            pool = _build_pool(settings)
+            database = instance.database(settings["database_id"], pool=pool)
+            print(f"spanner_data: Connecting to Spanner: {instance.name}/databases/{database.name} "
+                  f"(pool={settings['pool_type']}, size={settings['pool_size']})")
+
+            if not database.exists():
+                print(f"spanner_data: Error - Database '{settings['database_id']}' does not exist in instance '{settings['instance_id']}'.")
+                print("spanner_data: Please ensure the database and FleetGraph schema are created.")
+                return None
+
+            if settings["pool_type"] == "pinging":
+                _ping_thread = threading.Thread(
+                    target=_ping_forever, args=(pool, settings["ping_interval"]),
+                    name="spanner-pool-ping", daemon=True,
+                )
+                _ping_thread.start()
+
+            _pool = pool
+            _pool_settings = settings
+            _database = database
+            print("spanner_data: Spanner database connection check successful.")
+        except exceptions.NotFound:
+            print(f"spanner_data: Error - Spanner instance '{settings['instance_id']}' not found in project '{settings['project_id']}'.")
+        except Exception as e:
+            print(f"spanner_data: An unexpected error occurred during Spanner initialization: {e}")
+            traceback.print_exc()
+    return _database
+
+
+def get_separate_database(target_size):
+    """
+    Returns a new Database handle on this process's client with its own session pool, for
+    long-running readers (the change stream's partition readers) that would otherwise
+    hold sessions from the request pool for their whole life. The pool grows on demand
+    and keeps up to target_size idle sessions. None if Spanner isn't reachable.
+    """
+    if get_database() is None:
+        return None
+    instance = _spanner_client.instance(_pool_settings["instance_id"])
+    return instance.database(_pool_settings["database_id"], pool=spanner.BurstyPool(target_size=max(1, target_size)))
+
+
+# --- Read Consistency ---
+def parse_consistency(value):
+    """
+    Normalizes a read-consistency setting.
+
+    Args:
+        value: None or "strong"; "exact:<seconds>" / "max:<seconds>"; or a
+            ("exact"|"max", seconds) tuple.
+
+    Returns:
+        tuple: ("strong", None), ("exact", timedelta) or ("max", timedelta).
+
+    Raises:
+        ValueError: If the setting can't be parsed.
+    """
+    if value is None or value == STRONG:
+        return (STRONG, None)
+    if isinstance(value, str):
+        mode, _, seconds = value.partition(":")
+    else:
+        mode, seconds = value
+    mode = str(mode).strip().lower()
+    if mode not in ("exact", "max"):
+        raise ValueError(f"Unknown read consistency '{value}'. Use 'strong', 'exact:<seconds>' or 'max:<seconds>'.")
+    staleness = seconds if isinstance(seconds, timedelta) else timedelta(seconds=float(seconds))
+    if staleness <= timedelta(0):
+        return (STRONG, None)
+    return (mode, staleness)
+
+
+def staleness_bound_seconds(value):
+    """Returns how far behind a read with this consistency may be, in seconds (0 for strong)."""
+    mode, staleness = parse_consistency(value)
+    return staleness.total_seconds() if staleness else 0.0
+
+
+def current_staleness_seconds():
+    """How far behind reads in this context may be, per the read_consistency() in effect (0 for strong)."""
+    mode, staleness = _route_consistency.get() or (STRONG, None)
+    return staleness.total_seconds() if staleness else 0.0
+
+
+@contextmanager
+def read_consistency(value):
+    """Makes value the default consistency for queries run inside the with-block (this thread/context only)."""
+    token = _route_consistency.set(parse_consistency(value))
+    try:
+        yield
+    finally:
+        _route_consistency.reset(token)
+
+
+def with_read_consistency(value):
+    """Decorator form of read_consistency(), for Flask views and helpers."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with read_consistency(value):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _snapshot_kwargs(consistency, multi_use=False):
+    """Resolves consistency (explicit > route default > strong) into db.snapshot() keyword arguments."""
+    mode, staleness = parse_consistency(consistency) if consistency is not None else (_route_consistency.get() or (STRONG, None))
+    if mode == "exact":
+        return {"exact_staleness": staleness}
+    if mode == "max":
+        # Bounded staleness is only allowed on single-use snapshots; a multi-use one
+        # gets a fixed read timestamp that old instead.
+        return {"exact_staleness": staleness} if multi_use else {"max_staleness": staleness}
+    return {}
+
+
+def warm_up():
+    """
+    Pre-creates the pool's sessions and runs a trivial query so that the first
+    real requests don't pay the session-creation / cold-channel cost.
+
+    Returns True if the database is reachable and the warmup query succeeded.
+    """
+    global _warmed
+    started = time.perf_counter()
+    database = get_database()
+    if not database:
+        return False
+
+    if _pool_settings.get("pool_type") == "bursty":
+        # BurstyPool creates sessions lazily; check out up to target_size and hand them back.
+        sessions = []
+        try:
+            for _ in range(_pool_settings["pool_size"]):
+                sessions.append(_pool.get())
+        except Exception as e:
+            print(f"spanner_data: Warning - Could only pre-create {len(sessions)} bursty sessions: {e}")
+        finally:
+            for session in sessions:
+                _pool.put(session)
+
+    result = run_query("SELECT 1", expected_fields=["ok"])
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if result is None:
+        print(f"spanner_data: Warmup query failed after {elapsed_ms:.0f} ms.")
+        return False
+    _warmed = True
+    print(f"spanner_data: Session pool warmed ({_pool_settings.get('pool_type')}, size={_pool_settings.get('pool_size')}) in {elapsed_ms:.0f} ms.")
+    return True
+
+
+def run_query(sql, params=None, param_types_map=None, expected_fields=None, database=None, consistency=None,
+              query_name=None):
+    """
+    Executes a read-only SQL or GQL query in a single-use snapshot.
+
+    Args:
+        sql (str): The SQL statement or GQL query (starting with 'Graph ...').
+        params (dict, optional): Dictionary of query parameters.
+        param_types_map (dict, optional): Dictionary mapping param names to Spanner types.
+        expected_fields (list[str], optional): Column names in order. Looked up from
+            the result metadata when omitted.
+        database (optional): Explicit Database object; defaults to the shared one.
+        consistency (optional): Read consistency (see parse_consistency); defaults to
+            the route's setting, else strong.
+        query_name (str, optional): Name the query is tagged and aggregated under;
+            defaults to the calling function.
+
+    Returns:
+        list[dict]: One dict per row, or None on a handled query error.
+
+    Raises:
+        ConnectionError: If no database connection is available.
+    """
+    db = database or get_database()
+    if not db:
+        print("Error in run_query: Database connection (db object) is not available.")
+        # This ConnectionError will be caught by the updated fleet_advisor_agent_logic
+        raise ConnectionError("Spanner database connection not initialized.")
+
+    # print(f"--- Executing SQL ---\nSQL: {sql}") # Verbose logging, uncomment for debugging
+    # if params: print(f"Params: {params}")
+
+    query_name = query_name or query_stats.caller_query_name()
+    try:
+        with db.snapshot(**_snapshot_kwargs(consistency)) as snapshot:
+            return _execute_to_dicts(snapshot, sql, params, param_types_map, expected_fields, query_name=query_name)
+    except Exception as e:
+        return _handle_query_error(e, "run_query")
+
+
+def stream_query(sql, params=None, param_types_map=None, expected_fields=None, database=None, consistency=None,
+                 query_name=None):
+    """
+    Streams a read-only query's rows lazily from execute_sql, one compact list per row.
+
+    Unlike run_query nothing is buffered: memory stays constant regardless of result
+    size and the caller sees the first row as soon as Spanner sends it. The snapshot
+    (and its pooled session) is held until the iterator is exhausted or closed.
+
+    Args:
+        expected_fields (list[str], optional): When given, rows whose length doesn't
+            match are skipped with a warning.
+        consistency (optional): As for run_query; resolved when stream_query is called.
+        query_name (str, optional): As for run_query. The query is recorded when the
+            iterator finishes, so its time includes the consumer's.
+
+    Returns:
+        iterator[list]: The row values in column order.
+
+    Raises:
+        ConnectionError: If no database connection is available (raised immediately).
+        Query errors are raised from the iterator; rows already yielded can't be retracted.
+    """
+    db = database or get_database()
+    if not db:
+        print("Error in stream_query: Database connection (db object) is not available.")
+        raise ConnectionError("Spanner database connection not initialized.")
+    return _stream_rows(db, sql, params, param_types_map, expected_fields, _snapshot_kwargs(consistency),
+                        query_name or query_stats.caller_query_name(), query_stats.current_route())
+
+
+def _stream_rows(db, sql, params, param_types_map, expected_fields, snapshot_kwargs, query_name, route):
+    started = time.perf_counter()
+    row_count = bytes_decoded = 0
+    error = None
+    try:
+        with db.snapshot(**snapshot_kwargs) as snapshot:
+            results = snapshot.execute_sql(sql, params=params, param_types=param_types_map,
+                                           request_options={"request_tag": query_stats.request_tag(query_name, route)})
+            field_count = len(expected_fields) if expected_fields else None
+            for row_idx, row in enumerate(results):
+                if field_count is not None and len(row) != field_count:
+                    print(f"Warning in stream_query: Mismatch field names ({field_count}) vs row values ({len(row)}). Row {row_idx}: {row}")
+                    continue
+                row_count += 1
+                bytes_decoded += query_stats.approx_row_bytes(row)
+                yield row
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        query_stats.record(query_name, route, time.perf_counter() - started, rows=row_count,
+                           bytes_decoded=bytes_decoded, error=error)
+
+
+def _execute_to_dicts(snapshot, sql, params=None, param_types_map=None, expected_fields=None, caller="run_query",
+                      query_name=None, route=None):
+    query_name = query_name or caller
+    route = route or query_stats.current_route()
+    profile = query_stats.should_profile()
+    request_options = {"request_tag": query_stats.request_tag(query_name, route)}
+    started = time.perf_counter()
+    results_list = []
+    bytes_decoded = 0
+    try:
+        if profile:
+            results = snapshot.execute_sql(sql, params=params, param_types=param_types_map, request_options=request_options,
+                                           query_mode=ExecuteSqlRequest.QueryMode.PROFILE)
+        else:
+            results = snapshot.execute_sql(sql, params=params, param_types=param_types_map, request_options=request_options)
+
+        field_names = expected_fields
+        for row_idx, row in enumerate(results):
+            if field_names is None:
+                # Result metadata is only populated once the first row has been streamed.
+                print(f"Warning in {caller}: expected_fields not provided. Attempting dynamic lookup.")
+                field_names = [field.name for field in results.fields]
+            if len(field_names) != len(row):
+                print(f"Warning in {caller}: Mismatch field names ({len(field_names)}) vs row values ({len(row)}). Row {row_idx}: {row}")
+                continue  # Skip malformed row
+            bytes_decoded += query_stats.approx_row_bytes(row)
+            results_list.append(dict(zip(field_names, row)))
+    except Exception as e:
+        query_stats.record(query_name, route, time.perf_counter() - started, rows=len(results_list),
+                           bytes_decoded=bytes_decoded, error=e)
+        raise
+    query_stats.record(query_name, route, time.perf_counter() - started, rows=len(results_list),
+                       bytes_decoded=bytes_decoded, profile=_profile_stats(results) if profile else None)
+    return results_list
+
+
+def _plain(value):
+    return value if isinstance(value, (str, int, float, bool)) or value is None else str(value)
+
+
+def _profile_stats(results):
+    """Extracts the PROFILE-mode execution stats (elapsed/cpu time, rows scanned...) as a plain dict."""
+    try:
+        query_stats_struct = results.stats.query_stats
+        return {key: _plain(query_stats_struct[key]) for key in query_stats_struct}
+    except Exception as e:
+        print(f"spanner_data: Could not read PROFILE stats: {e}")
+        return None
+
+
+def _handle_query_error(error, caller):
+    """Logs a query failure and returns None, re-raising ConnectionError for the callers that handle it."""
+    if isinstance(error, (exceptions.NotFound, exceptions.PermissionDenied, exceptions.InvalidArgument)):
+        print(f"Spanner Error in {caller} ({type(error).__name__}): {error}")
+        return None  # Return None to indicate a handled Spanner query failure
+    if isinstance(error, (ValueError, AttributeError)):  # Field processing or other result-shape problems
+        print(f"{type(error).__name__} in {caller} (e.g., query processing): {error}")
+        traceback.print_exception(type(error), error, error.__traceback__)
+        return None
+    if isinstance(error, ConnectionError):
+        print(f"ConnectionError in {caller}: {error}")
+        traceback.print_exception(type(error), error, error.__traceback__)
+        raise error  # Re-raise to be caught by the agent's specific ConnectionError handler
+    print(f"An UNEXPECTED error occurred during query execution in {caller}: {error}")
+    traceback.print_exception(type(error), error, error.__traceback__)
+    return None  # Return None instead of re-raising, to protect SSE streams
+
+
+def _get_batch_executor():
+    global _batch_executor
+    if _batch_executor is None:
+        with _init_lock:
+            if _batch_executor is None:
+                workers = max(1, int(os.environ.get("SPANNER_BATCH_READ_WORKERS", "8")))
+                _batch_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="spanner-batch-read")
+    return _batch_executor
+
+
+def run_queries_batch(queries, database=None, consistency=None):
+    """
+    Runs several named read queries concurrently inside one multi-use read-only snapshot.
+
+    All queries see the same read timestamp, and their round trips overlap instead of
+    running back to back, so a page needing N queries pays one BeginTransaction plus
+    the slowest query rather than the sum of all of them.
+
+    Args:
+        queries (dict): {name: {"sql": ..., "params": ..., "param_types_map": ..., "expected_fields": ...}}
+            (the same keyword arguments run_query takes). Each query is recorded as
+            "<calling function>[name]" unless its spec has a query_name.
+        database (optional): Explicit Database object; defaults to the shared one.
+        consistency (optional): As for run_query, except that "max" staleness is read
+            as an exact staleness of the same bound (multi-use snapshots need a fixed timestamp).
+
+    Returns:
+        dict: {name: list[dict] or None}. A failed query yields None for its name only.
+
+    Raises:
+        ConnectionError: If no database connection is available.
+    """
+    db = database or get_database()
+    if not db:
+        print("Error in run_queries_batch: Database connection (db object) is not available.")
+        raise ConnectionError("Spanner database connection not initialized.")
+    if not queries:
+        return {}
+
+    batch_results = {}
+    try:
+        with db.snapshot(multi_use=True, **_snapshot_kwargs(consistency, multi_use=True)) as snapshot:
+            # Begin explicitly so the concurrent reads share one transaction instead of
+            # racing to begin it inline on their first RPC.
+            snapshot.begin()
+            executor = _get_batch_executor()
+            caller_name = query_stats.caller_query_name()
+            route = query_stats.current_route()
+            futures = {
+                name: executor.submit(
+                    _execute_to_dicts, snapshot, spec["sql"], spec.get("params"),
+                    spec.get("param_types_map"), spec.get("expected_fields"), f"run_queries_batch[{name}]",
+                    spec.get("query_name") or f"{caller_name}[{name}]", route,
+                )
+                for name, spec in queries.items()
+            }
+            for name, future in futures.items():
+                try:
+                    batch_results[name] = future.result()
+                except Exception as e:
+                    batch_results[name] = _handle_query_error(e, f"run_queries_batch[{name}]")
+    except ConnectionError:
+        raise
+    except Exception as e:
+        _handle_query_error(e, "run_queries_batch")
+        return {name: None for name in queries}
+    return batch_results
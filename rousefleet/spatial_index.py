@@ -0,0 +1,291 @@
+# spatial_index.py - In-memory nearest-equipment index over Equipment coordinates
+#
+# Units are bucketed per category into a lat/lon grid (SPATIAL_CELL_DEGREES on a side).
+# A k-nearest query walks rings of cells outward from the query point and stops once the
+# k-th best great-circle distance is closer than anything the next ring could hold, so
+# it touches a handful of cells instead of every unit of the category.
+#
+# The index is warm-loaded from Equipment at worker start, kept current from the
+# location-update path (the update endpoint and telematics flushes), and fully reloaded
+# every SPATIAL_INDEX_RELOAD_SECONDS to pick up moves made through other workers.
+# Longitudes are not wrapped at the antimeridian; the fleet doesn't cross it.
+
+import math
+import os
+import threading
+import time
+import traceback
+
+try:
+    from . import spanner_data  # staged inside the fleet_analyzer package
+    from .geocoder import geocoder
+except ImportError:
+    import spanner_data
+    from geocoder import geocoder
+
+CELL_DEGREES = float(os.environ.get("SPATIAL_CELL_DEGREES", "0.5"))
+RELOAD_SECONDS = float(os.environ.get("SPATIAL_INDEX_RELOAD_SECONDS", "300"))
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180.0
+_UNSET = object()
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in kilometres."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _ring(ci, cj, r):
+    """Grid cells at Chebyshev distance r from (ci, cj)."""
+    if r == 0:
+        yield ci, cj
+        return
+    for dj in range(-r, r + 1):
+        yield ci - r, cj + dj
+        yield ci + r, cj + dj
+    for di in range(-r + 1, r):
+        yield ci + di, cj - r
+        yield ci + di, cj + r
+
+
+class SpatialIndex:
+    """
+    Thread-safe grid index of equipment positions, bucketed by category.
+
+    Args:
+        cell_degrees (float): Grid cell size in degrees of latitude/longitude.
+        reload_seconds (float): Interval of the background full reload; 0 disables it.
+    """
+
+    def __init__(self, cell_degrees=CELL_DEGREES, reload_seconds=RELOAD_SECONDS):
+        self.cell_degrees = cell_degrees
+        self.reload_seconds = reload_seconds
+        self._units = {}  # equipment_id -> {"category", "make", "lat", "lon", "city", "cell"}
+        self._cells = {}  # category -> {(ci, cj): set(equipment_id)}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._reload_thread = None
+        self._moves_during_load = None  # dict while a load is in progress
+        self.loaded = False
+        self.loaded_at = None
+        self.queries = 0
+        self.updates = 0
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees)
+
+    # --- Loading ---
+    def warm_load(self):
+        """
+        Loads every unit's category, make, city and coordinates from Equipment.
+
+        Returns:
+            int | None: Number of units loaded, or None if the load failed.
+        """
+        sql = "SELECT equipment_id, category, make, current_city, latitude, longitude FROM Equipment"
+        fields = ["equipment_id", "category", "make", "current_city", "latitude", "longitude"]
+        with self._load_lock:
+            return self._load(sql, fields)
+
+    def _load(self, sql, fields):
+        started = time.perf_counter()
+        with self._lock:
+            self._moves_during_load = {}
+        units, cells = {}, {}
+        try:
+            for equipment_id, category, make, city, lat, lon in spanner_data.stream_query(sql, expected_fields=fields):
+                self._place(units, cells, equipment_id, {"category": category, "make": make, "city": city, "lat": lat, "lon": lon})
+        except Exception as e:
+            print(f"spatial_index: Warm load failed: {e}")
+            with self._lock:
+                self._moves_during_load = None
+            return None
+        with self._lock:
+            # Moves committed while the stream ran may be missing from it; replay them.
+            for equipment_id, changes in self._moves_during_load.items():
+                unit = units.get(equipment_id)
+                if unit is not None or "category" in changes:
+                    self._place(units, cells, equipment_id, dict(unit or {}, **changes))
+            self._moves_during_load = None
+            self._units, self._cells = units, cells
+            self.loaded = True
+            self.loaded_at = time.time()
+        print(f"spatial_index: Loaded {len(units)} units in {(time.perf_counter() - started) * 1000:.0f} ms.")
+        self._ensure_reloader()
+        return len(units)
+
+    def _ensure_reloader(self):
+        if self.reload_seconds <= 0 or (self._reload_thread is not None and self._reload_thread.is_alive()):
+            return
+        self._reload_thread = threading.Thread(target=self._reload_forever, name="spatial-index-reload", daemon=True)
+        self._reload_thread.start()
+
+    def _reload_forever(self):
+        while True:
+            time.sleep(self.reload_seconds)
+            try:
+                self.warm_load()
+            except Exception as e:
+                print(f"spatial_index: Reload failed: {e}")
+                traceback.print_exc()
+
+    def _place(self, units, cells, equipment_id, unit):
+        """Inserts or repositions a unit in the given structures (caller holds the lock if shared)."""
+        previous = units.get(equipment_id)
+        if previous is not None and previous["cell"] is not None:
+            bucket = cells.get(previous["category"], {}).get(previous["cell"])
+            if bucket is not None:
+                bucket.discard(equipment_id)
+                if not bucket:
+                    del cells[previous["category"]][previous["cell"]]
+        cell = None
+        if unit["lat"] is not None and unit["lon"] is not None:
+            cell = self._cell(unit["lat"], unit["lon"])
+            cells.setdefault(unit["category"], {}).setdefault(cell, set()).add(equipment_id)
+        units[equipment_id] = {"category": unit["category"], "make": unit["make"], "city": unit["city"],
+                               "lat": unit["lat"], "lon": unit["lon"], "cell": cell}
+
+    # --- Write-path hooks (call after the commit succeeded) ---
+    def put(self, equipment_id, category, make=None, latitude=None, longitude=None, city=None):
+        """Adds a newly inserted unit."""
+        unit = {"category": category, "make": make, "city": city, "lat": latitude, "lon": longitude}
+        with self._lock:
+            self._place(self._units, self._cells, equipment_id, unit)
+            if self._moves_during_load is not None:
+                self._moves_during_load[equipment_id] = dict(unit)
+            self.updates += 1
+
+    def move(self, equipment_id, latitude=_UNSET, longitude=_UNSET, city=_UNSET):
+        """Applies a location update; fields left unset keep their indexed value."""
+        changes = {}
+        if latitude is not _UNSET: changes["lat"] = latitude
+        if longitude is not _UNSET: changes["lon"] = longitude
+        if city is not _UNSET: changes["city"] = city
+        if not changes:
+            return
+        with self._lock:
+            if self._moves_during_load is not None:
+                self._moves_during_load.setdefault(equipment_id, {}).update(changes)
+            unit = self._units.get(equipment_id)
+            if unit is None:
+                return  # Not loaded yet (or unknown); the next load picks it up.
+            self._place(self._units, self._cells, equipment_id, dict(unit, **changes))
+            self.updates += 1
+
+    # --- Queries ---
+    def nearest(self, latitude, longitude, k=5, category=None, make=None, max_km=None):
+        """
+        Finds the k units closest to a point.
+
+        Args:
+            latitude (float), longitude (float): Query point.
+            k (int): Number of units wanted.
+            category (str, optional): Only units of this category.
+            make (str, optional): Only units of this make.
+            max_km (float, optional): Ignore units further away than this.
+
+        Returns:
+            list[dict]: Up to k of {equipment_id, category, make, city, latitude, longitude,
+            distance_km}, nearest first.
+        """
+        if k <= 0:
+            return []
+        with self._lock:
+            self.queries += 1
+            if category is not None:
+                grids = [self._cells[category]] if category in self._cells else []
+            else:
+                grids = list(self._cells.values())
+            total_cells = sum(len(grid) for grid in grids)
+            ci, cj = self._cell(latitude, longitude)
+            best = []  # (distance_km, equipment_id), kept sorted, at most k long
+            seen_cells = 0
+            r = 0
+            while seen_cells < total_cells:
+                for cell in _ring(ci, cj, r):
+                    for grid in grids:
+                        members = grid.get(cell)
+                        if not members:
+                            continue
+                        seen_cells += 1
+                        for equipment_id in members:
+                            unit = self._units[equipment_id]
+                            if make is not None and unit["make"] != make:
+                                continue
+                            distance = haversine_km(latitude, longitude, unit["lat"], unit["lon"])
+                            if max_km is not None and distance > max_km:
+                                continue
+                            if len(best) < k or distance < best[-1][0]:
+                                best.append((distance, equipment_id))
+                                best.sort()
+                                del best[k:]
+                # Anything in ring r+1 is at least r cells away in latitude or longitude.
+                bound = self._ring_lower_bound_km(latitude, r + 1)
+                if (len(best) == k and best[-1][0] <= bound) or (max_km is not None and bound > max_km):
+                    break
+                r += 1
+            return [self._result(equipment_id, distance) for distance, equipment_id in best]
+
+    def _ring_lower_bound_km(self, latitude, r):
+        span = (r - 1) * self.cell_degrees
+        if span <= 0:
+            return 0.0
+        widest_lat = min(90.0, abs(latitude) + (r + 1) * self.cell_degrees)
+        return span * KM_PER_DEGREE * math.cos(math.radians(widest_lat))
+
+    def _result(self, equipment_id, distance):
+        unit = self._units[equipment_id]
+        return {
+            "equipment_id": equipment_id, "category": unit["category"], "make": unit["make"], "city": unit["city"],
+            "latitude": unit["lat"], "longitude": unit["lon"], "distance_km": round(distance, 2),
+        }
+
+    def city_centroid(self, city):
+        """Mean position of the indexed units in a city (case-insensitive), or None."""
+        wanted = (city or "").strip().casefold()
+        if not wanted:
+            return None
+        with self._lock:
+            points = [(unit["lat"], unit["lon"]) for unit in self._units.values()
+                      if unit["cell"] is not None and (unit["city"] or "").casefold() == wanted]
+        if not points:
+            return None
+        return sum(lat for lat, _ in points) / len(points), sum(lon for _, lon in points) / len(points)
+
+    def locate(self, location_text):
+        """
+        Resolves a free-text job location with the offline geocoder, falling back to the
+        centroid of the units indexed in a city the gazetteer doesn't know.
+
+        Returns:
+            (float, float) | None: Coordinates, or None if the location isn't recognized.
+        """
+        if not location_text:
+            return None
+        place = geocoder.geocode(location_text)
+        if place is not None:
+            return place["latitude"], place["longitude"]
+        return self.city_centroid(location_text) or self.city_centroid(str(location_text).split(",")[0])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "loaded_at": self.loaded_at,
+                "units": len(self._units),
+                "positioned_units": sum(1 for unit in self._units.values() if unit["cell"] is not None),
+                "categories": len(self._cells),
+                "cells": sum(len(grid) for grid in self._cells.values()),
+                "cell_degrees": self.cell_degrees,
+                "queries": self.queries,
+                "updates": self.updates,
+            }
+
+
+# Process-wide index shared by every caller.
+spatial_index = SpatialIndex()
@@ -0,0 +1,5 @@
+# The app's modules import each other as top-level modules (run from rousefleet/).
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
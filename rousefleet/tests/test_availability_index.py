@@ -0,0 +1,60 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+from availability_index import AvailabilityIndex, _IntervalTree
+
+INF = float("inf")
+
+
+def _brute_force(intervals, start, end):
+    return sorted(key for interval_start, interval_end, key in intervals if interval_start < end and interval_end > start)
+
+
+def test_overlapping_matches_brute_force():
+    rng = random.Random(7)
+    for size in (0, 1, 2, 3, 10, 257):
+        intervals = []
+        for key in range(size):
+            start = rng.choice([-INF, rng.uniform(0, 100)])
+            end = rng.choice([INF, (start if start > -INF else 0) + rng.uniform(0, 30)])
+            intervals.append((start, end, key))
+        tree = _IntervalTree(intervals)
+        assert len(tree) == size
+        for _ in range(50):
+            start = rng.uniform(-10, 110)
+            end = start + rng.uniform(0, 40)
+            assert sorted(tree.overlapping(start, end)) == _brute_force(intervals, start, end)
+
+
+def test_overlapping_treats_intervals_as_half_open():
+    tree = _IntervalTree([(0, 10, "a"), (10, 20, "b")])
+    assert tree.overlapping(10, 15) == ["b"]
+    assert sorted(tree.overlapping(5, 15)) == ["a", "b"]
+    assert tree.overlapping(20, 30) == []
+
+
+def test_deep_tree_builds_without_recursion():
+    tree = _IntervalTree((i, i + 1, i) for i in range(50000))
+    assert tree.overlapping(25000.5, 25001) == [25000]
+
+
+def test_free_units_across_tree_and_overflow():
+    index = AvailabilityIndex(reload_seconds=0, rebuild_threshold=2)
+    day = datetime(2026, 5, 1, tzinfo=timezone.utc)
+    for equipment_id, category in (("E1", "Excavator"), ("E2", "Excavator"), ("E3", "Loader")):
+        index.add_unit(equipment_id, category, make="CAT")
+    index.put_assignment("A1", "E1", day, day + timedelta(days=5))
+    index.put_assignment("A2", "E3", None, None)  # open-ended both ways
+    index.put_assignment("A3", "E2", day + timedelta(days=10), day + timedelta(days=12))  # passes the threshold
+    assert index.rebuilds == 1
+
+    window = (day + timedelta(days=4), day + timedelta(days=11))
+    assert index.free_units(*window, category="Excavator") == set()
+    assert index.free_units(day + timedelta(days=5), day + timedelta(days=10), category="Excavator") == {"E1", "E2"}
+    assert set(index.booked_units(*window)) == {"E1", "E2", "E3"}
+
+    index.put_assignment("A1", "E1", day - timedelta(days=5), day)  # moved out of the window after the rebuild
+    assert index.free_units(*window, category="Excavator", make="CAT") == {"E1"}
+    index.remove_assignment("A3")
+    assert index.is_free("E2", *window)
+    assert not index.is_free("E3", *window)
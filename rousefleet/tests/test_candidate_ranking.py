@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from candidate_ranking import CandidatePool, parse_weights, score_pool
+
+NOW = datetime(2026, 6, 1, tzinfo=timezone.utc)
+
+
+def _unit(equipment_id, latitude, longitude, meter_hours, location_id=None):
+    return {"equipment_id": equipment_id, "serial_number": f"SN-{equipment_id}", "make": "CAT", "model": "320",
+            "model_year": 2022, "meter_hours": meter_hours, "description": None, "current_city": None,
+            "latitude": latitude, "longitude": longitude, "current_service_location_id": location_id}
+
+
+@pytest.fixture
+def pool():
+    units = [
+        _unit("NEAR", 43.70, -79.40, 4000, "L-FULL"),
+        _unit("FAR", 45.42, -75.70, 500),
+        _unit("NOWHERE", None, None, None),
+    ]
+    maintenance = [
+        {"equipment_id": "NEAR", "last_job_date": NOW - timedelta(days=10), "trailing_spend": 100.0},
+        {"equipment_id": "FAR", "last_job_date": NOW - timedelta(days=400), "trailing_spend": 900.0},
+        {"equipment_id": "GONE", "last_job_date": NOW, "trailing_spend": 1.0},
+    ]
+    return CandidatePool(units, maintenance)
+
+
+def _only(factor):
+    return parse_weights(f"{factor}=1")
+
+
+def test_each_factor_orders_units(pool):
+    toronto = (43.65, -79.38)
+    now = NOW.timestamp()
+    assert [c["equipment_id"] for c in score_pool(pool, 3, job_point=toronto, weights=_only("distance"), now=now)] == \
+        ["NEAR", "FAR", "NOWHERE"]
+    assert score_pool(pool, 1, weights=_only("meter_hours"), now=now)[0]["equipment_id"] == "FAR"
+    assert score_pool(pool, 1, weights=_only("maintenance_recency"), now=now)[0]["equipment_id"] == "NEAR"
+    assert score_pool(pool, 1, weights=_only("maintenance_spend"), now=now)[0]["equipment_id"] == "NOWHERE"
+    assert score_pool(pool, 1, weights=_only("yard_occupancy"), over_capacity_ids=["L-FULL"], now=now)[0]["equipment_id"] == "NEAR"
+
+
+def test_breakdown_reports_values_scores_and_weights(pool):
+    best = score_pool(pool, 1, job_point=(43.65, -79.38), now=NOW.timestamp())[0]
+    assert set(best["factors"]) == {"distance", "meter_hours", "maintenance_recency", "maintenance_spend", "yard_occupancy"}
+    assert best["factors"]["maintenance_recency"]["value"] == pytest.approx(10.0)
+    assert 0 < best["distance_km"] < 10
+    total = sum(factor["weight"] for factor in best["factors"].values())
+    assert best["score"] == pytest.approx(sum(f["weight"] * f["score"] for f in best["factors"].values()) / total, abs=1e-3)
+
+
+def test_without_a_job_point_distance_carries_no_weight(pool):
+    best = score_pool(pool, 1, now=NOW.timestamp())[0]
+    assert "distance" not in best["factors"] and "distance_km" not in best
+
+
+def test_booked_units_are_left_out(pool):
+    ranked = score_pool(pool, 5, job_point=(43.65, -79.38), booked_ids=["NEAR", "UNKNOWN"], now=NOW.timestamp())
+    assert [c["equipment_id"] for c in ranked] == ["FAR", "NOWHERE"]
+    assert score_pool(pool, 5, booked_ids=["NEAR", "FAR", "NOWHERE"]) == []
+
+
+def test_weights_are_validated(pool):
+    with pytest.raises(ValueError):
+        parse_weights("distance=1,colour=2")
+    with pytest.raises(ValueError):
+        score_pool(pool, 1, weights=parse_weights("distance=1"))  # distance dropped without a job point
+    assert score_pool(CandidatePool([], []), 5) == []
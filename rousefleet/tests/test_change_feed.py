@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta, timezone
+
+import change_feed
+from change_feed import ChangeFeed, ChangeStreamSource, PollingSource
+
+T0 = datetime(2026, 6, 1, tzinfo=timezone.utc)
+
+
+def test_in_process_events_reach_matching_subscribers():
+    feed = ChangeFeed("in_process")
+    everything, jobs = [], []
+    feed.subscribe(everything.append)
+    feed.subscribe(jobs.append, tables=["MaintenanceJob"])
+    assert feed.start() and not feed.complete  # only this process's writes
+    feed.publish("Equipment", {"equipment_id": "E1"}, mod_type="UPDATE", values={"current_city": "Ottawa"})
+    feed.publish("MaintenanceJob", {"job_id": "J1"}, mod_type="INSERT", values={"equipment_id": "E1"})
+    assert [(event["table"], event["mod_type"]) for event in everything] == [("Equipment", "UPDATE"), ("MaintenanceJob", "INSERT")]
+    assert everything[0]["columns"] == ["current_city"] and everything[1]["columns"] is None
+    assert [event["keys"] for event in jobs] == [{"job_id": "J1"}]
+    assert feed.stats()["events"] == {"Equipment": 1, "MaintenanceJob": 1}
+
+
+def test_a_failing_subscriber_does_not_stop_the_others():
+    feed = ChangeFeed("in_process")
+    received = []
+
+    def broken(event):
+        raise RuntimeError("boom")
+
+    feed.subscribe(broken)
+    listener = feed.subscribe(received.append)
+    feed.start()
+    feed.publish("Equipment", {"equipment_id": "E1"})
+    assert len(received) == 1 and feed.subscriber_errors == 1
+    feed.unsubscribe(listener)
+    feed.publish("Equipment", {"equipment_id": "E2"})
+    assert len(received) == 1
+
+
+def test_off_feed_never_starts():
+    feed = ChangeFeed("off")
+    received = []
+    feed.subscribe(received.append)
+    assert not feed.start() and not feed.complete
+    feed.publish("Equipment", {"equipment_id": "E1"})
+    assert received == [] and feed.stats()["source"] == "off"
+
+
+def test_polling_reports_inserts_and_changed_columns(monkeypatch):
+    equipment_columns = change_feed.TABLES["Equipment"][1]
+    row = {column: None for column in equipment_columns}
+    row.update(equipment_id="E1", serial_number="SN-1", current_city="Toronto", latitude=43.6)
+    tables = {"Equipment": [dict(row, commit_version=T0)], "MaintenanceJob": [{"commit_version": T0}],
+              "CustomerEquipmentAssignment": [{"commit_version": None}]}
+    monkeypatch.setattr(change_feed, "run_queries_batch", lambda queries, consistency=None: {t: tables[t] for t in queries})
+    source = PollingSource(interval=60)
+    assert source._seed()
+
+    later = T0 + timedelta(seconds=5)
+    moved = dict(row, current_city="Ottawa", latitude=45.4, last_update_time=later, commit_version=later)
+    new_job = {"job_id": "J1", "equipment_id": "E1", "job_date": later, "job_description": "", "cost": 1.0,
+               "service_type": "Repair", "create_time": later, "commit_version": later}
+    tables = {"Equipment": [moved, dict(moved, equipment_id="E2", commit_version=later)],
+              "MaintenanceJob": [new_job], "CustomerEquipmentAssignment": []}
+    events = []
+    source.poll(events.append)
+    assert [(event["table"], event["mod_type"], event["keys"]) for event in events] == [
+        ("Equipment", "UPDATE", {"equipment_id": "E1"}),
+        ("Equipment", "INSERT", {"equipment_id": "E2"}),
+        ("MaintenanceJob", "INSERT", {"job_id": "J1"}),
+    ]
+    assert events[0]["columns"] == ["current_city", "latitude"]
+    assert source._watermarks["Equipment"] == later
+
+    tables = {"Equipment": [dict(moved, commit_version=later + timedelta(seconds=1))], "MaintenanceJob": [],
+              "CustomerEquipmentAssignment": []}
+    events.clear()
+    source.poll(events.append)
+    assert events == []  # rewritten with the same values
+
+
+def test_change_stream_records_become_events_and_start_children(monkeypatch):
+    source = ChangeStreamSource()
+    events, spawned = [], []
+    source._emit = events.append
+    monkeypatch.setattr(source, "_spawn", lambda token, start: spawned.append((token, start)))
+    record = {
+        "data_change_record": [{
+            "commit_timestamp": T0, "table_name": "MaintenanceJob", "mod_type": "INSERT",
+            "mods": [{"keys": '{"job_id": "J1"}', "new_values": '{"equipment_id": "E1", "job_date": "2026-05-31T00:00:00Z"}'}],
+        }],
+        "heartbeat_record": [{"timestamp": T0 + timedelta(seconds=10)}],
+        "child_partitions_record": [{"start_timestamp": T0, "child_partitions": [{"token": "child-1"}]}],
+    }
+    resume_at = source._handle(record, T0 - timedelta(minutes=1))
+    assert resume_at == T0 + timedelta(seconds=10)
+    assert events[0]["keys"] == {"job_id": "J1"}
+    assert events[0]["values"]["job_date"] == datetime(2026, 5, 31, tzinfo=timezone.utc)
+    assert spawned == [("child-1", T0)]
@@ -0,0 +1,44 @@
+import itertools
+import random
+
+import pytest
+
+from graph_engine import co_location_pairs
+
+
+def _groups(rng, locations=4, max_members=7):
+    groups = []
+    for number in range(locations):
+        members = [{"equipment_id": f"id-{rng.randrange(10 ** 6):06d}", "serial_number": f"SN-{rng.randrange(10 ** 6):06d}",
+                    "make": rng.choice(["CAT", "Deere"])} for _ in range(rng.randrange(2, max_members + 1))]
+        members.sort(key=lambda member: member["serial_number"])
+        groups.append({"location_id": f"L{number}", "location_name": f"Yard {number}", "unit_count": len(members),
+                       "members": members})
+    return groups
+
+
+def _legacy_pairs(groups, limit):
+    """The original pair query: eq1 id < eq2 id, ORDER BY location name, eq1 serial, eq2 serial."""
+    rows = []
+    for group in groups:
+        for first, second in itertools.permutations(group["members"], 2):
+            if first["equipment_id"] < second["equipment_id"]:
+                rows.append({"equipment1_sn": first["serial_number"], "equipment1_make": first["make"],
+                             "equipment2_sn": second["serial_number"], "equipment2_make": second["make"],
+                             "shared_location_name": group["location_name"]})
+    rows.sort(key=lambda row: (row["shared_location_name"], row["equipment1_sn"], row["equipment2_sn"]))
+    return rows[:limit]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("limit", [0, 1, 5, 1000])
+def test_pairs_match_the_legacy_query(seed, limit):
+    groups = _groups(random.Random(seed))
+    assert co_location_pairs(groups, limit) == _legacy_pairs(groups, limit)
+
+
+def test_every_location_with_two_units_yields_a_pair():
+    # The GQL path reads only `limit` locations on the strength of this.
+    groups = _groups(random.Random(9), locations=6, max_members=2)
+    pairs = co_location_pairs(groups, 6)
+    assert [row["shared_location_name"] for row in pairs] == [group["location_name"] for group in groups]
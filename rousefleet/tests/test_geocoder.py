@@ -0,0 +1,53 @@
+import pytest
+
+import geocoder as geocoder_module
+from geocoder import Geocoder
+
+
+@pytest.fixture
+def geocoder():
+    return Geocoder(memo_size=8)
+
+
+@pytest.mark.parametrize("text, city, matched_by", [
+    ("Houston, TX", "Houston", "city_state"),
+    ("houston texas", "Houston", "city_state"),
+    ("Ft. Worth", "Fort Worth", "city"),
+    ("Boston MA 02110", "Boston", "city_state"),
+    ("M5V 2N1", "Toronto", "postal_prefix"),
+])
+def test_free_text_resolves_to_gazetteer_places(geocoder, text, city, matched_by):
+    result = geocoder.geocode(text)
+    assert result["city"] == city and result["matched_by"] == matched_by
+
+
+def test_coordinates_keep_their_signs(geocoder):
+    west = geocoder.geocode("43.65, -79.38")
+    east = geocoder.geocode("43.65, 79.38")
+    assert (west["latitude"], west["longitude"]) == (43.65, -79.38)
+    assert (east["latitude"], east["longitude"]) == (43.65, 79.38)
+    assert geocoder.geocode(" 43.65,-79.38 ") is west  # same parsed point, same memo entry
+    assert (geocoder.hits, geocoder.misses) == (1, 2)
+
+
+def test_out_of_range_coordinates_do_not_resolve(geocoder):
+    assert geocoder.geocode("95.0, -79.38") is None
+
+
+def test_memo_folds_case_and_punctuation_and_stays_bounded(geocoder):
+    assert geocoder.geocode("Houston, TX") is geocoder.geocode("  HOUSTON,   tx. ")
+    assert geocoder.hits == 1
+    for i in range(20):
+        geocoder.geocode(f"Nowhere {i}")
+    assert geocoder.stats()["memo_entries"] == 8
+    assert geocoder.geocode("") is None
+
+
+def test_service_locations_resolve_and_clear_cached_misses(geocoder, monkeypatch):
+    assert geocoder.geocode("Toronto Central Depot") is None
+    rows = [{"name": "Toronto Central Depot", "city": "Toronto", "state_province": "ON", "postal_code": "M5V 2N1",
+             "country": "CA", "latitude": 43.642, "longitude": -79.387}]
+    monkeypatch.setattr(geocoder_module.spanner_data, "run_query", lambda sql, expected_fields=None: rows)
+    assert geocoder.load_service_locations() == 1
+    assert geocoder.geocode("Toronto Central Depot")["matched_by"] == "location_name"
+    assert geocoder.geocode("m5v2n1")["latitude"] == 43.642
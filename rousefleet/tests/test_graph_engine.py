@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import graph_engine
+from graph_engine import FleetGraphEngine, _GraphState
+
+T0 = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _results(**tables):
+    results = {table: [] for table in graph_engine._TABLES}
+    for table, rows in tables.items():
+        results[table] = [dict(row, commit_version=row.get("commit_version", T0)) for row in rows]
+    return results
+
+
+def _location(location_id, name):
+    return {"location_id": location_id, "name": name}
+
+
+def _unit(equipment_id, location_id, serial=None):
+    return {"equipment_id": equipment_id, "serial_number": serial or f"SN-{equipment_id}", "make": "CAT", "model": "320",
+            "current_service_location_id": location_id}
+
+
+def _job(job_id, equipment_id, days_ago):
+    return {"job_id": job_id, "equipment_id": equipment_id, "job_date": T0 - timedelta(days=days_ago) if days_ago is not None else None,
+            "job_description": "", "service_type": "Repair", "cost": 1.0}
+
+
+def _assignment(assignment_id, customer_id, equipment_id):
+    return {"assignment_id": assignment_id, "customer_id": customer_id, "equipment_id": equipment_id,
+            "assignment_type": "Rental", "assignment_start_date": None, "assignment_end_date": None}
+
+
+def _base():
+    return _results(
+        ServiceLocation=[_location("L1", "North Yard"), _location("L2", "South Yard")],
+        Customer=[{"customer_id": "C1", "customer_name": "Acme", "industry_type": "Construction"}],
+        Equipment=[_unit("E1", "L1"), _unit("E2", "L1"), _unit("E3", "L2"), _unit("E4", None)],
+        MaintenanceJob=[_job("J1", "E1", 30), _job("J2", "E1", None), _job("J3", "E1", 2)],
+        CustomerEquipmentAssignment=[_assignment("A1", "C1", "E1")],
+    )
+
+
+def _snapshot(state):
+    """Every traversal the engine serves, in comparable form."""
+    return {
+        "at": {location: state.equipment_at(location) for location in range(len(state.locations))},
+        "jobs": {unit: list(state.jobs_of(unit)) for unit in range(len(state.equipment))},
+        "by_customer": {customer: sorted(state.assignments_of_customer(customer)) for customer in range(len(state.customers))},
+        "by_unit": {unit: sorted(state.assignments_of_equipment(unit)) for unit in range(len(state.equipment))},
+    }
+
+
+def test_apply_fills_labels_edges_and_watermarks():
+    state = _GraphState()
+    state.apply(_base())
+    assert len(state.equipment) == 4 and state.delta_count == 4 + 3 + 1
+    north = state.locations.index["L1"]
+    assert [state.equipment.get(node, "equipment_id") for node in state.equipment_at(north)] == ["E1", "E2"]
+    e1 = state.equipment.index["E1"]
+    assert [state.jobs.get(job, "job_id") for job in state.jobs_of(e1)] == ["J3", "J1", "J2"]  # newest first, undated last
+    assert state.watermarks["Equipment"] == T0
+
+
+def test_compact_preserves_every_traversal_and_clears_deltas():
+    state = _GraphState()
+    state.apply(_base())
+    before = _snapshot(state)
+    state.compact()
+    assert state.delta_count == 0 and not state.moved_equipment and not state.new_jobs
+    assert _snapshot(state) == before
+
+
+def test_deltas_after_compact_merge_with_the_arrays():
+    state = _GraphState()
+    state.apply(_base())
+    state.compact()
+    later = T0 + timedelta(minutes=1)
+    state.apply(_results(Equipment=[dict(_unit("E2", "L2"), commit_version=later), _unit("E5", "L1")],
+                         MaintenanceJob=[_job("J4", "E1", 0), _job("J5", "E404", 0)],
+                         CustomerEquipmentAssignment=[_assignment("A2", "C1", "E5")]))
+    merged = _snapshot(state)
+    north, south = state.locations.index["L1"], state.locations.index["L2"]
+    ids = lambda nodes: [state.equipment.get(node, "equipment_id") for node in nodes]
+    assert ids(state.equipment_at(north)) == ["E1", "E5"]
+    assert ids(state.equipment_at(south)) == ["E2", "E3"]
+    assert [state.jobs.get(job, "job_id") for job in state.jobs_of(state.equipment.index["E1"])] == ["J4", "J3", "J1", "J2"]
+    assert "J5" not in state.jobs.index  # the job's unit is unknown
+    assert state.watermarks["Equipment"] == later
+    state.compact()
+    assert _snapshot(state) == merged
+
+
+def test_copy_is_independent_of_the_original():
+    state = _GraphState()
+    state.apply(_base())
+    copy = state.copy()
+    copy.compact()
+    state.apply(_results(Equipment=[_unit("E9", "L1")]))
+    assert "E9" not in copy.equipment.index
+    assert len(copy.equipment_location) == 4 and state.delta_count > 0
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    monkeypatch.setattr(graph_engine, "run_queries_batch", lambda queries, consistency=None: _base())
+    engine = FleetGraphEngine(refresh_seconds=0, full_reload_seconds=0, compact_threshold=2)
+    engine.warm_load()
+    return engine
+
+
+def test_feed_events_apply_and_compaction_swaps_in_a_copy(engine):
+    loaded = engine._state
+    engine.apply_change({"table": "Equipment", "mod_type": "INSERT", "keys": {"equipment_id": "E7"},
+                         "values": _unit("E7", "L2"), "columns": None, "commit_timestamp": T0, "source": "test"})
+    engine.apply_change({"table": "Equipment", "mod_type": "UPDATE", "keys": {"equipment_id": "E1"},
+                         "values": {"current_service_location_id": "L2"}, "columns": ["current_service_location_id"],
+                         "commit_timestamp": T0, "source": "test"})
+    assert engine._state is loaded and engine._state.delta_count == 2
+    engine.apply_change({"table": "MaintenanceJob", "mod_type": "INSERT", "keys": {"job_id": "J8"},
+                         "values": _job("J8", "E7", 1), "columns": None, "commit_timestamp": T0, "source": "test"})
+    if engine._compact_thread is not None:
+        engine._compact_thread.join(5)
+    assert engine._state is not loaded and engine.compactions == 1 and engine._state.delta_count == 0
+    groups = {group["location_id"]: [m["equipment_id"] for m in group["members"]]
+              for group in engine.co_location_groups(min_units=1)}
+    assert groups == {"L1": ["E2"], "L2": ["E1", "E3", "E7"]}
+    assert engine.maintenance_for_customer_equipment("Acme")[0]["job_id"] == "J3"
+
+
+def test_compact_replays_events_that_arrive_while_it_runs(engine, monkeypatch):
+    engine.compact_threshold = 0
+    rebuild = _GraphState.compact
+
+    def compact_with_a_write(state):
+        if state is not engine._state:  # the copy: a feed event lands meanwhile
+            engine.apply_change({"table": "Equipment", "mod_type": "INSERT", "keys": {"equipment_id": "E8"},
+                                 "values": _unit("E8", "L1"), "columns": None, "commit_timestamp": T0, "source": "test"})
+        rebuild(state)
+
+    monkeypatch.setattr(_GraphState, "compact", compact_with_a_write)
+    monkeypatch.setattr(engine, "_compact_in_background", lambda: None)
+    engine._state.delta_count = 1
+    assert engine.compact()
+    assert "E8" in engine._state.equipment.index
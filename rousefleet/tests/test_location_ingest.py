@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import location_ingest
+from location_ingest import LocationIngestBuffer, parse_ping
+
+T0 = datetime(2026, 6, 1, 12, tzinfo=timezone.utc)
+
+
+def _ping(equipment_id, seconds, **values):
+    return {"equipment_id": equipment_id, "values": values, "timestamp": T0 + timedelta(seconds=seconds)}
+
+
+@pytest.fixture
+def buffer(monkeypatch):
+    buffer = LocationIngestBuffer(flush_interval=60)
+    monkeypatch.setattr(buffer, "_ensure_flusher", lambda: None)  # flushed by hand below
+    buffer.written = []
+    buffer.missing = set()
+
+    def write(updates):
+        buffer.written.append(updates)
+        return set(buffer.missing), {}
+
+    monkeypatch.setattr(buffer, "_write", write)
+    monkeypatch.setattr(location_ingest, "_flush_listeners", [])
+    return buffer
+
+
+def test_pings_for_one_unit_collapse_to_the_latest(buffer):
+    futures = buffer.submit([
+        _ping("E1", 10, latitude=1.0, longitude=1.0),
+        _ping("E1", 30, latitude=3.0, longitude=3.0),
+        _ping("E1", 20, latitude=2.0, longitude=2.0, current_city="Ottawa"),  # late: only fills gaps
+        _ping("E2", 5, current_city="Toronto"),
+    ])
+    buffer.flush_now()
+    assert buffer.written == [{"E1": {"latitude": 3.0, "longitude": 3.0, "current_city": "Ottawa"},
+                               "E2": {"current_city": "Toronto"}}]
+    assert [future.result(0) for future in futures[:3]] == [{"status": "updated", "coalesced_pings": 3}] * 3
+    assert (buffer.pings_received, buffer.pings_coalesced, buffer.rows_written) == (4, 2, 2)
+
+
+def test_equal_timestamps_take_the_later_arrival(buffer):
+    buffer.submit([_ping("E1", 0, latitude=1.0), _ping("E1", 0, latitude=2.0)])
+    buffer.flush_now()
+    assert buffer.written == [{"E1": {"latitude": 2.0}}]
+
+
+def test_unknown_units_fail_alone_and_listeners_see_the_rest(buffer):
+    seen = []
+    location_ingest.add_flush_listener(seen.append)
+    buffer.missing = {"E404"}
+    known, unknown = buffer.submit([_ping("E1", 0, latitude=1.0), _ping("E404", 0, latitude=1.0)])
+    buffer.flush_now()
+    assert known.result(0)["status"] == "updated"
+    assert unknown.result(0) == {"status": "error", "error": "Equipment ID 'E404' not found"}
+    assert seen == [{"E1": {"latitude": 1.0}}]
+
+
+def test_a_failed_write_fails_every_ping_in_the_flush(buffer, monkeypatch):
+    def fail(updates):
+        raise ConnectionError("Spanner database connection not initialized.")
+
+    monkeypatch.setattr(buffer, "_write", fail)
+    futures = buffer.submit([_ping("E1", 0, latitude=1.0), _ping("E2", 0, latitude=1.0)])
+    buffer.flush_now()
+    assert all(future.result(0)["status"] == "error" for future in futures)
+    assert buffer.rows_written == 0
+
+
+def test_parse_ping():
+    ping, error = parse_ping({"equipment_id": "E1", "latitude": "43.6", "longitude": -79.4, "timestamp": "2026-06-01T12:00:00"})
+    assert error is None
+    assert ping["values"] == {"latitude": 43.6, "longitude": -79.4}
+    assert ping["timestamp"] == T0
+    assert parse_ping({"equipment_id": "E1"})[1] == "Ping must include latitude/longitude, new_city or new_address"
+    assert parse_ping({"latitude": 1.0})[1] == "Missing required field: equipment_id"
+    assert parse_ping({"equipment_id": "E1", "latitude": "north"})[1] == "Invalid latitude value. Must be a number."
@@ -0,0 +1,67 @@
+import itertools
+import re
+import sqlite3
+
+import pytest
+
+from pagination import build_page, decode_cursor, encode_cursor, keyset_after_condition
+
+# SQLite, like Spanner, sorts NULLs first in ascending order.
+ROWS = [(city, make, f"id-{i:02d}") for i, (city, make) in
+        enumerate(itertools.product([None, "Boston", "Toronto"], [None, "CAT", "Deere"]))]
+
+
+@pytest.fixture
+def table():
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE Equipment (current_city TEXT, make TEXT, equipment_id TEXT PRIMARY KEY)")
+    db.executemany("INSERT INTO Equipment VALUES (?, ?, ?)", ROWS)
+    yield db
+    db.close()
+
+
+def _after(db, columns, key_values):
+    condition, params = keyset_after_condition(columns, key_values)
+    condition = re.sub(r"@(\w+)", r":\1", condition)  # SQLite's named parameters
+    sql = f"SELECT {', '.join(columns)} FROM Equipment WHERE {condition} ORDER BY {', '.join(columns)}"
+    return db.execute(sql, params).fetchall()
+
+
+def test_condition_matches_ordered_scan(table):
+    columns = ["current_city", "make", "equipment_id"]
+    ordered = table.execute(f"SELECT {', '.join(columns)} FROM Equipment ORDER BY {', '.join(columns)}").fetchall()
+    for position, row in enumerate(ordered):
+        assert _after(table, columns, list(row)) == ordered[position + 1:]
+
+
+def test_condition_binds_no_null_values():
+    condition, params = keyset_after_condition(["current_city", "equipment_id"], [None, "id-03"])
+    assert "current_city IS NOT NULL" in condition
+    assert params == {"after_1": "id-03"}
+
+
+def test_condition_leads_with_a_seekable_bound():
+    condition, params = keyset_after_condition(["current_city", "equipment_id"], ["Boston", "id-03"], param_prefix="p")
+    assert condition.startswith("current_city >= @p_0 AND ")
+    assert params == {"p_0": "Boston", "p_1": "id-03"}
+
+
+def test_single_column_condition():
+    assert keyset_after_condition(["equipment_id"], ["id-03"]) == ("equipment_id > @after_0", {"after_0": "id-03"})
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(["Boston", None, 3]), 3) == ["Boston", None, 3]
+    assert decode_cursor("", 2) is None
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(["Boston"]), 2)
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor!", 1)
+
+
+def test_build_page_sets_cursor_only_when_more_rows():
+    rows = [{"equipment_id": f"id-{i}"} for i in range(3)]
+    page = build_page(rows, 2, ["equipment_id"])
+    assert page["has_more"] and page["items"] == rows[:2]
+    assert decode_cursor(page["next_cursor"], 1) == ["id-1"]
+    assert build_page(rows, 3, ["equipment_id"]) == {"items": rows, "next_cursor": None, "has_more": False}
@@ -0,0 +1,85 @@
+import pytest
+
+import read_cache
+from read_cache import TTLCache
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(read_cache.time, "monotonic", clock)
+    return clock
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = TTLCache("test", ttl_seconds=10)
+    cache.put("key", "value")
+    clock.now += 9
+    assert cache.get("key") == (True, "value")
+    clock.now += 2
+    assert cache.get("key") == (False, None)
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = TTLCache("test", max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1) and cache.get("c") == (True, 3)
+    assert cache.evictions == 1
+
+
+def test_load_started_before_invalidation_is_not_stored(clock):
+    cache = TTLCache("test")
+
+    def load():
+        cache.invalidate()  # a write commits while the loader reads
+        return "stale"
+
+    assert cache.get_or_load("key", load) == "stale"
+    assert cache.get("key") == (False, None)
+    assert cache.get_or_load("key", lambda: "fresh") == "fresh"
+    assert cache.get("key") == (True, "fresh")
+
+
+def test_failed_loads_are_not_cached(clock):
+    cache = TTLCache("test")
+    assert cache.get_or_load("key", lambda: None) is None
+    assert cache.get("key") == (False, None)
+
+
+def test_values_stored_in_settle_window_expire_with_it(clock):
+    cache = TTLCache("test", ttl_seconds=300, settle_seconds=10)
+    cache.invalidate()
+    clock.now += 4
+    cache.put("key", "maybe stale")
+    clock.now += 5
+    assert cache.get("key") == (True, "maybe stale")
+    clock.now += 2
+    assert cache.get("key") == (False, None)
+    cache.put("key", "settled")  # past the window: full TTL again
+    clock.now += 200
+    assert cache.get("key") == (True, "settled")
+
+
+def test_notify_write_matches_tables_and_columns(clock):
+    whole = read_cache.register_cache("test-whole-row", depends_on={"Customer": None})
+    names = read_cache.register_cache("test-names", depends_on={"Customer": ("customer_name",)})
+    for cache in (whole, names):
+        cache.put("key", "value")
+    read_cache.notify_write("Customer", columns=["region"])
+    assert whole.get("key") == (False, None)
+    assert names.get("key") == (True, "value")
+    read_cache.notify_write("Customer", columns=["customer_name"])
+    assert names.get("key") == (False, None)
+    assert read_cache.register_cache("test-names") is names
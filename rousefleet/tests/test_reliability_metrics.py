@@ -0,0 +1,69 @@
+import math
+from datetime import datetime, timezone
+
+import pytest
+
+from reliability_metrics import TRAILING_DAYS, compute, is_repair
+
+DAY = 86400.0
+NOW = datetime(2026, 6, 1, tzinfo=timezone.utc).timestamp()
+
+
+@pytest.fixture
+def rows():
+    units = {"equipment_id": ["E1", "E2", "E3"], "make": ["CAT", "CAT", None],
+             "model": ["320", "320", "X"], "meter_hours": [1000, None, 50]}
+    jobs = {
+        "equipment_id": ["E1", "E1", "E1", "E2", "E9", "E2"],
+        "job_date": [NOW - 10 * DAY, NOW - 40 * DAY, NOW - (TRAILING_DAYS + 30) * DAY, NOW - 5 * DAY, NOW, math.nan],
+        "cost": [100.0, 200.0, 300.0, 50.0, 999.0, math.nan],
+        "service_type": ["Repair - Engine", "Inspection", "REPAIR - Hydraulics", "Oil Change", "Repair", "Repair"],
+    }
+    return compute(units, jobs, now=NOW)
+
+
+def test_unit_metrics(rows):
+    equipment = {row["equipment_id"]: row for row in rows[0]}
+    e1 = equipment["E1"]
+    assert (e1["job_count"], e1["repair_count"]) == (3, 2)
+    assert e1["repair_ratio"] == pytest.approx(2 / 3)
+    assert e1["mean_days_between_jobs"] == pytest.approx((TRAILING_DAYS + 20) / 2)
+    assert e1["cost_per_meter_hour"] == pytest.approx(600 / 1000)
+    assert e1["trailing_spend"] == pytest.approx(300.0)  # the oldest job is outside the window
+    assert e1["last_job_date"] == datetime.fromtimestamp(NOW - 10 * DAY, timezone.utc)
+
+
+def test_undated_jobs_count_but_do_not_date(rows):
+    e2 = {row["equipment_id"]: row for row in rows[0]}["E2"]
+    assert (e2["job_count"], e2["repair_count"]) == (2, 1)
+    assert e2["mean_days_between_jobs"] is None  # only one dated job
+    assert e2["cost_per_meter_hour"] is None  # no meter hours
+    assert e2["trailing_spend"] == pytest.approx(50.0)
+
+
+def test_unit_without_jobs(rows):
+    e3 = {row["equipment_id"]: row for row in rows[0]}["E3"]
+    assert (e3["job_count"], e3["repair_ratio"], e3["last_job_date"]) == (0, None, None)
+    assert e3["cost_per_meter_hour"] == 0.0
+
+
+def test_model_rows_pool_their_units(rows):
+    models = {(row["make"], row["model"]): row for row in rows[1]}
+    assert list(models) == [("CAT", "320")]  # rows without a make are left out
+    model = models["CAT", "320"]
+    assert (model["unit_count"], model["job_count"], model["repair_count"]) == (2, 5, 3)
+    assert model["repair_ratio"] == pytest.approx(3 / 5)
+    assert model["mean_days_between_jobs"] == pytest.approx((TRAILING_DAYS + 20) / 2)
+    assert model["cost_per_meter_hour"] == pytest.approx(600 / 1000)  # only units with meter hours
+    assert model["trailing_spend"] == pytest.approx(350.0 / 2)
+
+
+def test_jobs_on_unknown_units_are_dropped():
+    units = {"equipment_id": [], "make": [], "model": [], "meter_hours": []}
+    jobs = {"equipment_id": ["E9"], "job_date": [NOW], "cost": [1.0], "service_type": ["Repair"]}
+    assert compute(units, jobs, now=NOW) == ([], [])
+
+
+def test_is_repair():
+    assert is_repair("Repair - Engine") and is_repair("emergency REPAIR")
+    assert not is_repair("Inspection") and not is_repair(None)
@@ -0,0 +1,57 @@
+import random
+
+import pytest
+
+from spatial_index import SpatialIndex, haversine_km
+
+
+def _brute_force(units, latitude, longitude, k, category=None, make=None, max_km=None):
+    ranked = []
+    for equipment_id, (unit_category, unit_make, lat, lon) in units.items():
+        if category is not None and unit_category != category or make is not None and unit_make != make:
+            continue
+        distance = haversine_km(latitude, longitude, lat, lon)
+        if max_km is None or distance <= max_km:
+            ranked.append((distance, equipment_id))
+    return [equipment_id for _, equipment_id in sorted(ranked)[:k]]
+
+
+@pytest.fixture
+def fleet():
+    rng = random.Random(11)
+    units = {}
+    for i in range(400):
+        units[f"E{i:03d}"] = (rng.choice(["Excavator", "Loader"]), rng.choice(["CAT", "Deere"]),
+                              rng.uniform(25, 50), rng.uniform(-125, -70))
+    index = SpatialIndex(cell_degrees=0.5, reload_seconds=0)
+    for equipment_id, (category, make, lat, lon) in units.items():
+        index.put(equipment_id, category, make=make, latitude=lat, longitude=lon)
+    return index, units
+
+
+@pytest.mark.parametrize("filters", [{}, {"category": "Loader"}, {"category": "Excavator", "make": "CAT"},
+                                     {"max_km": 300}, {"category": "Dozer"}])
+def test_nearest_matches_brute_force(fleet, filters):
+    index, units = fleet
+    rng = random.Random(3)
+    for _ in range(25):
+        latitude, longitude, k = rng.uniform(20, 55), rng.uniform(-130, -65), rng.choice([1, 5, 20])
+        found = index.nearest(latitude, longitude, k=k, **filters)
+        assert [row["equipment_id"] for row in found] == _brute_force(units, latitude, longitude, k, **filters)
+        assert [row["distance_km"] for row in found] == sorted(row["distance_km"] for row in found)
+
+
+def test_moved_units_are_found_at_their_new_position(fleet):
+    index, _ = fleet
+    index.move("E000", latitude=43.6532, longitude=-79.3832, city="Toronto")
+    nearest = index.nearest(43.65, -79.38, k=1)[0]
+    assert nearest["equipment_id"] == "E000" and nearest["city"] == "Toronto"
+    index.move("E000", latitude=None, longitude=None)
+    assert "E000" not in [row["equipment_id"] for row in index.nearest(43.65, -79.38, k=400)]
+
+
+def test_nearest_on_empty_index_and_zero_k():
+    index = SpatialIndex(reload_seconds=0)
+    assert index.nearest(43.65, -79.38, k=3) == []
+    index.put("E1", "Loader", latitude=43.65, longitude=-79.38)
+    assert index.nearest(43.65, -79.38, k=0) == []